@@ -0,0 +1,37 @@
+"""Build the phase advance -> quad field lookup grid for the phase controller.
+
+The grid is saved where the "Set live optics" button looks for it. It is only
+used while the default optics match the optics it was built from.
+"""
+from __future__ import print_function
+from lib import optics
+from lib import phase_lookup
+from lib import utils
+
+
+sync_mode = "live"  # {'live', 'design'}
+pvloggerid = None  # If not None, sync the model with this PVLoggerID instead.
+kinetic_energy = 1.0e9  # [eV]
+ref_ws_id = "RTBT_Diag:WS24"
+max_offset = 45.0  # [deg]
+n_steps = (13, 13)
+n_workers = 1
+
+controller = optics.PhaseController(
+    ref_ws_id=ref_ws_id, kinetic_energy=kinetic_energy, sync_mode=sync_mode
+)
+if pvloggerid is not None:
+    controller.sync_model_pvloggerid(pvloggerid)
+    controller.set_current_optics_as_default()
+grid = phase_lookup.build(
+    controller,
+    max_offset=utils.radians(max_offset),
+    n_steps=n_steps,
+    n_workers=n_workers,
+    verbose=0,
+)
+filename = phase_lookup.filename(controller)
+grid.save(filename)
+print("Saved grid to {}".format(filename))
+
+exit()
@@ -0,0 +1,148 @@
+"""Check that the JAMA and NumPy backends give the same reconstruction.
+
+Run this script once under Jython (JAMA backend) and once under CPython (NumPy
+backend), in either order. Each run reconstructs the covariance matrix from the
+same fixture (fixed transfer matrices and moments), computes the `BeamStats`,
+and saves the results to `_output/data/backend_parity_<backend>.json`. If the
+results of the other backend are already saved, the two are compared and the
+script exits with status 1 if any value differs by more than the tolerance.
+
+The fixture has three cases: a physical solution (linear least squares only),
+and an unphysical solution constrained by the Cholesky and the Edwards-Teng
+fits, so that the nonlinear solvers are covered too.
+"""
+from __future__ import print_function
+import json
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib"))
+import analysis
+import backend
+import utils
+
+
+output_dir = "_output/data"
+rel_tol = {"linear": 1e-9, "Cholesky": 1e-6, "Edwards-Teng": 1e-6}
+abs_tol = 1e-12
+
+
+def phase_advance_mat(mu_x, mu_y, beta=10.0, coupling=0.0):
+    """Return a 4 x 4 transfer matrix (list) with a small x-y rotation."""
+    Mx = [
+        [math.cos(mu_x), beta * math.sin(mu_x)],
+        [-math.sin(mu_x) / beta, math.cos(mu_x)],
+    ]
+    My = [
+        [math.cos(mu_y), beta * math.sin(mu_y)],
+        [-math.sin(mu_y) / beta, math.cos(mu_y)],
+    ]
+    M = [[0.0] * 4 for _ in range(4)]
+    for i in range(2):
+        for j in range(2):
+            M[i][j] = Mx[i][j]
+            M[i + 2][j + 2] = My[i][j]
+    cs, sn = math.cos(coupling), math.sin(coupling)
+    R = [[cs, 0, sn, 0], [0, cs, 0, sn], [-sn, 0, cs, 0], [0, -sn, 0, cs]]
+    return utils.matmul(R, M)
+
+
+def fixture(xy_scale=1.0):
+    """Return (transfer_mats, moments) measured from a known coupled beam.
+
+    The moments have a fixed relative error. `xy_scale` multiplies the <xy>
+    moments; a large value makes the LLSQ solution unphysical.
+    """
+    Sigma = [
+        [25.0, 1.5, 4.0, 0.3],
+        [1.5, 0.5, 0.2, 0.05],
+        [4.0, 0.2, 16.0, -0.8],
+        [0.3, 0.05, -0.8, 0.4],
+    ]
+    transfer_mats, moments = [], []
+    for k in range(8):
+        M = phase_advance_mat(0.4 * k, 0.3 + 0.55 * k, coupling=0.02 * k)
+        S = utils.matmul(utils.matmul(M, Sigma), utils.transpose(M))
+        err = [1.0 + 0.02 * math.sin(7.0 * k + l) for l in range(3)]
+        moments.append(
+            [S[0][0] * err[0], S[2][2] * err[1], xy_scale * S[0][2] * err[2]]
+        )
+        transfer_mats.append(M)
+    return transfer_mats, moments
+
+
+def results():
+    """Return {case: {name: value}} for the current backend."""
+    cases = [
+        ("linear", fixture(), dict(constr=False)),
+        ("Cholesky", fixture(xy_scale=4.0), dict(constr_method="Cholesky")),
+        ("Edwards-Teng", fixture(xy_scale=4.0), dict(constr_method="Edwards-Teng")),
+    ]
+    output = dict()
+    for case, (transfer_mats, moments), kws in cases:
+        Sigma = analysis.reconstruct(transfer_mats, moments, **kws)
+        stats = analysis.BeamStats(Sigma)
+        values = dict()
+        for i in range(4):
+            for j in range(i, 4):
+                values["sig_{}{}".format(i + 1, j + 1)] = Sigma.get(i, j)
+        for name in [
+            "eps_x",
+            "eps_y",
+            "eps_1",
+            "eps_2",
+            "coupling_coeff",
+            "alpha_x",
+            "alpha_y",
+            "beta_x",
+            "beta_y",
+        ]:
+            values[name] = getattr(stats, name)
+        output[case] = values
+    return output
+
+
+def compare(results1, results2):
+    """Print the differences; return the number of values out of tolerance."""
+    n_fail = 0
+    for case in sorted(results1):
+        max_rel_diff = 0.0
+        for name in sorted(results1[case]):
+            x1, x2 = results1[case][name], results2[case][name]
+            if x1 is None or x2 is None:
+                if x1 is not x2:
+                    print("  {} {}: {} != {}".format(case, name, x1, x2))
+                    n_fail += 1
+                continue
+            diff = abs(x1 - x2)
+            rel_diff = diff / max(abs(x1), abs(x2), abs_tol)
+            max_rel_diff = max(max_rel_diff, rel_diff)
+            if diff > abs_tol and rel_diff > rel_tol[case]:
+                print("  {} {}: {} != {}".format(case, name, x1, x2))
+                n_fail += 1
+        print("{}: max relative difference = {:.2e}".format(case, max_rel_diff))
+    return n_fail
+
+
+if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+other = "numpy" if backend.NAME == "jama" else "jama"
+filename = os.path.join(output_dir, "backend_parity_{}.json")
+output = results()
+file = open(filename.format(backend.NAME), "w")
+json.dump(output, file, indent=1, sort_keys=True)
+file.close()
+print("Saved {} results to {}".format(backend.NAME, filename.format(backend.NAME)))
+
+if not os.path.isfile(filename.format(other)):
+    print("No {} results yet; run this script with the other backend.".format(other))
+    sys.exit(0)
+file = open(filename.format(other), "r")
+other_output = json.load(file)
+file.close()
+n_fail = compare(output, other_output)
+if n_fail > 0:
+    print("FAIL: {} value(s) differ between jama and numpy.".format(n_fail))
+    sys.exit(1)
+print("PASS: jama and numpy agree.")
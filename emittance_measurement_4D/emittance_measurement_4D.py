@@ -7,6 +7,7 @@ from javax.swing import JFrame
 from javax.swing import JPanel
 from javax.swing import JTabbedPane
 
+from lib import accelerator_registry
 from lib.analysis_panel import AnalysisPanel
 from lib.phase_controller_panel import PhaseControllerPanel
 from lib.time_and_date_lib import DateAndTimeText
@@ -17,6 +18,8 @@ class EmittanceMeasurement4D:
         # Create panels.
         self.phase_controller_panel = PhaseControllerPanel()
         self.analysis_panel = AnalysisPanel()
+        print("Startup (lattice loading):")
+        accelerator_registry.default_registry().print_metrics()
 
         # Add panels to tabbed pane.
         self.pane = JTabbedPane(JTabbedPane.TOP)
@@ -4,16 +4,15 @@ import sys
 import os
 from xal.smf import Accelerator
 from xal.smf import AcceleratorSeq
-from xal.smf.data import XMLDataManager
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from lib import accelerator_registry
 from lib import optics
 
 
 pvloggerid = 49547664
 kinetic_energy = 0.8e9
-accelerator = XMLDataManager.loadDefaultAccelerator()
-sequence = accelerator.getComboSequence("RTBT")
+sequence = accelerator_registry.get_sequence("RTBT")
 tmatgen = optics.TransferMatrixGenerator(sequence, kinetic_energy)
 tmatgen.sync(pvloggerid)
 
@@ -23,13 +22,12 @@ for ws_id in ws_ids:
     file.write(
         "node_id M11 M12 M13 M14 M21 M22 M23 M34 M31 M32 M33 M34 M41 M42 M43 M44\n"
     )
-    for node in sequence.getNodes():
-        node_id = node.getId()
-        print(node_id)
-        M = tmatgen.generate(node_id, ws_id)
+    print(ws_id)
+    tmats = tmatgen.to_target(ws_id)
+    for node_id, M in zip(tmatgen.node_ids, tmats):
         file.write(
             "{} {} {} {} {} {} {} {} {} {} {} {} {} {} {} {} {}\n".format(
-                node.getId(), *[M[i][j] for i in range(4) for j in range(4)]
+                node_id, *[M[i][j] for i in range(4) for j in range(4)]
             )
         )
     file.close()
@@ -0,0 +1,170 @@
+"""Process-wide registry of the SNS accelerator, its sequences and scenarios.
+
+`XMLDataManager.loadDefaultAccelerator` parses the full lattice XML every time
+it is called. The registry loads the accelerator once and hands out the combo
+sequences ("Ring", "RTBT") and scenarios by name. `invalidate` forgets
+everything so the next request reloads the XML (e.g. after the lattice files
+change). `lattice_id` identifies the loaded lattice files, so that results
+saved to disk (e.g. by `ring_twiss`) are not reused after the lattice changes.
+The time spent loading the accelerator and building sequences and scenarios is
+recorded (see `metrics`).
+"""
+from __future__ import print_function
+import os
+import threading
+import time
+
+from xal.sim.scenario import Scenario
+from xal.smf.data import XMLDataManager
+
+
+class AcceleratorRegistry:
+    """Lazily loaded accelerator, sequences and scenarios.
+
+    Parameters
+    ----------
+    loader : callable
+        Returns the accelerator.
+    path_finder : callable
+        Returns the path of the accelerator file that `loader` reads.
+    """
+
+    def __init__(
+        self,
+        loader=XMLDataManager.loadDefaultAccelerator,
+        path_finder=XMLDataManager.defaultPath,
+    ):
+        self.loader = loader
+        self.path_finder = path_finder
+        self.lock = threading.RLock()
+        self._accelerator = None
+        self._lattice_id = None
+        self.sequences = dict()
+        self.shared_scenarios = dict()
+        self.timings = dict()
+
+    def _record(self, name, seconds):
+        count, total = self.timings.get(name, (0, 0.0))
+        self.timings[name] = (count + 1, total + seconds)
+
+    def accelerator(self):
+        """Return the accelerator, loading it on the first call."""
+        with self.lock:
+            if self._accelerator is None:
+                start = time.time()
+                self._accelerator = self.loader()
+                self._lattice_id = lattice_id(self.path_finder())
+                self._record("load accelerator", time.time() - start)
+            return self._accelerator
+
+    def lattice_id(self):
+        """Return the identity of the loaded lattice (see `lattice_id`)."""
+        with self.lock:
+            self.accelerator()
+            return self._lattice_id
+
+    def sequence(self, name):
+        """Return the combo sequence (e.g. "Ring" or "RTBT")."""
+        with self.lock:
+            sequence = self.sequences.get(name)
+            if sequence is None:
+                accelerator = self.accelerator()
+                start = time.time()
+                sequence = accelerator.getComboSequence(name)
+                if sequence is None:
+                    sequence = accelerator.getSequence(name)
+                if sequence is None:
+                    raise KeyError("No sequence named {}.".format(name))
+                self._record("sequence " + name, time.time() - start)
+                self.sequences[name] = sequence
+            return sequence
+
+    def new_scenario(self, name):
+        """Return a new scenario for the sequence; the caller owns it."""
+        sequence = self.sequence(name)
+        start = time.time()
+        scenario = Scenario.newScenarioFor(sequence)
+        with self.lock:
+            self._record("scenario " + name, time.time() - start)
+        return scenario
+
+    def shared_scenario(self, name):
+        """Return a prebuilt scenario for the sequence, shared by all callers.
+
+        Callers may set the probe and the synchronization mode but should not
+        set model inputs. Use `new_scenario` to get a private one.
+        """
+        with self.lock:
+            scenario = self.shared_scenarios.get(name)
+            if scenario is None:
+                scenario = self.shared_scenarios[name] = self.new_scenario(name)
+            return scenario
+
+    def invalidate(self):
+        """Forget the accelerator, sequences and scenarios."""
+        with self.lock:
+            self._accelerator = None
+            self._lattice_id = None
+            self.sequences.clear()
+            self.shared_scenarios.clear()
+
+    def metrics(self):
+        """Return {event: (count, total seconds)} for the timed operations."""
+        with self.lock:
+            return dict(self.timings)
+
+    def print_metrics(self):
+        for name, (count, total) in sorted(self.metrics().items()):
+            print("{}: {} call(s), {:.3f} s".format(name, count, total))
+
+
+def lattice_id(path):
+    """Return "<path>@<mtime>" for the accelerator file at `path`.
+
+    mtime is the newest modification time of the files in the folder of the
+    accelerator file (and its subfolders), which hold the lattice files it
+    refers to.
+    """
+    if path is None:
+        return None
+    newest = 0
+    for directory, _, filenames in os.walk(os.path.dirname(os.path.abspath(path))):
+        for filename in filenames:
+            mtime = os.path.getmtime(os.path.join(directory, filename))
+            newest = max(newest, int(mtime))
+    return "{}@{}".format(path, newest)
+
+
+_default_registry = None
+
+
+def default_registry():
+    """Return the registry shared by the module-level functions."""
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = AcceleratorRegistry()
+    return _default_registry
+
+
+def get_accelerator():
+    return default_registry().accelerator()
+
+
+def get_sequence(name):
+    return default_registry().sequence(name)
+
+
+def get_lattice_id():
+    return default_registry().lattice_id()
+
+
+def new_scenario(name):
+    return default_registry().new_scenario(name)
+
+
+def shared_scenario(name):
+    return default_registry().shared_scenario(name)
+
+
+def invalidate():
+    default_registry().invalidate()
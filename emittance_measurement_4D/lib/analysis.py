@@ -6,20 +6,15 @@ import random
 from math import sqrt, sin, cos
 from pprint import pprint
 from datetime import datetime
-from Jama import Matrix
-
-from xal.extension.solver import Scorer
-from xal.service.pvlogger.sim import PVLoggerDataSource
-from xal.sim.scenario import Scenario
-from xal.smf import Accelerator
-from xal.smf import AcceleratorSeq
-from xal.smf.data import XMLDataManager
 
 # Local
-from least_squares import lsq_linear
+from backend import Matrix
+from least_squares import FactoredMatrix
+from least_squares import levenberg_marquardt
+from least_squares import lsq_linear_batch
+import parallel
+import sobol
 import utils
-from xal_helpers import minimize
-from xal_helpers import get_trial_vals
 
 
 DIAG_WIRE_ANGLE = utils.radians(-45.0)
@@ -123,16 +118,132 @@ def V_matrix_uncoupled(alpha_x, alpha_y, beta_x, beta_y):
     return V
 
 
+def trial_values(Sigma):
+    """Return the parameters tracked by `TrialStats` (None if Sigma is unphysical)."""
+    if not is_valid_covariance_matrix(Sigma):
+        return None
+    eps_x, eps_y, eps_1, eps_2 = emittances(Sigma)
+    alpha_x, alpha_y, beta_x, beta_y = twiss2D(Sigma)
+    return [
+        eps_x,
+        eps_y,
+        eps_1,
+        eps_2,
+        eps_x * eps_y,
+        eps_1 * eps_2,
+        alpha_x,
+        alpha_y,
+        beta_x,
+        beta_y,
+    ]
+
+
+class TrialStats:
+    """Running statistics of the beam parameters over random trials.
+
+    The mean and standard deviation of each parameter are updated as each
+    trial is added (see `utils.RunningStats`), so the covariance matrices do
+    not have to be stored. Trials that give an unphysical covariance matrix
+    are counted but do not contribute to the statistics.
+
+    Attributes
+    ----------
+    n_trials : int
+        The number of trials added.
+    n_fail : int
+        The number of trials with an unphysical covariance matrix.
+    Sigmas : list[Matrix] or None
+        The covariance matrix of each trial (if `keep_sigmas`).
+    """
+
+    names = [
+        "eps_x",
+        "eps_y",
+        "eps_1",
+        "eps_2",
+        "eps_x_eps_y",
+        "eps_1_eps_2",
+        "alpha_x",
+        "alpha_y",
+        "beta_x",
+        "beta_y",
+    ]
+
+    def __init__(self, Sigmas=None, keep_sigmas=False):
+        self.stats = dict()
+        for name in self.names:
+            self.stats[name] = utils.RunningStats()
+        self.n_trials = self.n_fail = 0
+        self.Sigmas = [] if keep_sigmas else None
+        if Sigmas is not None:
+            for Sigma in Sigmas:
+                self.add(Sigma)
+
+    def add(self, Sigma, keep_invalid=True):
+        """Add the covariance matrix from one trial.
+
+        Returns True if the covariance matrix is physical. If `keep_invalid` is
+        False, unphysical covariance matrices are not stored (even if
+        `keep_sigmas` is True).
+        """
+        return self.add_values(trial_values(Sigma), Sigma, keep_invalid)
+
+    def add_values(self, values, Sigma=None, keep_invalid=True):
+        """Add one trial from its `trial_values` (None if the trial failed)."""
+        self.n_trials += 1
+        valid = values is not None
+        if self.Sigmas is not None and (valid or keep_invalid):
+            self.Sigmas.append(Sigma)
+        if not valid:
+            self.n_fail += 1
+            return False
+        for name, value in zip(self.names, values):
+            self.stats[name].push(value)
+        return True
+
+    def n_success(self):
+        return self.n_trials - self.n_fail
+
+    def fail_rate(self):
+        return float(self.n_fail) / self.n_trials
+
+    def mean_std(self, name):
+        """Return the mean and standard deviation of parameter `name`."""
+        return self.stats[name].mean_std()
+
+    def rel_ci_width(self, z=1.96):
+        """Return the largest relative half-width of the confidence intervals.
+
+        The interval for the mean of each parameter is +/- z * std / sqrt(n),
+        relative to max(|mean|, std). The interval for the standard deviation
+        is +/- z * std / sqrt(2 (n - 1)), relative to std. The default z gives
+        95% confidence intervals.
+        """
+        n = self.n_success()
+        if n < 2:
+            return float("inf")
+        width = z / sqrt(2.0 * (n - 1))
+        for name in self.names:
+            mean, std = self.mean_std(name)
+            scale = max(abs(mean), std)
+            if scale > 0:
+                width = max(width, z * std / sqrt(n) / scale)
+        return width
+
+
 class BeamStats:
     """Container for beam statistics calculated from the covariance matrix."""
 
-    def __init__(self, Sigma, Sigmas=None):
+    def __init__(self, Sigma, Sigmas=None, trial_stats=None):
         """Constructor
 
         Sigma : Jama Matrix, shape (4, 4)
             The covariance matrix.
         Sigmas : list[Jama Matrix or list, shape (4, 4)]
             Ensemble of covariance matrices from random trials.
+        trial_stats : TrialStats
+            Statistics accumulated over random trials (for example, from
+            `random_trials`). Used instead of `Sigmas`.
         """
         self.Sigma = Sigma
         self.eps_x, self.eps_y = apparent_emittances(Sigma)
@@ -146,57 +257,20 @@ class BeamStats:
         self.alpha_x, self.alpha_y, self.beta_x, self.beta_y = twiss2D(Sigma)
 
         self.Sigmas = None
-        self.ran_eps_x_mean = self.ran_eps_x_std = None
-        self.ran_eps_y_mean = self.ran_eps_y_std = None
-        self.ran_eps_1_mean = self.ran_eps_1_std = None
-        self.ran_eps_2_mean = self.ran_eps_2_std = None
-        self.ran_eps_x_eps_y_mean = self.ran_eps_x_eps_y_std = None
-        self.ran_eps_1_eps_2_mean = self.ran_eps_1_eps_2_std = None
-        self.ran_beta_x_mean = self.ran_beta_x_std = None
-        self.ran_beta_y_mean = self.ran_beta_y_std = None
-        self.ran_alpha_x_mean = self.ran_alpha_x_std = None
-        self.ran_alpha_y_mean = self.ran_alpha_y_std = None
-
-        if Sigmas is not None:
-            self.Sigmas = Sigmas
-            (
-                ran_eps_x_list,
-                ran_eps_y_list,
-                ran_eps_1_list,
-                ran_eps_2_list,
-            ) = utils.transpose([emittances(Sigma) for Sigma in Sigmas])
-            self.ran_eps_x_mean, self.ran_eps_x_std = utils.mean_std(ran_eps_x_list)
-            self.ran_eps_y_mean, self.ran_eps_y_std = utils.mean_std(ran_eps_y_list)
-            self.ran_eps_1_mean, self.ran_eps_1_std = utils.mean_std(ran_eps_1_list)
-            self.ran_eps_2_mean, self.ran_eps_2_std = utils.mean_std(ran_eps_2_list)
-
-            ran_eps_x_eps_y_list = [
-                eps_x * eps_y for eps_x, eps_y in zip(ran_eps_x_list, ran_eps_y_list)
-            ]
-            ran_eps_1_eps_2_list = [
-                eps_1 * eps_2 for eps_1, eps_2 in zip(ran_eps_1_list, ran_eps_2_list)
-            ]
-            self.ran_eps_x_eps_y_mean, self.ran_eps_x_eps_y_std = utils.mean_std(
-                ran_eps_x_eps_y_list
-            )
-            self.ran_eps_1_eps_2_mean, self.ran_eps_1_eps_2_std = utils.mean_std(
-                ran_eps_1_eps_2_list
-            )
-
-            (
-                ran_alpha_x_list,
-                ran_alpha_y_list,
-                ran_beta_x_list,
-                ran_beta_y_list,
-            ) = utils.transpose([twiss2D(Sigma) for Sigma in Sigmas])
-            self.ran_beta_x_mean, self.ran_beta_x_std = utils.mean_std(ran_beta_x_list)
-            self.ran_beta_y_mean, self.ran_beta_y_std = utils.mean_std(ran_beta_y_list)
-            self.ran_alpha_x_mean, self.ran_alpha_x_std = utils.mean_std(
-                ran_alpha_x_list
-            )
-            self.ran_alpha_y_mean, self.ran_alpha_y_std = utils.mean_std(
-                ran_alpha_y_list
-            )
+        self.n_trials = 0
+        if trial_stats is None and Sigmas is not None:
+            trial_stats = TrialStats(Sigmas)
+            trial_stats.Sigmas = Sigmas
+        self.trial_stats = trial_stats
+        if trial_stats is not None:
+            self.Sigmas = trial_stats.Sigmas
+            self.n_trials = trial_stats.n_trials
+        for name in TrialStats.names:
+            mean = std = None
+            if trial_stats is not None:
+                mean, std = trial_stats.mean_std(name)
+            setattr(self, "ran_{}_mean".format(name), mean)
+            setattr(self, "ran_{}_std".format(name), std)
 
     def rms_ellipse_dims(dim1, dim2):
         return rms_ellipse_dims(self.Sigma, dim1, dim2)
@@ -263,11 +337,407 @@ def get_sig_xy(sig_xx, sig_yy, sig_uu, diag_wire_angle):
     return sig_xy
 
 
+def design_matrix(transfer_mats):
+    """Return the LLSQ design matrix.
+
+    Row 3i (3i + 1, 3i + 2) relates <xx> (<yy>, <xy>) at the ith measurement
+    to the 10 element moment vector at the reconstruction point.
+    """
+    A = []
+    for M in transfer_mats:
+        A.append(
+            [M[0][0]**2, M[0][1]**2, 2 * M[0][0] * M[0][1], 0, 0, 0, 0, 0, 0, 0]
+        )
+        A.append(
+            [0, 0, 0, M[2][2]**2, M[2][3]**2, 2 * M[2][2] * M[2][3], 0, 0, 0, 0]
+        )
+        A.append(
+            [
+                0,
+                0,
+                0,
+                0,
+                0,
+                0,
+                M[0][0] * M[2][2],
+                M[0][1] * M[2][2],
+                M[0][0] * M[2][3],
+                M[0][1] * M[2][3],
+            ]
+        )
+    return A
+
+
+def target_vector(moments):
+    """Return the LLSQ target vector from a list of [<xx>, <yy>, <xy>]."""
+    b = []
+    for sig_xx, sig_yy, sig_xy in moments:
+        b.append(sig_xx)
+        b.append(sig_yy)
+        b.append(sig_xy)
+    return b
+
+
+class ReconstructionSystem:
+    """Block-structured LLSQ system for the moments at the reconstruction point.
+
+    The <xx> rows of the design matrix only involve (sig_11, sig_22, sig_12),
+    the <yy> rows only involve (sig_33, sig_44, sig_34), and the <xy> rows only
+    involve (sig_13, sig_23, sig_14, sig_24). So instead of one (3n x 10)
+    problem, we solve three independent problems of size (n x 3), (n x 3) and
+    (n x 4). Each block is factored once and can be reused for any number of
+    target vectors.
+
+    Attributes
+    ----------
+    blocks : list[list, shape (n, 3 or 4)]
+        The design matrix of the <xx>, <yy> and <xy> blocks.
+    """
+
+    block_names = ["xx", "yy", "xy"]
+
+    def __init__(self, transfer_mats):
+        A_xx, A_yy, A_xy = [], [], []
+        for M in transfer_mats:
+            A_xx.append([M[0][0]**2, M[0][1]**2, 2 * M[0][0] * M[0][1]])
+            A_yy.append([M[2][2]**2, M[2][3]**2, 2 * M[2][2] * M[2][3]])
+            A_xy.append(
+                [
+                    M[0][0] * M[2][2],
+                    M[0][1] * M[2][2],
+                    M[0][0] * M[2][3],
+                    M[0][1] * M[2][3],
+                ]
+            )
+        self.blocks = [A_xx, A_yy, A_xy]
+        self._factors = None
+
+    def factors(self):
+        """Return the (cached) factorization of each block."""
+        if self._factors is None:
+            self._factors = [FactoredMatrix(A) for A in self.blocks]
+        return self._factors
+
+    def cond(self):
+        """Return the condition number of each block [xx, yy, xy]."""
+        return [Matrix(A).cond() for A in self.blocks]
+
+    def solve(self, moments, **lsq_kws):
+        """Return the 10 element moment vector from a list of [<xx>, <yy>, <xy>]."""
+        return self.solve_batch([moments], **lsq_kws)[0]
+
+    def solve_batch(self, moments_list, **lsq_kws):
+        """Solve the system for many sets of measured moments at once.
+
+        Parameters
+        ----------
+        moments_list : list[list[list, shape (3,)], shape (n,)], shape (k,)
+            Each element is a list of the measured [<xx>, <yy>, <xy>] moments.
+        **lsq_kws
+            Key word arguments passed to `lsq_linear_batch`.
+
+        Returns
+        -------
+        list[list, shape (10,)], shape (k,)
+            The 10 element moment vector for each set of moments.
+        """
+        solutions = [[] for _ in moments_list]
+        for i, factor in enumerate(self.factors()):
+            # Column j of B holds the i'th moment at each measurement in set j.
+            B = utils.transpose(
+                [[moment[i] for moment in moments] for moments in moments_list]
+            )
+            X = lsq_linear_batch(factor, B, **lsq_kws)
+            for solution, x in zip(solutions, X):
+                solution.extend(x)
+        return solutions
+
+
+# Order of the (i, j) elements of Sigma in the 10 element moment vector.
+VEC_INDICES = [
+    (0, 0), (1, 1), (0, 1), (2, 2), (3, 3), (2, 3), (0, 2), (1, 2), (0, 3), (1, 3)
+]
+
+# Order of the (i, j) elements of the lower-triangular Cholesky factor L in the
+# 10 element parameter vector.
+CHOL_INDICES = [
+    (0, 0), (1, 0), (1, 1), (2, 0), (2, 1), (2, 2), (3, 0), (3, 1), (3, 2), (3, 3)
+]
+
+
+def clip_eigenvalues(Sigma, min_frac=1e-4):
+    """Return the closest positive definite matrix to symmetric matrix `Sigma`.
+
+    Eigenvalues below `min_frac` times the largest eigenvalue are raised to that
+    value; the eigenvectors are unchanged.
+    """
+    eig = Sigma.eig()
+    V = eig.getV()
+    eigvals = eig.getRealEigenvalues()
+    floor = min_frac * max([abs(eigval) for eigval in eigvals])
+    D = utils.diagonal_matrix([max(eigval, floor) for eigval in eigvals])
+    Sigma = V.times(D.times(V.transpose()))
+    return Sigma.plus(Sigma.transpose()).times(0.5)
+
+
+def cholesky_to_mat(x):
+    """Return Sigma = L L^T from the 10 elements of the Cholesky factor L."""
+    L = Matrix(4, 4, 0.0)
+    for (i, j), value in zip(CHOL_INDICES, x):
+        L.set(i, j, value)
+    return L.times(L.transpose())
+
+
+def fit_cholesky(transfer_mats, moments, Sigma0, **lm_kws):
+    """Fit the moments with a covariance matrix of the form Sigma = L L^T.
+
+    Any matrix of this form is positive semidefinite, which in turn guarantees
+    det(Sigma) >= 0 and eps_x * eps_y >= eps_1 * eps_2. So every iterate
+    satisfies the conditions in `is_valid_covariance_matrix`, and the fit only
+    has to minimize the LLSQ residuals. The residuals are quadratic in the
+    elements of L, so the Jacobian is computed exactly and Levenberg-Marquardt
+    converges in a few tens of iterations.
+
+    Parameters
+    ----------
+    transfer_mats, moments : list
+        See `reconstruct`.
+    Sigma0 : Matrix, shape (4, 4)
+        Initial guess (usually the unconstrained LLSQ solution). It does not
+        need to be positive definite.
+    **lm_kws
+        Key word arguments passed to `levenberg_marquardt`.
+
+    Returns
+    -------
+    Matrix, shape (4, 4)
+        The fitted covariance matrix.
+    """
+    A = design_matrix(transfer_mats)
+    b = target_vector(moments)
+    L0 = clip_eigenvalues(Sigma0).chol().getL()
+    x0 = [L0.get(i, j) for (i, j) in CHOL_INDICES]
+
+
+    def fun(x):
+        Sigma = cholesky_to_mat(x)
+        vec = [Sigma.get(i, j) for (i, j) in VEC_INDICES]
+        return [utils.dot(row, vec) - b_i for row, b_i in zip(A, b)]
+
+    def jac(x):
+        # d(Sigma_pq) / d(L_ij) = delta_pi * L_qj + delta_qi * L_pj
+        L = [[0.0] * 4 for _ in range(4)]
+        for (i, j), value in zip(CHOL_INDICES, x):
+            L[i][j] = value
+        D = [[0.0] * len(CHOL_INDICES) for _ in VEC_INDICES]
+        for k, (p, q) in enumerate(VEC_INDICES):
+            for l, (i, j) in enumerate(CHOL_INDICES):
+                if p == i:
+                    D[k][l] += L[q][j]
+                if q == i:
+                    D[k][l] += L[p][j]
+        DT = utils.transpose(D)
+        return [utils.matvec(DT, row) for row in A]
+
+    # When the best fit is singular (eps_2 = 0), one diagonal element of L only
+    # approaches zero asymptotically and the cost creeps down very slowly. Stop
+    # once the relative improvement per step is negligible.
+    lm_kws.setdefault("ftol", 1e-6)
+    x, cost, itn = levenberg_marquardt(fun, jac, x0, **lm_kws)
+    return cholesky_to_mat(x)
+
+
+# The Edwards-Teng parameters, in the order used by `edwards_teng_to_mat`.
+ET_PARAM_NAMES = [
+    "eps_1", "eps_2", "alpha_x", "alpha_y", "beta_x", "beta_y", "a", "b", "c"
+]
+# Smallest |a| used by `fit_edwards_teng`. d = b * c / a, so the fit and its
+# Jacobian are singular at a = 0.
+ET_MIN_ABS_A = 1e-3
+
+
+def edwards_teng_to_mat(eps_1, eps_2, alpha_x, alpha_y, beta_x, beta_y, a, b, c):
+    """Return the covariance matrix from the parameterization of Edwards/Teng.
+
+    We parameterize Sigma as Sigma = V * C * Sigma_n * C^T * V^T. V is simply
+    the block-diagonal normalization matrix in terms of the 2D Twiss
+    parameters. Sigma_n = diag(eps_1, eps_1, eps_2, eps_2). C is a symplectic
+    matrix with three free parameters: a, b, c. When a = b = c = 0, we have
+    eps_x = eps_1, eps_y = eps_2 (no coupling). When they are nonzero, there
+    is coupling.
+    """
+    E = utils.diagonal_matrix([eps_1, eps_1, eps_2, eps_2])
+    V = V_matrix_uncoupled(alpha_x, alpha_y, beta_x, beta_y)
+    if a == 0:
+        if b == 0 or c == 0:
+            d = 0
+        else:
+            raise ValueError("a is zero but b * c is not zero.")
+    else:
+        d = b * c / a
+    C = Matrix([[1, 0, a, b], [0, 1, c, d], [-d, b, 1, 0], [c, -a, 0, 1]])
+    VC = V.times(C)
+    return VC.times(E.times(VC.transpose()))
+
+
+def edwards_teng_derivs(eps_1, eps_2, alpha_x, alpha_y, beta_x, beta_y, a, b, c):
+    """Return the derivatives of `edwards_teng_to_mat` with respect to each parameter.
+
+    With G = V * C, Sigma = G * E * G^T and
+    dSigma = dG * E * G^T + G * E * dG^T + G * dE * G^T,
+    where only one of dV, dC, dE is nonzero for each parameter.
+
+    Returns
+    -------
+    list[Matrix, shape (4, 4)], shape (9,)
+        dSigma / dp for each parameter p in `ET_PARAM_NAMES`.
+    """
+    E = utils.diagonal_matrix([eps_1, eps_1, eps_2, eps_2])
+    V = V_matrix_uncoupled(alpha_x, alpha_y, beta_x, beta_y)
+    # d depends on (a, b, c) through d = b * c / a.
+    if a == 0:
+        if b == 0 and c == 0:
+            d = dd_da = dd_db = dd_dc = 0.0
+        else:
+            raise ValueError("a is zero; the derivatives of d are undefined.")
+    else:
+        d = b * c / a
+        dd_da, dd_db, dd_dc = -b * c / a ** 2, c / a, b / a
+    C = Matrix([[1, 0, a, b], [0, 1, c, d], [-d, b, 1, 0], [c, -a, 0, 1]])
+    G = V.times(C)
+
+    def sparse(elements):
+        M = Matrix(4, 4, 0.0)
+        for (i, j), value in elements.items():
+            M.set(i, j, value)
+        return M
+
+    def from_dG(dG):
+        dGEGT = dG.times(E.times(G.transpose()))
+        return dGEGT.plus(dGEGT.transpose())
+
+    def from_dE(dE):
+        return G.times(dE.times(G.transpose()))
+
+    def from_dV(dV):
+        return from_dG(dV.times(C))
+
+    def from_dC(dC):
+        return from_dG(V.times(dC))
+
+    def dV_dbeta(alpha, beta, i):
+        return sparse(
+            {
+                (i, i): 0.5 / sqrt(beta),
+                (i + 1, i): 0.5 * alpha / beta ** 1.5,
+                (i + 1, i + 1): -0.5 / beta ** 1.5,
+            }
+        )
+
+    return [
+        from_dE(utils.diagonal_matrix([1.0, 1.0, 0.0, 0.0])),
+        from_dE(utils.diagonal_matrix([0.0, 0.0, 1.0, 1.0])),
+        from_dV(sparse({(1, 0): -1.0 / sqrt(beta_x)})),
+        from_dV(sparse({(3, 2): -1.0 / sqrt(beta_y)})),
+        from_dV(dV_dbeta(alpha_x, beta_x, 0)),
+        from_dV(dV_dbeta(alpha_y, beta_y, 2)),
+        from_dC(sparse({(0, 2): 1.0, (1, 3): dd_da, (2, 0): -dd_da, (3, 1): -1.0})),
+        from_dC(sparse({(0, 3): 1.0, (1, 3): dd_db, (2, 0): -dd_db, (2, 1): 1.0})),
+        from_dC(sparse({(1, 2): 1.0, (1, 3): dd_dc, (2, 0): -dd_dc, (3, 0): 1.0})),
+    ]
+
+
+def fit_edwards_teng(
+    transfer_mats,
+    moments,
+    Sigma0,
+    n_starts=1,
+    seed=0,
+    n_workers=None,
+    **lm_kws
+):
+    """Fit the moments with the Edwards-Teng parameterization of Sigma.
+
+    The 9 parameters are fit by Levenberg-Marquardt using the exact derivatives
+    from `edwards_teng_derivs`. The 2D emittances and Twiss parameters of the
+    starting point are taken from `Sigma0`.
+
+    Parameters
+    ----------
+    transfer_mats, moments : list
+        See `reconstruct`.
+    Sigma0 : Matrix, shape (4, 4)
+        Initial guess (usually the unconstrained LLSQ solution). It does not
+        need to be positive definite.
+    n_starts : int
+        Number of starting points. The first start uses small fixed coupling
+        parameters (a, b, c); the others draw them from a random number
+        generator seeded with `seed`. The best fit is returned.
+    seed : int
+        Seed for the starting coupling parameters, so that the result is
+        reproducible.
+    n_workers : int, optional
+        Number of threads used to run the starts (see `parallel.map_threads`).
+        The starts only run in parallel under Jython.
+    **lm_kws
+        Key word arguments passed to `levenberg_marquardt`.
+
+    Returns
+    -------
+    Matrix, shape (4, 4)
+        The fitted covariance matrix.
+    """
+    A = design_matrix(transfer_mats)
+    b = target_vector(moments)
+    Sigma0 = clip_eigenvalues(Sigma0)
+    eps_x, eps_y = apparent_emittances(Sigma0)
+    alpha_x, alpha_y, beta_x, beta_y = twiss2D(Sigma0)
+    rng = random.Random(seed)
+    guesses = []
+    for i in range(n_starts):
+        if i == 0:
+            coupling = [0.05, -0.05, 0.05]
+        else:
+            coupling = [rng.uniform(-0.5, 0.5) for _ in range(3)]
+        guesses.append([eps_x, eps_y, alpha_x, alpha_y, beta_x, beta_y] + coupling)
+    lb = [0.0, 0.0, None, None, 1e-6, 1e-6, None, None, None]
+    ub = len(ET_PARAM_NAMES) * [None]
+
+    def away_from_zero(x):
+        # Keep |a| >= ET_MIN_ABS_A (the trial points can have any sign of a).
+        x = list(x)
+        x[6] = math.copysign(max(abs(x[6]), ET_MIN_ABS_A), x[6])
+        return x
+
+    def fun(x):
+        Sigma = edwards_teng_to_mat(*away_from_zero(x))
+        vec = [Sigma.get(i, j) for (i, j) in VEC_INDICES]
+        return [utils.dot(row, vec) - b_i for row, b_i in zip(A, b)]
+
+    def jac(x):
+        DT = [
+            [dSigma.get(i, j) for (i, j) in VEC_INDICES]
+            for dSigma in edwards_teng_derivs(*away_from_zero(x))
+        ]
+        return [utils.matvec(DT, row) for row in A]
+
+    if n_starts > 1:
+        lm_kws["verbose"] = 0
+
+    def run(guess):
+        return levenberg_marquardt(fun, jac, guess, bounds=(lb, ub), **lm_kws)
+
+    results = parallel.map_threads(run, guesses, n_workers)
+    costs = [cost for (x, cost, itn) in results]
+    x, cost, itn = results[costs.index(min(costs))]
+    return edwards_teng_to_mat(*away_from_zero(x))
+
+
 def reconstruct(
     transfer_mats,
     moments,
     constr=True,
-    constr_method="Edwards-Teng",
+    constr_method="Cholesky",
     min_kws=None,
     **lsq_kws
 ):
@@ -283,46 +753,27 @@ def reconstruct(
     constr: bool
         Whether to try nonlinear solver if LLSQ answer is unphysical.
         (Default: True)
-    constr_method : {'Edwards-Teng', 'Cholesky'}
+    constr_method : {'Cholesky', 'Edwards-Teng'}
         The method to use to constrain the answer (if `constr` == True).
+            * 'Cholesky' : Fit Sigma = L L^T by Levenberg-Marquardt, starting
+              from the LLSQ answer (see `fit_cholesky`). Deterministic.
+            * 'Edwards-Teng' : Fit the Edwards-Teng parameters by
+              Levenberg-Marquardt (see `fit_edwards_teng`).
     min_kws : dict
-        Key word arguments passed to `minimize` method.
+        Key word arguments passed to `fit_cholesky` or `fit_edwards_teng`.
     **lsq_kws
-        Key word arguments passed to `lsq_linear` method.
+        Key word arguments passed to `lsq_linear_batch` method.
         
     Returns
     -------
     Jama Matrix, shape (4, 4)
         Reconstructed covariance matrix.
     """
-    A, b = [], []
-    for M, (sig_xx, sig_yy, sig_xy) in zip(transfer_mats, moments):
-        A.append(
-            [M[0][0]**2, M[0][1]**2, 2 * M[0][0] * M[0][1], 0, 0, 0, 0, 0, 0, 0]
-        )
-        A.append(
-            [0, 0, 0, M[2][2]**2, M[2][3]**2, 2 * M[2][2] * M[2][3], 0, 0, 0, 0]
-        )
-        A.append(
-            [
-                0,
-                0,
-                0,
-                0,
-                0,
-                0,
-                M[0][0] * M[2][2],
-                M[0][1] * M[2][2],
-                M[0][0] * M[2][3],
-                M[0][1] * M[2][3],
-            ]
-        )
-        b.append(sig_xx)
-        b.append(sig_yy)
-        b.append(sig_xy)
-
+    system = ReconstructionSystem(transfer_mats)
+    if lsq_kws.get("verbose", 0) > 0:
+        print("Condition numbers (xx, yy, xy): {} {} {}".format(*system.cond()))
     lsq_kws.setdefault("solver", "exact")
-    Sigma = to_mat(lsq_linear(A, b, **lsq_kws))
+    Sigma = to_mat(system.solve(moments, **lsq_kws))
 
     if not constr:
         return Sigma
@@ -332,131 +783,136 @@ def reconstruct(
         return Sigma
 
     print("Covariance matrix is unphysical. Running solver.")
-    A = Matrix(A)
-    b = utils.list_to_col_mat(b)
     if min_kws is None:
         min_kws = dict()
-    min_kws.setdefault("maxiters", 5000)
-    min_kws.setdefault("tol", 1e-15)
-    min_kws.setdefault("verbose", 2)
-
-    if constr_method == "Edwards-Teng":
-        # This section uses the parameterization of Edwards/Teng.
-        #
-        # We parameterize Sigma as Sigma = V * C * Sigma_n * C^T * V^T. V is simply
-        # the block-diagonal normalization matrix in terms of the 2D Twiss
-        # parameters. Sigma_n = diag(eps_1, eps_1, eps_2, eps_2). C is a symplectic
-        # matrix with three free parameters: a, b, c. When a = b = c = 0, we have
-        # eps_x = eps_1, eps_y = eps_2 (no coupling). When they are nonzero, there
-        # is coupling.
-        def get_cov(eps_1, eps_2, alpha_x, alpha_y, beta_x, beta_y, a, b, c):
-            E = utils.diagonal_matrix([eps_1, eps_1, eps_2, eps_2])
-            V = Matrix(4, 4, 0.0)
-            V.set(0, 0, sqrt(beta_x))
-            V.set(1, 0, -alpha_x / sqrt(beta_x))
-            V.set(1, 1, 1.0 / sqrt(beta_x))
-            V.set(2, 2, sqrt(beta_y))
-            V.set(3, 2, -alpha_y / sqrt(beta_y))
-            V.set(3, 3, 1.0 / sqrt(beta_y))
-            if a == 0:
-                if b == 0 or c == 0:
-                    d = 0
-                else:
-                    raise ValueError("a is zero but b * c is not zero.")
-            else:
-                d = b * c / a
-            C = Matrix([[1, 0, a, b], [0, 1, c, d], [-d, b, 1, 0], [c, -a, 0, 1]])
-            VC = V.times(C)
-            return VC.times(E.times(VC.transpose()))
-
-        class MyScorer(Scorer):
-            def __init__(self):
-                return
-
-            def score(self, trial, variables):
-                Sigma = get_cov(*get_trial_vals(trial, variables))
-                vec = to_vec(Sigma)
-                residuals = A.times(vec).minus(b)
-                return residuals.normF() ** 2
-
-        eps_x, eps_y = apparent_emittances(Sigma)
-        alpha_x, alpha_y, beta_x, beta_y = twiss2D(Sigma)
-        guess = [
-            eps_x,
-            eps_y,
-            alpha_x,
-            alpha_y,
-            beta_x,
-            beta_y,
-            0.1 * random.random(),
-            -0.1 * random.random(),
-            +0.1 * random.random(),
-        ]
-        lb = [0.0, 0.0, -INF, -INF, 0.0, 0.0, -INF, -INF, -INF]
-        ub = INF
-        bounds = (lb, ub)
-        var_names = [
-            "eps_1",
-            "eps_2",
-            "alpha_x",
-            "alpha_y",
-            "beta_x",
-            "beta_y",
-            "a",
-            "b",
-            "c",
-        ]
-        scorer = MyScorer()
-        params = minimize(scorer, guess, var_names, bounds, **min_kws)
-        Sigma = get_cov(*params)
-        return Sigma
 
-    elif constr_method == "Cholesky":
-        # This section uses inverse Cholesky factorization Sigma = L * L^T, where
-        # L is a lower triangular matrix.
-        def get_cov(x):
-            L = Matrix(
-                [
-                    [x[0], 0, 0, 0],
-                    [x[1], x[2], 0, 0],
-                    [x[3], x[4], x[5], 0],
-                    [x[6], x[7], x[8], x[9]],
-                ]
-            )
-            return L.times(L.transpose())
-
-        class MyScorer(Scorer):
-            def __init__(self):
-                return
-
-            def score(self, trial, variables):
-                Sigma = get_cov(get_trial_vals(trial, variables))
-                vec = to_vec(Sigma)
-                residuals = A.times(vec).minus(b)
-                return residuals.normF() ** 2
-
-        bounds = (-INF, INF)
-        guess = [random.random() - 0.5 for _ in range(10)]
-        var_names = ["v_{}".format(i) for i in range(10)]
-        scorer = MyScorer()
-        x = minimize(scorer, guess, var_names, bounds, **min_kws)
-        Sigma = get_cov(x)
-        return Sigma
+    if constr_method == "Cholesky":
+        min_kws.setdefault("verbose", lsq_kws.get("verbose", 0))
+        return fit_cholesky(transfer_mats, moments, Sigma, **min_kws)
+
+    elif constr_method == "Edwards-Teng":
+        min_kws.setdefault("verbose", lsq_kws.get("verbose", 0))
+        return fit_edwards_teng(transfer_mats, moments, Sigma, **min_kws)
 
     else:
-        raise ValueError("`constr_method` must be in {'Edwards/Teng', 'Cholesky'}")
+        raise ValueError("`constr_method` must be in {'Cholesky', 'Edwards-Teng'}")
 
 
-def reconstruct_random_trials(
+def propagate(Sigma, M):
+    """Return M Sigma M^T, the covariance matrix after transfer matrix M (4 x 4)."""
+    if type(M) is list:
+        M = Matrix(M)
+    return M.times(Sigma).times(M.transpose())
+
+
+def reconstruct_and_propagate(
+    measurement, tmat_table, rec_node_id, node_ids=None, **reconstruct_kws
+):
+    """Reconstruct the covariance matrix at one node and propagate it to others.
+
+    The least-squares problem is solved once, at `rec_node_id`. The covariance
+    matrix at each other node is M Sigma M^T, where M is the transfer matrix
+    from the reconstruction node to that node (upstream nodes included). The
+    unconstrained problem is linear in Sigma, so this gives the same answer as
+    solving it again at every node.
+
+    Parameters
+    ----------
+    measurement : Measurement
+        The measurement; its moments are computed if needed.
+    tmat_table : optics.TransferMatrixTable
+        Transfer matrices for the measurement's machine state. Anything with a
+        `get(start_node_id, stop_node_id)` method returning a 4 x 4 list works.
+    rec_node_id : str
+        Node at which to solve for Sigma.
+    node_ids : list[str]
+        Nodes to propagate to. Defaults to `tmat_table.node_ids`.
+    **reconstruct_kws
+        Key word arguments passed to `reconstruct`.
+
+    Returns
+    -------
+    dict
+        The covariance matrix (Jama Matrix) at each node.
+    """
+    if not measurement.moments:
+        measurement.get_moments()
+    if node_ids is None:
+        node_ids = tmat_table.node_ids
+    tmats_list, moments_list = [], []
+    for ws_id in measurement.node_ids:
+        sig_xx, sig_yy, sig_uu, sig_xy = measurement.moments[ws_id]
+        tmats_list.append(tmat_table.get(rec_node_id, ws_id))
+        moments_list.append([sig_xx, sig_yy, sig_xy])
+    Sigma = reconstruct(tmats_list, moments_list, **reconstruct_kws)
+    Sigmas = dict()
+    for node_id in node_ids:
+        if node_id == rec_node_id:
+            Sigmas[node_id] = Sigma
+        else:
+            Sigmas[node_id] = propagate(Sigma, tmat_table.get(rec_node_id, node_id))
+    return Sigmas
+
+
+def add_noise_to_moments(moments, frac_err, rng=random):
+    """Return [<xx>, <yy>, <xy>] after fractional noise is added to the moments.
+
+    Each of <xx>, <yy>, <uu> is multiplied by 1 + f, where f is drawn from
+    `rng` with -frac_err <= f <= +frac_err. `rng` can be anything with a
+    `uniform` method, such as `random.Random` or `sobol.PointSampler`.
+    """
+    noisy_moments = []
+    for sig_xx, sig_yy, sig_uu in moments:
+        sig_xx *= 1.0 + rng.uniform(-frac_err, frac_err)
+        sig_yy *= 1.0 + rng.uniform(-frac_err, frac_err)
+        sig_uu *= 1.0 + rng.uniform(-frac_err, frac_err)
+        sig_xy = get_sig_xy(sig_xx, sig_yy, sig_uu, DIAG_WIRE_ANGLE)
+        noisy_moments.append([sig_xx, sig_yy, sig_xy])
+    return noisy_moments
+
+
+def _random_trials_chunk(args):
+    """Run one chunk of random trials (see `random_trials`).
+
+    Returns a list of (moment vector, `trial_values`) for each trial. This is
+    a top-level function so that it can be sent to a process pool.
+    """
+    transfer_mats, moments, frac_err, n, chunk_seed, sobol_seed, start = args
+    if sobol_seed is None:
+        rng = random.Random(chunk_seed)
+        samplers = n * [rng]
+    else:
+        sequence = sobol.SobolSequence(3 * len(moments), seed=sobol_seed)
+        samplers = [sobol.PointSampler(point) for point in sequence.points(start, n)]
+    system = ReconstructionSystem(transfer_mats)
+    block = [add_noise_to_moments(moments, frac_err, rng) for rng in samplers]
+    return [(x, trial_values(to_mat(x))) for x in system.solve_batch(block)]
+
+
+def random_trials(
     transfer_mats,
     moments,
     frac_err=0.03,
     n_trials=1000,
     persevere=False,
     max_attempts=1000,
+    seed=None,
+    keep_sigmas=False,
+    batch_size=500,
+    n_workers=None,
+    tol=None,
+    min_trials=100,
+    sampler="random",
 ):
     """Reconstruct with errors added to the measured moments.
 
+    The trials are split into chunks of `batch_size`. Each chunk draws its
+    noise from its own random number generator, solves all its trials together
+    (see `ReconstructionSystem.solve_batch`), and can run on a separate worker.
+    The chunk seeds are derived from `seed`, and the results are added to
+    running statistics in chunk order, so the output does not depend on the
+    number of workers.
+
     Parameters
     ----------
     transfer_mats : list[list, shape (4, 4)], shape (n,)
@@ -471,46 +927,131 @@ def reconstruct_random_trials(
     persevere : bool
         If False, reconstruct `n_trials` times. If True, reconstruct until
         `n_trials` successful trials are obtained (this could take a long
-        time if the fail rate is large).
+        time if the fail rate is large). Failed trials are then not kept.
     max_attempts : int
-        Stop if the reconstruction fails `max_attempts` times in a row.
+        If `persevere`, stop if the reconstruction fails `max_attempts` times
+        in a row.
+    seed : int, optional
+        Seed for the random number generator. The same seed always gives the
+        same trials.
+    keep_sigmas : bool
+        Whether to store the covariance matrix from every trial.
+    batch_size : int
+        The number of trials in each chunk.
+    n_workers : int, optional
+        The number of chunks to run at once (see `parallel.WorkerPool`).
+        Defaults to `parallel.default_workers()`.
+    tol : float, optional
+        If provided, stop early once `TrialStats.rel_ci_width` is below `tol`
+        (the confidence intervals of all the statistics are narrow enough).
+        This is checked after each chunk, once there are at least `min_trials`
+        successful trials. `n_trials` is then the maximum number of trials.
+    min_trials : int
+        See `tol`.
+    sampler : {'random', 'sobol'}
+        How to draw the noise.
+            * 'random' : Pseudo-random numbers.
+            * 'sobol' : A randomly shifted Sobol sequence (see `sobol`). The
+              statistics usually converge with fewer trials.
 
     Returns
     -------
-    Sigmas : list[Matrix]
-        Reconstructed covariance matrix for each trial.
+    TrialStats
+        `TrialStats.n_trials` is the number of trials used. If `tol` is
+        provided, `TrialStats.converged` tells whether the tolerance was met.
     """
+    if sampler not in ["random", "sobol"]:
+        raise ValueError("`sampler` must be in {'random', 'sobol'}")
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    if n_workers is None:
+        n_workers = parallel.default_workers()
+    chunk_seeds = random.Random(seed)
+    sobol_seed = seed if sampler == "sobol" else None
+    stats = TrialStats(keep_sigmas=keep_sigmas)
+    stats.converged = False
+    batch_size = min(batch_size, n_trials)
+    n_submitted = n_fail_in_a_row = 0
+
+    def finished():
+        if stats.converged:
+            return True
+        if persevere:
+            return stats.n_success() >= n_trials or n_fail_in_a_row >= max_attempts
+        return stats.n_trials >= n_trials
+
+    with parallel.WorkerPool(n_workers, processes=True) as pool:
+        while not finished():
+            # Without `persevere`, the chunk sizes are fixed by `n_trials`. With
+            # `persevere`, we run full chunks and ignore any trials after the
+            # stopping point, so the result does not depend on `n_workers`.
+            args_list = []
+            for _ in range(max(1, n_workers)):
+                n = batch_size
+                if not persevere:
+                    n = min(batch_size, n_trials - n_submitted)
+                    if n <= 0:
+                        break
+                chunk_seed = chunk_seeds.getrandbits(32)
+                args_list.append(
+                    (
+                        transfer_mats,
+                        moments,
+                        frac_err,
+                        n,
+                        chunk_seed,
+                        sobol_seed,
+                        n_submitted,
+                    )
+                )
+                n_submitted += n
+            chunks = pool.map(_random_trials_chunk, args_list)
+            for chunk in chunks:
+                for x, values in chunk:
+                    if finished():
+                        break
+                    Sigma = to_mat(x) if keep_sigmas else None
+                    keep_invalid = not persevere
+                    valid = stats.add_values(values, Sigma, keep_invalid)
+                    n_fail_in_a_row = 0 if valid else n_fail_in_a_row + 1
+                if tol is not None and stats.n_success() >= min_trials:
+                    stats.converged = stats.rel_ci_width() < tol
+    return stats
 
-    def add_noise(value, frac_err):
-        """Add fractional noise: x -> x (1 + f)."""
-        max_err = frac_err * value
-        return value + random.uniform(-max_err, +max_err)
-
-    def run_trial(moments, transfer_mats):
-        """Return covariance matrix from LLSQ fit."""
-        noisy_moments = []
-        for i in range(len(moments)):
-            sig_xx, sig_yy, sig_uu = moments[i]
-            sig_xx = add_noise(sig_xx, frac_err)
-            sig_yy = add_noise(sig_yy, frac_err)
-            sig_uu = add_noise(sig_uu, frac_err)
-            sig_xy = get_sig_xy(sig_xx, sig_yy, sig_uu, DIAG_WIRE_ANGLE)
-            noisy_moments.append([sig_xx, sig_yy, sig_xy])
-        Sigma = reconstruct(transfer_mats, noisy_moments, constr=False)
-        return Sigma
 
-    if persevere:
-        Sigmas = []
-        for _ in range(n_trials):
-            Sigma, failed, n_attempts = None, True, 0
-            while failed and n_attempts < max_attempts:
-                Sigma = run_trial(moments, transfer_mats)
-                failed = not is_valid_covariance_matrix(Sigma)
-                n_attempts += 1
-            Sigmas.append(Sigma)
-    else:
-        Sigmas = [run_trial(moments, transfer_mats) for _ in range(n_trials)]
-    return Sigmas
+def reconstruct_random_trials(
+    transfer_mats,
+    moments,
+    frac_err=0.03,
+    n_trials=1000,
+    persevere=False,
+    max_attempts=1000,
+    seed=None,
+    **kws
+):
+    """Reconstruct with errors added to the measured moments.
+
+    Same as `random_trials`, but returns the list of covariance matrices.
+    Additional key word arguments (such as `n_workers`, `tol`, `sampler`) are
+    passed to `random_trials`.
+
+    Returns
+    -------
+    Sigmas : list[Matrix]
+        Reconstructed covariance matrix for each trial.
+    """
+    stats = random_trials(
+        transfer_mats,
+        moments,
+        frac_err=frac_err,
+        n_trials=n_trials,
+        persevere=persevere,
+        max_attempts=max_attempts,
+        seed=seed,
+        keep_sigmas=True,
+        **kws
+    )
+    return stats.Sigmas
 
 
 # PTA file processing
@@ -624,6 +1165,9 @@ class Measurement(dict):
     transfer_mats : dict
         The linear 4x4 transfer matrix from a start node to each wire-scanner. 
         The start node is determined in the function call `get_transfer_mats`.
+    optics : list[float]
+        Kinetic energy and quad fields of the measurement (see
+        `TransferMatrixGenerator.optics`), set by `get_optics`.
     """
 
     def __init__(self, filename):
@@ -634,6 +1178,7 @@ class Measurement(dict):
         self.pvloggerid = None
         self.node_ids = None
         self.moments, self.transfer_mats = dict(), dict()
+        self.optics = None
         self.read_pta_file()
 
     def read_pta_file(self):
@@ -733,13 +1278,32 @@ class Measurement(dict):
             self.moments[node_id] = [sig_xx, sig_yy, sig_uu, sig_xy]
         return self.moments
 
-    def get_transfer_mats(self, start_node_id, tmat_generator):
-        """Store/return dictionary of transfer matrices from start_node to each profile."""
+    def get_optics(self, tmat_generator):
+        """Store/return the optics (kinetic energy and quad fields)."""
+        self.optics = tmat_generator.optics(self.pvloggerid)
+        return self.optics
+
+    def get_transfer_mats(self, start_node_id, tmat_generator, cache=None):
+        """Store/return dictionary of transfer matrices from start_node to each profile.
+
+        If `cache` (a list) is given, measurements with the same optics (see
+        `same_optics`) share one dictionary of transfer matrices, which is only
+        computed for the first of them.
+        """
+        self.get_optics(tmat_generator)
+        key = (start_node_id, tuple(self.node_ids))
+        if cache is not None:
+            for optics, cached_key, transfer_mats in cache:
+                if cached_key == key and same_optics(optics, self.optics):
+                    self.transfer_mats = transfer_mats
+                    return self.transfer_mats
         self.transfer_mats = dict()
         tmat_generator.sync(self.pvloggerid)
         for node_id in self.node_ids:
             tmat = tmat_generator.generate(start_node_id, node_id)
             self.transfer_mats[node_id] = tmat
+        if cache is not None:
+            cache.append((self.optics, key, self.transfer_mats))
         return self.transfer_mats
 
     def export_files(self):
@@ -775,7 +1339,7 @@ def process(filenames):
     measurements = [
         measurement
         for measurement in measurements
-        if measurement.pvloggerid > 0 and measurement.pvloggerid is not None
+        if measurement.pvloggerid is not None and measurement.pvloggerid > 0
     ]
     return measurements
 
@@ -790,12 +1354,55 @@ class DictOfLists(dict):
         self[key].append(value)
 
 
+# Tolerances used to decide if two measurements were taken with the same optics.
+# Readback noise on the quad fields is well below the relative tolerance, and the
+# quad steps of a phase scan are well above it.
+OPTICS_RTOL = 1e-3
+OPTICS_ATOL = 1e-4  # [T/m]
+
+
+def same_optics(optics1, optics2, rtol=OPTICS_RTOL, atol=OPTICS_ATOL):
+    """Return True if two optics vectors agree to within the tolerance.
+
+    The vectors hold the kinetic energy and the quad fields (see
+    `TransferMatrixGenerator.optics`). Each pair of values must satisfy
+    |a - b| <= atol + rtol * max(|a|, |b|). The absolute tolerance [T/m]
+    keeps quads that are nearly off from splitting a group.
+    """
+    if len(optics1) != len(optics2):
+        return False
+    for a, b in zip(optics1, optics2):
+        if abs(a - b) > atol + rtol * max(abs(a), abs(b)):
+            return False
+    return True
+
+
+def cluster_optics(optics_list, rtol=OPTICS_RTOL, atol=OPTICS_ATOL):
+    """Return the group index of each optics vector.
+
+    Each vector joins the first group whose first member has the same optics
+    (see `same_optics`), or else starts a new group. Groups are numbered in
+    order of appearance.
+    """
+    leaders, groups = [], []
+    for optics in optics_list:
+        for group, leader in enumerate(leaders):
+            if same_optics(optics, leader, rtol, atol):
+                break
+        else:
+            group = len(leaders)
+            leaders.append(optics)
+        groups.append(group)
+    return groups
+
+
 def get_scan_info(measurements, tmat_generator, start_node_id):
     """Make dictionaries of measured moments and transfer matrices at each wire-scanner."""
     print("Reading files...")
     if type(measurements) is not list:
         measurements = [measurements]
     moments_dict, tmats_dict = DictOfLists(), DictOfLists()
+    tmats_cache = []
     for measurement in measurements:
         print(
             "  Reading file '{}'  pvloggerid = {}".format(
@@ -803,7 +1410,7 @@ def get_scan_info(measurements, tmat_generator, start_node_id):
             )
         )
         measurement.get_moments()
-        measurement.get_transfer_mats(start_node_id, tmat_generator)
+        measurement.get_transfer_mats(start_node_id, tmat_generator, tmats_cache)
         for node_id in measurement.node_ids:
             moments_dict.add(node_id, measurement.moments[node_id])
             tmats_dict.add(node_id, measurement.transfer_mats[node_id])
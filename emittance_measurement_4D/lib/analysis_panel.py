@@ -51,18 +51,17 @@ from xal.model.probe.traj import Trajectory
 from xal.sim.scenario import AlgorithmFactory
 from xal.sim.scenario import ProbeFactory
 from xal.sim.scenario import Scenario
-from xal.service.pvlogger.sim import PVLoggerDataSource
 from xal.smf import Accelerator
 from xal.smf import AcceleratorSeq
-from xal.smf.data import XMLDataManager
 from xal.tools.beam import Twiss
 from xal.tools.beam.calc import CalculationsOnBeams
-from xal.tools.beam.calc import CalculationsOnRings
 
 # Local
+import accelerator_registry
 import analysis
 from optics import TransferMatrixGenerator
 import optics
+import parallel
 import plotting as plt
 import utils
 import xal_helpers
@@ -73,8 +72,8 @@ class AnalysisPanel(JPanel):
         JPanel.__init__(self)
         self.setLayout(BorderLayout())
         self.reconstruction_node_id = "RTBT_Diag:BPM17"
-        self.accelerator = XMLDataManager.loadDefaultAccelerator()
-        self.sequence = self.accelerator.getComboSequence("RTBT")
+        self.accelerator = accelerator_registry.get_accelerator()
+        self.sequence = accelerator_registry.get_sequence("RTBT")
         self.kinetic_energy = 1e9  # [eV]
         self.tmat_generator = TransferMatrixGenerator(
             self.sequence, self.kinetic_energy
@@ -152,6 +151,8 @@ class AnalysisPanel(JPanel):
         self.group_label = JLabel('Group')
         self.group_dropdown = JComboBox(['0'])
         self.group_dropdown.addActionListener(GroupDropdownListener(self))
+        self.group_by_optics_button = JButton("Group by optics")
+        self.group_by_optics_button.addActionListener(GroupByOpticsButtonListener(self))
         self.reconstruct_covariance_button = JButton("Reconstruct covariance matrix")
         self.reconstruct_covariance_button.addActionListener(
             ReconstructCovarianceButtonListener(self)
@@ -171,6 +172,10 @@ class AnalysisPanel(JPanel):
         self.norm_dropdown.addActionListener(NormDropdownListener(self))
         self.keep_physical_checkbox = JCheckBox("Keep answer physical", False)
         self.persevere_checkbox = JCheckBox('Persevere', True)
+        self.adaptive_checkbox = JCheckBox('Adaptive', False)
+        self.tol_text_field = JTextField('0.05')
+        self.sobol_checkbox = JCheckBox('Sobol', False)
+        self.n_workers_text_field = JTextField(str(parallel.default_workers()))
 
         bottom_left_panel = JPanel()
         bottom_left_panel.setLayout(BoxLayout(bottom_left_panel, BoxLayout.Y_AXIS))
@@ -197,11 +202,21 @@ class AnalysisPanel(JPanel):
         row.add(self.n_trials_text_field)
         row.add(self.persevere_checkbox)
         bottom_left_top_panel.add(row)
+        row = JPanel()
+        row.setLayout(FlowLayout(FlowLayout.LEFT))
+        row.add(self.adaptive_checkbox)
+        row.add(JLabel('Tol.'))
+        row.add(self.tol_text_field)
+        row.add(self.sobol_checkbox)
+        row.add(JLabel('Workers'))
+        row.add(self.n_workers_text_field)
+        bottom_left_top_panel.add(row)
 
         row = JPanel()
         row.setLayout(FlowLayout(FlowLayout.LEFT))
         row.add(self.group_label)
         row.add(self.group_dropdown)
+        row.add(self.group_by_optics_button)
         bottom_left_top_panel.add(row)
         bottom_left_panel.add(bottom_left_top_panel)
 
@@ -305,6 +320,27 @@ class AnalysisPanel(JPanel):
         for i in range(n_meas):
             self.group_dropdown.addItem(str(i))
 
+    def group_by_optics(self):
+        """Put measurements with the same optics in the same group.
+
+        The optics are read from the stored PVLogger snapshots, so this works
+        whether or not the transfer matrices have been computed. Measurements
+        are compared with the tolerance of `analysis.same_optics`.
+        """
+        optics_list = [
+            measurement.get_optics(self.tmat_generator)
+            for measurement in self.measurements
+        ]
+        groups = analysis.cluster_optics(optics_list)
+        model = self.group_meas_table.getModel()
+        for row, group in enumerate(groups):
+            model.setValueAt("Group {}".format(group), row, 1)
+        self.groups = max(groups) + 1
+        self.group_dropdown.removeAllItems()
+        for group in range(self.groups):
+            self.group_dropdown.addItem(str(group))
+        print("There are now {} groups".format(self.groups))
+
     def update_plots(self):
         measurements = self.measurements
         tmats_dict = self.tmats_dict
@@ -575,52 +611,25 @@ class AnalysisPanel(JPanel):
         if not self.measurements:
             return
 
-        phases_dict = dict()
-
+        # Track each distinct machine state once.
+        node_ids = []
         for measurement in self.measurements:
-            pvl_data_source = PVLoggerDataSource(measurement.pvloggerid)
-
-            # Get the model optics at the RTBT entrance in the Ring.
-            sequence = self.accelerator.getComboSequence("Ring")
-            scenario = Scenario.newScenarioFor(sequence)
-            scenario = pvl_data_source.setModelSource(sequence, scenario)
-            scenario.resync()
-            tracker = AlgorithmFactory.createTransferMapTracker(sequence)
-            probe = ProbeFactory.getTransferMapProbe(sequence, tracker)
-            probe.setKineticEnergy(self.kinetic_energy)
-            scenario.setProbe(probe)
-            scenario.run()
-            trajectory = probe.getTrajectory()
-            calculator = CalculationsOnRings(trajectory)
-            state = trajectory.stateForElement("Begin_Of_Ring3")
-            twiss_x, twiss_y, twiss_z = calculator.computeMatchedTwissAt(state)
-
-            # Track envelope probe through RTBT.
-            sequence = self.accelerator.getComboSequence("RTBT")
-            scenario = Scenario.newScenarioFor(sequence)
-            scenario = pvl_data_source.setModelSource(sequence, scenario)
-            scenario.resync()
-            tracker = AlgorithmFactory.createEnvelopeTracker(sequence)
-            tracker.setUseSpacecharge(False)
-            probe = ProbeFactory.getEnvelopeProbe(sequence, tracker)
-            probe.setBeamCurrent(0.0)
-            probe.setKineticEnergy(self.kinetic_energy)
-            eps_x = eps_y = 20e-5  # [mm mrad] (arbitrary)
-            twiss_x = Twiss(twiss_x.getAlpha(), twiss_x.getBeta(), eps_x)
-            twiss_y = Twiss(twiss_y.getAlpha(), twiss_y.getBeta(), eps_y)
-            twiss_z = Twiss(0, 1, 0)
-            probe.initFromTwiss([twiss_x, twiss_y, twiss_z])
-            scenario.setProbe(probe)
-            scenario.run()
-            trajectory = probe.getTrajectory()
-            calculator = CalculationsOnBeams(trajectory)
+            for ws_id in measurement.node_ids:
+                if ws_id not in node_ids:
+                    node_ids.append(ws_id)
+        phases_by_state = optics.compute_model_phases(
+            node_ids,
+            self.kinetic_energy,
+            [measurement.pvloggerid for measurement in self.measurements],
+        )
 
+        phases_dict = dict()
+        for measurement in self.measurements:
+            phases = phases_by_state[measurement.pvloggerid]
             for ws_id in measurement.node_ids:
-                state = trajectory.stateForElement(ws_id)
-                mu_x, mu_y, _ = calculator.computeBetatronPhase(state).toArray()
                 if ws_id not in phases_dict:
                     phases_dict[ws_id] = []
-                phases_dict[ws_id].append([mu_x, mu_y])
+                phases_dict[ws_id].append(phases[node_ids.index(ws_id)])
         return phases_dict
 
 
@@ -939,6 +948,16 @@ class GroupDropdownListener(ActionListener):
         self.panel.update_plots()
 
 
+class GroupByOpticsButtonListener(ActionListener):
+    def __init__(self, panel):
+        self.panel = panel
+
+    def actionPerformed(self, event):
+        if not self.panel.measurements:
+            return
+        self.panel.group_by_optics()
+
+
 class ReconstructCovarianceButtonListener(ActionListener):
     def __init__(self, panel):
         self.panel = panel
@@ -978,20 +997,34 @@ class ReconstructCovarianceButtonListener(ActionListener):
                     moments_list_uu.append([sig_xx, sig_yy, sig_uu])
             # Reconstruct using measured moments.
             Sigma = analysis.reconstruct(tmats_list, moments_list_xy, constr=constr, verbose=2)
-            # Reconstruct with noise.
-            Sigmas = analysis.reconstruct_random_trials(
+            # Reconstruct with noise. In adaptive mode, the number of trials is
+            # the maximum number of trials.
+            tol = None
+            if self.panel.adaptive_checkbox.isSelected():
+                tol = float(self.panel.tol_text_field.getText())
+            sampler = 'random'
+            if self.panel.sobol_checkbox.isSelected():
+                sampler = 'sobol'
+            trial_stats = analysis.random_trials(
                 tmats_list,
                 moments_list_uu,
                 frac_err=float(self.panel.frac_noise_text_field.getText()),
                 n_trials=int(self.panel.n_trials_text_field.getText()),
-                persevere=bool(self.panel.persevere_checkbox.isSelected())
+                persevere=bool(self.panel.persevere_checkbox.isSelected()),
+                batch_size=100,
+                n_workers=int(self.panel.n_workers_text_field.getText()),
+                tol=tol,
+                sampler=sampler,
             )
             # Save statistics.
-            stats = analysis.BeamStats(Sigma, Sigmas)
+            stats = analysis.BeamStats(Sigma, trial_stats=trial_stats)
             self.panel.beam_stats.append(stats)
             # Display results.
             stats.print_all()
             print("Random trials:")
+            print("    n_trials =", trial_stats.n_trials)
+            if tol is not None:
+                print("    converged =", trial_stats.converged)
             print(
                 "    means =",
                 stats.ran_eps_x_mean,
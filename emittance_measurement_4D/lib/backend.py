@@ -0,0 +1,221 @@
+"""Matrix backend for the analysis layer.
+
+The backend is chosen once, at import time. Under Jython we use JAMA. Under
+CPython (where JAMA is not available) we use NumPy; `Matrix` is then a thin
+wrapper around a 2D array that implements the part of the JAMA API used by
+`analysis`, `least_squares` and `utils`. This lets the same reconstruction
+code run inside OpenXAL and offline on the saved data.
+
+Under CPython, add the `lib` folder to `sys.path` and import the modules
+directly (for example, `import analysis`). The script `check_backend_parity.py`
+checks that both backends give the same reconstruction.
+
+`MatrixError` is the exception raised by `solve` for a singular or rank
+deficient matrix: `java.lang.RuntimeException` under JAMA (which Python's
+`RuntimeError` does not catch) and `RuntimeError` under NumPy.
+"""
+try:
+    from Jama import LUDecomposition
+    from Jama import Matrix
+    from Jama import QRDecomposition
+    from java.lang import RuntimeException as MatrixError
+
+    NAME = "jama"
+except ImportError:
+    import numpy as np
+
+    MatrixError = RuntimeError
+    NAME = "numpy"
+
+
+if NAME == "numpy":
+
+    def _to_array(M):
+        """Return the array stored in Matrix `M` (or `M` as an array)."""
+        if hasattr(M, "array"):
+            return M.array
+        return np.asarray(M, dtype=float)
+
+    class EigenvalueDecomposition:
+        """Eigenvalues and eigenvectors of a real square matrix."""
+
+        def __init__(self, M):
+            array = _to_array(M)
+            if np.allclose(array, array.T):
+                eigvals, eigvecs = np.linalg.eigh(array)
+            else:
+                eigvals, eigvecs = np.linalg.eig(array)
+            self.eigvals = eigvals
+            self.eigvecs = eigvecs
+
+        def getRealEigenvalues(self):
+            return list(np.real(self.eigvals))
+
+        def getImagEigenvalues(self):
+            return list(np.imag(self.eigvals))
+
+        def getV(self):
+            return Matrix(np.real(self.eigvecs))
+
+        def getD(self):
+            return Matrix(np.diag(np.real(self.eigvals)))
+
+    class Matrix:
+        """NumPy implementation of the JAMA Matrix API used in this package.
+
+        The constructor accepts the same arguments as JAMA: a nested list (or
+        array) of shape (m, n), or the dimensions (m, n) and an optional fill
+        value. The underlying array is available as `Matrix.array` for
+        vectorized code.
+        """
+
+        def __init__(self, *args):
+            if len(args) == 1:
+                array = np.array(_to_array(args[0]), dtype=float)
+                if array.ndim == 1:
+                    array = array.reshape(1, -1)
+            elif len(args) == 2:
+                array = np.zeros((args[0], args[1]))
+            elif len(args) == 3:
+                array = np.full((args[0], args[1]), float(args[2]))
+            else:
+                raise TypeError("Matrix takes 1, 2 or 3 arguments.")
+            self.array = array
+
+        def __repr__(self):
+            return "Matrix({})".format(self.array.tolist())
+
+        def get(self, i, j):
+            return float(self.array[i, j])
+
+        def set(self, i, j, value):
+            self.array[i, j] = value
+
+        def getRowDimension(self):
+            return self.array.shape[0]
+
+        def getColumnDimension(self):
+            return self.array.shape[1]
+
+        def getArray(self):
+            return self.array.tolist()
+
+        def getArrayCopy(self):
+            return self.array.tolist()
+
+        def getMatrix(self, *args):
+            """Return a submatrix.
+
+            Call signatures (indices are inclusive, as in JAMA):
+                getMatrix(i0, i1, j0, j1)
+                getMatrix(rows, cols)
+                getMatrix(i0, i1, cols)
+                getMatrix(rows, j0, j1)
+            """
+            if len(args) == 4:
+                i0, i1, j0, j1 = args
+                rows, cols = list(range(i0, i1 + 1)), list(range(j0, j1 + 1))
+            elif len(args) == 2:
+                rows, cols = args
+            elif type(args[0]) is list:
+                rows, cols = args[0], list(range(args[1], args[2] + 1))
+            else:
+                rows, cols = list(range(args[0], args[1] + 1)), args[2]
+            return Matrix(self.array[np.ix_(list(rows), list(cols))])
+
+        def copy(self):
+            return Matrix(self.array.copy())
+
+        def transpose(self):
+            return Matrix(self.array.T)
+
+        def uminus(self):
+            return Matrix(-self.array)
+
+        def plus(self, other):
+            return Matrix(self.array + _to_array(other))
+
+        def minus(self, other):
+            return Matrix(self.array - _to_array(other))
+
+        def times(self, other):
+            if hasattr(other, "array"):
+                return Matrix(np.dot(self.array, other.array))
+            return Matrix(self.array * other)
+
+        def trace(self):
+            return float(np.trace(self.array))
+
+        def det(self):
+            return float(np.linalg.det(self.array))
+
+        def rank(self):
+            return int(np.linalg.matrix_rank(self.array))
+
+        def cond(self):
+            return float(np.linalg.cond(self.array))
+
+        def normF(self):
+            return float(np.linalg.norm(self.array))
+
+        def inverse(self):
+            return self.solve(Matrix(np.identity(self.getRowDimension())))
+
+        def solve(self, B):
+            if self.getRowDimension() == self.getColumnDimension():
+                return LUDecomposition(self).solve(B)
+            return QRDecomposition(self).solve(B)
+
+        def eig(self):
+            return EigenvalueDecomposition(self)
+
+        def chol(self):
+            return CholeskyDecomposition(self)
+
+    class CholeskyDecomposition:
+        """Cholesky factorization A = L L^T of a symmetric positive definite matrix."""
+
+        def __init__(self, A):
+            array = _to_array(A)
+            try:
+                self.L = np.linalg.cholesky(array)
+                self.spd = True
+            except np.linalg.LinAlgError:
+                self.L = np.zeros(array.shape)
+                self.spd = False
+
+        def isSPD(self):
+            return self.spd
+
+        def getL(self):
+            return Matrix(self.L)
+
+    class LUDecomposition:
+        """Solve square systems (the factorization is done by LAPACK)."""
+
+        def __init__(self, A):
+            self.array = _to_array(A)
+
+        def isNonsingular(self):
+            return np.linalg.matrix_rank(self.array) == self.array.shape[0]
+
+        def solve(self, B):
+            try:
+                return Matrix(np.linalg.solve(self.array, _to_array(B)))
+            except np.linalg.LinAlgError:
+                raise RuntimeError("Matrix is singular.")
+
+    class QRDecomposition:
+        """QR factorization for least-squares solutions of m >= n systems."""
+
+        def __init__(self, A):
+            self.Q, self.R = np.linalg.qr(_to_array(A))
+
+        def isFullRank(self):
+            diag = np.abs(np.diag(self.R))
+            return bool(np.all(diag > diag.max() * 1e-14))
+
+        def solve(self, B):
+            if not self.isFullRank():
+                raise RuntimeError("Matrix is rank deficient.")
+            return Matrix(np.linalg.solve(self.R, np.dot(self.Q.T, _to_array(B))))
@@ -0,0 +1,218 @@
+"""Quad field readbacks and book values kept up to date by CA monitors.
+
+A synchronous Channel Access get costs a network round trip. `FieldCache`
+monitors the field readback and `B_Book` channel of each quad and serves reads
+from memory, together with the time each value arrived. Values that have not
+arrived yet (or are older than a requested age) are read directly. Channels
+that did not connect when the cache was made are not monitored; callers read
+them directly (see `covers`).
+
+`FakeChannelFactory` makes in-memory channels with the same methods, so the
+cache can be run without a machine.
+"""
+import threading
+import time
+
+from ramp import settled
+
+try:
+    from xal.ca import IEventSinkValTime
+    from xal.ca import Monitor
+    from xal.smf.impl import Electromagnet
+    from xal.smf.impl import MagnetMainSupply
+
+    XAL = True
+    _Sink = IEventSinkValTime
+    VALUE_MASK = Monitor.VALUE
+except ImportError:
+    XAL = False
+    _Sink = object
+    VALUE_MASK = 1
+
+
+class _FieldSink(_Sink):
+    """Forward monitor events for one channel to the cache."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def eventValue(self, record, channel):
+        self.cache._receive(self.key, record.doubleValue())
+
+
+class FieldCache:
+    """Monitored quad fields [T/m], keyed by (quad_id, opt).
+
+    Parameters
+    ----------
+    channels : dict
+        Channel for each (quad_id, opt), opt in {'live', 'book'}. 'live' is the
+        field readback channel.
+    to_field : dict
+        Conversion from channel value to field for each quad id. Identity if
+        a quad is missing.
+    clock : callable
+        Returns the current time [seconds].
+    """
+
+    def __init__(self, channels, to_field=None, clock=time.time):
+        self.channels = channels
+        self.to_field = to_field or dict()
+        self.clock = clock
+        self.values = dict()
+        self.times = dict()
+        self.monitors = []
+        self.condition = threading.Condition()
+        for key, channel in channels.items():
+            monitor = channel.addMonitorValTime(_FieldSink(self, key), VALUE_MASK)
+            self.monitors.append(monitor)
+
+    @classmethod
+    def for_controller(cls, controller):
+        """Monitor every quad of a PhaseController."""
+        channels, to_field = dict(), dict()
+        for quad_id, quad_node, ps_node in zip(
+            controller.quad_ids, controller.quad_nodes, controller.ps_nodes
+        ):
+            live_channel = quad_node.findChannel(Electromagnet.FIELD_RB_HANDLE)
+            book_channel = ps_node.findChannel(MagnetMainSupply.FIELD_BOOK_HANDLE)
+            for opt, channel in [("live", live_channel), ("book", book_channel)]:
+                # Channels that do not connect are left out (see `covers`).
+                if channel.connectAndWait():
+                    channels[(quad_id, opt)] = channel
+            to_field[quad_id] = quad_node.toFieldFromCA
+        return cls(channels, to_field)
+
+    def _convert(self, quad_id, value):
+        to_field = self.to_field.get(quad_id)
+        if to_field is None:
+            return value
+        return to_field(value)
+
+    def _receive(self, key, value):
+        with self.condition:
+            self.values[key] = self._convert(key[0], value)
+            self.times[key] = self.clock()
+            self.condition.notifyAll()
+
+    def update(self, quad_id, opt, field):
+        """Store a value known without a monitor event (e.g. one just put)."""
+        with self.condition:
+            self.values[(quad_id, opt)] = field
+            self.times[(quad_id, opt)] = self.clock()
+            self.condition.notifyAll()
+
+    def covers(self, quad_ids, opt="live"):
+        """Return True if the channels of all the quads are monitored."""
+        for quad_id in quad_ids:
+            if (quad_id, opt) not in self.channels:
+                return False
+        return True
+
+    def age(self, quad_id, opt="live"):
+        """Return the time since the value arrived [seconds], or None."""
+        received = self.times.get((quad_id, opt))
+        if received is None:
+            return None
+        return self.clock() - received
+
+    def get_with_time(self, quad_id, opt="live", max_age=None):
+        """Return (field, arrival time).
+
+        The channel is read directly if no value has arrived or the value is
+        older than `max_age` [seconds].
+        """
+        key = (quad_id, opt)
+        age = self.age(quad_id, opt)
+        if age is None or (max_age is not None and age > max_age):
+            self._receive(key, self.channels[key].getValDbl())
+        with self.condition:
+            return self.values[key], self.times[key]
+
+    def get(self, quad_id, opt="live", max_age=None):
+        """Return the field [T/m]; see `get_with_time`."""
+        return self.get_with_time(quad_id, opt, max_age)[0]
+
+    def wait_until(self, quad_ids, fields, opt="live", tol=0.002, timeout=1.0):
+        """Block until the fields are within a fraction `tol` of `fields`.
+
+        Returns True if they are, or False if `timeout` [seconds] expired first.
+        """
+        deadline = self.clock() + timeout
+        with self.condition:
+            while True:
+                current = [self.values.get((quad_id, opt)) for quad_id in quad_ids]
+                if None not in current and settled(current, fields, tol):
+                    return True
+                remaining = deadline - self.clock()
+                if remaining <= 0.0:
+                    return False
+                self.condition.wait(remaining)
+
+    def close(self):
+        """Stop the monitors."""
+        for monitor in self.monitors:
+            monitor.clear()
+        self.monitors = []
+
+
+class FakeRecord:
+    def __init__(self, value):
+        self.value = value
+
+    def doubleValue(self):
+        return self.value
+
+
+class FakeMonitor:
+    def __init__(self, channel, listener):
+        self.channel = channel
+        self.listener = listener
+
+    def clear(self):
+        self.channel.monitors.remove(self)
+
+
+class FakeChannel:
+    """In-memory channel; a put notifies the monitors."""
+
+    def __init__(self, name, value=0.0):
+        self.name = name
+        self.value = value
+        self.monitors = []
+        self.n_gets = 0
+
+    def channelName(self):
+        return self.name
+
+    def connectAndWait(self):
+        return True
+
+    def getValDbl(self):
+        self.n_gets += 1
+        return self.value
+
+    def putVal(self, value):
+        self.value = value
+        for monitor in list(self.monitors):
+            monitor.listener.eventValue(FakeRecord(value), self)
+
+    def addMonitorValTime(self, listener, mask):
+        monitor = FakeMonitor(self, listener)
+        self.monitors.append(monitor)
+        listener.eventValue(FakeRecord(self.value), self)
+        return monitor
+
+
+class FakeChannelFactory:
+    """Make and keep `FakeChannel`s by name."""
+
+    def __init__(self):
+        self.channels = dict()
+
+    def getChannel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = FakeChannel(name)
+        return channel
@@ -0,0 +1,549 @@
+"""Linear optics of a MAD-X lattice in pure Python.
+
+The lattice is read from the MAD-X files written by
+`generate_madx/generate_madx.py` (element definitions followed by a
+SEQUENCE with REFER=CENTER). Each element is represented by its thick 4 x 4
+transfer matrix (x, x', y, y'); dispersion, closed orbit and nonlinear terms
+are ignored. Sextupoles and kickers are drifts.
+
+`LinearOptics` implements the optics part of the `PhaseController` API
+(`transfer_matrix`, `twiss`, `phases`, `beta_funcs`, `max_betas`,
+`get_field`, `set_field`), so optimizers can evaluate quadrupole settings
+without the JVM. Node ids such as 'RTBT_Mag:QH02' or 'RTBT:Tgt' are mapped to
+the MAD-X names ('QH02', 'RTBT_Tgt'). As in OpenXAL, the optics at a node are
+the optics at the node entrance.
+
+The element maps are also kept in a `MapTree` (a balanced product tree).
+After `set_field`, the optics at any node are computed from the tree, so
+changing a few quadrupoles costs O(log N) matrix products instead of a full
+`track`.
+"""
+from __future__ import print_function
+import math
+import os
+
+
+RTBT_MADX_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "generate_madx", "rtbt.madx"
+)
+SPEED_OF_LIGHT = 0.299792458  # [m/ns], so that brho [T*m] = pc [GeV] / c
+PROTON_MASS = 0.938272  # [GeV]
+
+
+# 4 x 4 matrices
+# -------------------------------------------------------------------------------
+def identity():
+    return [[float(i == j) for j in range(4)] for i in range(4)]
+
+
+def matmul(A, B):
+    """Return A * B for 4 x 4 matrices (lists)."""
+    B0, B1, B2, B3 = B
+    C = []
+    for a0, a1, a2, a3 in A:
+        C.append([a0 * B0[j] + a1 * B1[j] + a2 * B2[j] + a3 * B3[j] for j in range(4)])
+    return C
+
+
+def symplectic_inverse(M):
+    """Return the inverse of a symplectic 4 x 4 matrix: -J M^T J."""
+    return [
+        [M[1][1], -M[0][1], M[3][1], -M[2][1]],
+        [-M[1][0], M[0][0], -M[3][0], M[2][0]],
+        [M[1][3], -M[0][3], M[3][3], -M[2][3]],
+        [-M[1][2], M[0][2], -M[3][2], M[2][2]],
+    ]
+
+
+def _focus_block(length, k):
+    """Return the 2 x 2 matrix of a focusing strength k [1/m^2] over length."""
+    if k > 0.0:
+        sqrt_k = math.sqrt(k)
+        phi = sqrt_k * length
+        return [
+            [math.cos(phi), math.sin(phi) / sqrt_k],
+            [-sqrt_k * math.sin(phi), math.cos(phi)],
+        ]
+    elif k < 0.0:
+        sqrt_k = math.sqrt(-k)
+        phi = sqrt_k * length
+        return [
+            [math.cosh(phi), math.sinh(phi) / sqrt_k],
+            [sqrt_k * math.sinh(phi), math.cosh(phi)],
+        ]
+    return [[1.0, length], [0.0, 1.0]]
+
+
+def _block_diag(Mx, My):
+    return [
+        [Mx[0][0], Mx[0][1], 0.0, 0.0],
+        [Mx[1][0], Mx[1][1], 0.0, 0.0],
+        [0.0, 0.0, My[0][0], My[0][1]],
+        [0.0, 0.0, My[1][0], My[1][1]],
+    ]
+
+
+def drift_matrix(length):
+    return _block_diag(_focus_block(length, 0.0), _focus_block(length, 0.0))
+
+
+def quad_matrix(length, k1):
+    """Thick quadrupole (k1 > 0 focuses in x)."""
+    return _block_diag(_focus_block(length, k1), _focus_block(length, -k1))
+
+
+def edge_matrix(h, e):
+    """Thin pole-face rotation (no fringe field) of a bend with curvature h."""
+    t = h * math.tan(e)
+    return _block_diag([[1.0, 0.0], [t, 1.0]], [[1.0, 0.0], [-t, 1.0]])
+
+
+def sbend_matrix(length, angle, k1=0.0, e1=0.0, e2=0.0):
+    """Sector bend with optional gradient and pole-face rotations."""
+    h = angle / length
+    body = _block_diag(_focus_block(length, h * h + k1), _focus_block(length, -k1))
+    M = matmul(body, edge_matrix(h, e1))
+    return matmul(edge_matrix(h, e2), M)
+
+
+def rotation_matrix(angle):
+    """Rotate the x-y coordinates by `angle` [rad]."""
+    c, s = math.cos(angle), math.sin(angle)
+    return [[c, 0.0, s, 0.0], [0.0, c, 0.0, s], [-s, 0.0, c, 0.0], [0.0, -s, 0.0, c]]
+
+
+def tilt(M, angle):
+    """Return the matrix of element M rotated by `angle` about the beam axis."""
+    if angle == 0.0:
+        return M
+    return matmul(rotation_matrix(-angle), matmul(M, rotation_matrix(angle)))
+
+
+def twiss_from_map(M, init_twiss):
+    """Return [mu_x, mu_y, alpha_x, alpha_y, beta_x, beta_y] after map M.
+
+    `init_twiss` is a dict with keys 'alpha_x', 'alpha_y', 'beta_x', 'beta_y'
+    (the Twiss parameters before M). The phase advances are mod 2pi. The map
+    is assumed to be uncoupled.
+    """
+    params = []
+    for k, plane in [(0, "x"), (2, "y")]:
+        alpha0 = init_twiss["alpha_" + plane]
+        beta0 = init_twiss["beta_" + plane]
+        c = M[k][k] * beta0 - M[k][k + 1] * alpha0
+        d = M[k + 1][k] * beta0 - M[k + 1][k + 1] * alpha0
+        beta = (c ** 2 + M[k][k + 1] ** 2) / beta0
+        alpha = -(c * d + M[k][k + 1] * M[k + 1][k + 1]) / beta0
+        mu = math.atan2(M[k][k + 1], c) % (2.0 * math.pi)
+        params.append((mu, alpha, beta))
+    (mu_x, alpha_x, beta_x), (mu_y, alpha_y, beta_y) = params
+    return [mu_x, mu_y, alpha_x, alpha_y, beta_x, beta_y]
+
+
+class MapTree:
+    """Balanced product tree (segment tree) of 4 x 4 element maps.
+
+    Each internal node stores the product of the maps below it, so changing
+    one map costs O(log N) matrix products, and the product of any run of
+    consecutive maps costs O(log N) products.
+
+    Parameters
+    ----------
+    maps : list
+        Element maps in beam order.
+    """
+
+    def __init__(self, maps):
+        self.n = len(maps)
+        self.size = 1
+        while self.size < self.n:
+            self.size *= 2
+        self.nodes = 2 * self.size * [None]
+        for i in range(self.size):
+            self.nodes[self.size + i] = maps[i] if i < self.n else identity()
+        for node in range(self.size - 1, 0, -1):
+            self._combine(node)
+
+    def _combine(self, node):
+        # The right child comes later in the beam line, so it multiplies on the left.
+        self.nodes[node] = matmul(self.nodes[2 * node + 1], self.nodes[2 * node])
+
+    def get(self, i):
+        """Return map i."""
+        return self.nodes[self.size + i]
+
+    def update(self, i, M):
+        """Replace map i."""
+        node = self.size + i
+        self.nodes[node] = M
+        node //= 2
+        while node >= 1:
+            self._combine(node)
+            node //= 2
+
+    def product(self, lo, hi):
+        """Return M[hi - 1] * ... * M[lo] (the identity if lo >= hi)."""
+        left, right = identity(), identity()
+        lo += self.size
+        hi += self.size
+        while lo < hi:
+            if lo & 1:
+                left = matmul(self.nodes[lo], left)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                right = matmul(right, self.nodes[hi])
+            lo //= 2
+            hi //= 2
+        return matmul(right, left)
+
+    def prefix(self, i):
+        """Return the product of the first i maps."""
+        return self.product(0, i)
+
+
+# Lattice
+# -------------------------------------------------------------------------------
+class Element:
+    """A lattice element.
+
+    Attributes
+    ----------
+    name, keyword : str
+        MAD-X name and type ('QUADRUPOLE', 'SBEND', 'DRIFT', ...).
+    position : float
+        Position of the element entrance [m].
+    length, k1, angle, e1, e2, tilt : float
+        MAD-X element parameters (zero if not given).
+    """
+
+    def __init__(self, name, keyword, position=0.0, **params):
+        self.name = name
+        self.keyword = keyword
+        self.position = position
+        self.length = params.get("L", 0.0)
+        self.k1 = params.get("K1", 0.0)
+        self.angle = params.get("ANGLE", 0.0)
+        self.e1 = params.get("E1", 0.0)
+        self.e2 = params.get("E2", 0.0)
+        self.tilt = params.get("TILT", 0.0)
+        self._matrix = None
+
+    def __repr__(self):
+        return "Element({}, {}, L={})".format(self.name, self.keyword, self.length)
+
+    def set_k1(self, k1):
+        self.k1 = k1
+        self._matrix = None
+
+    def matrix(self):
+        """Return the 4 x 4 transfer matrix (computed once per setting)."""
+        if self._matrix is None:
+            if self.keyword == "QUADRUPOLE":
+                M = quad_matrix(self.length, self.k1)
+            elif self.keyword in ["SBEND", "RBEND"] and self.angle != 0.0:
+                M = sbend_matrix(self.length, self.angle, self.k1, self.e1, self.e2)
+            else:
+                M = drift_matrix(self.length)
+            self._matrix = tilt(M, self.tilt)
+        return self._matrix
+
+
+def _parse_params(tokens):
+    params = dict()
+    for token in tokens:
+        if "=" not in token:
+            continue
+        key, value = [s.strip() for s in token.split("=", 1)]
+        try:
+            params[key.upper()] = float(value)
+        except ValueError:
+            params[key.upper()] = value.strip("'\"")
+    return params
+
+
+def read_madx(filename):
+    """Read a MAD-X lattice file.
+
+    Returns
+    -------
+    elements : list[Element]
+        The sequence, with drifts ('DRIFT_0', 'DRIFT_1', ...) in the gaps.
+    beam : dict
+        Parameters of the BEAM command (MASS and ENERGY are in GeV).
+    init_twiss : dict
+        Initial values given to the TWISS command (BETX, ALFX, BETY, ALFY).
+    """
+    definitions = dict()
+    sequence = []
+    beam, init_twiss = dict(), dict()
+    in_sequence = False
+    file = open(filename, "r")
+    for line in file:
+        line = line.strip().rstrip(";")
+        if not line or line.startswith("!") or line.startswith("//"):
+            continue
+        if in_sequence:
+            if line.upper().startswith("ENDSEQUENCE"):
+                in_sequence = False
+                continue
+            tokens = line.split(",")
+            sequence.append((tokens[0].strip(), _parse_params(tokens[1:])["AT"]))
+        elif ":" in line and not line.upper().startswith("TITLE"):
+            name, rest = [s.strip() for s in line.split(":", 1)]
+            tokens = rest.split(",")
+            keyword = tokens[0].strip().upper()
+            if keyword == "SEQUENCE":
+                in_sequence = True
+            else:
+                definitions[name] = (keyword, _parse_params(tokens[1:]))
+        elif line.upper().startswith("BEAM"):
+            beam = _parse_params(line.split(",")[1:])
+        elif line.upper().startswith("TWISS"):
+            init_twiss = _parse_params(line.split(",")[1:])
+    file.close()
+
+    elements = []
+    position = 0.0
+    n_drifts = 0
+    for name, center in sequence:
+        keyword, params = definitions[name]
+        length = params.get("L", 0.0)
+        start = center - 0.5 * length
+        if start - position > 1e-9:
+            drift_name = "DRIFT_{}".format(n_drifts)
+            elements.append(Element(drift_name, "DRIFT", position, L=start - position))
+            n_drifts += 1
+        elements.append(Element(name, keyword, start, **params))
+        position = start + length
+    return elements, beam, init_twiss
+
+
+def read_twiss_file(filename):
+    """Read a MAD-X TWISS output table.
+
+    Returns a list of dicts, one per row, keyed by (upper case) column name.
+    """
+    columns, rows = [], []
+    file = open(filename, "r")
+    for line in file:
+        tokens = line.split()
+        if not tokens or tokens[0] in ["@", "$"]:
+            continue
+        if tokens[0] == "*":
+            columns = tokens[1:]
+            continue
+        row = dict()
+        for column, token in zip(columns, tokens):
+            if token.startswith('"'):
+                row[column] = token.strip('"')
+            else:
+                row[column] = float(token)
+        rows.append(row)
+    file.close()
+    return rows
+
+
+class LinearOptics:
+    """Linear optics model of a MAD-X lattice.
+
+    Parameters
+    ----------
+    filename : str
+        MAD-X lattice file. The default is the RTBT.
+    kinetic_energy : float, optional
+        Beam kinetic energy [eV]. The default is the energy in the BEAM command.
+    """
+
+    def __init__(self, filename=RTBT_MADX_FILE, kinetic_energy=None):
+        self.elements, self.beam, init_twiss = read_madx(filename)
+        self.index = dict()
+        for i, element in enumerate(self.elements):
+            self.index[element.name.upper()] = i
+
+        # Quadrupoles are split into pieces named 'QH02', 'QH02_A', ... Group
+        # the pieces under the name of the first piece.
+        self.pieces = dict()
+        for element in self.elements:
+            base = element.name
+            if len(base) > 2 and base[-2] == "_" and base[:-2].upper() in self.index:
+                base = base[:-2]
+            if element.keyword == "QUADRUPOLE":
+                self.pieces.setdefault(base.upper(), []).append(element)
+
+        if kinetic_energy is None:
+            mass = self.beam.get("MASS", PROTON_MASS)
+            kinetic_energy = 1e9 * (self.beam.get("ENERGY", mass) - mass)
+        self.set_kinetic_energy(kinetic_energy)
+        self.set_init_twiss(
+            init_twiss.get("ALFX", 0.0),
+            init_twiss.get("ALFY", 0.0),
+            init_twiss.get("BETX", 1.0),
+            init_twiss.get("BETY", 1.0),
+        )
+        self.eps_x = self.eps_y = 20e-5  # (arbitrary, as in PhaseController)
+        self.cumulative_maps = None
+        self.tree = None
+
+    def set_kinetic_energy(self, kinetic_energy):
+        """Set the kinetic energy [eV]; quadrupole k1 values are not changed."""
+        self.kinetic_energy = kinetic_energy
+        mass = 1e9 * self.beam.get("MASS", PROTON_MASS)
+        pc = math.sqrt(kinetic_energy * (kinetic_energy + 2.0 * mass))
+        self.brho = 1e-9 * pc / SPEED_OF_LIGHT
+
+    def set_init_twiss(self, alpha_x, alpha_y, beta_x, beta_y):
+        """Set the Twiss parameters at the lattice entrance."""
+        self.init_twiss = {
+            "alpha_x": alpha_x,
+            "alpha_y": alpha_y,
+            "beta_x": beta_x,
+            "beta_y": beta_y,
+        }
+
+    def node_index(self, node_id):
+        """Return the index of the element matching an OpenXAL or MAD-X id."""
+        for name in [node_id, node_id.split(":")[-1], node_id.replace(":", "_")]:
+            if name.upper() in self.index:
+                return self.index[name.upper()]
+        raise KeyError("No element matches node id '{}'.".format(node_id))
+
+    def quad_pieces(self, quad_id):
+        name = self.elements[self.node_index(quad_id)].name
+        return self.pieces[name.upper()]
+
+    def get_k1(self, quad_id):
+        return self.quad_pieces(quad_id)[0].k1
+
+    def set_k1(self, quad_id, k1):
+        for element in self.quad_pieces(quad_id):
+            element.set_k1(k1)
+            if self.tree is not None:
+                self.tree.update(self.index[element.name.upper()], element.matrix())
+        self.cumulative_maps = None
+
+    def get_field(self, quad_id):
+        """Return quadrupole field strength [T/m]."""
+        return self.get_k1(quad_id) * self.brho
+
+    def get_fields(self, quad_ids):
+        return [self.get_field(quad_id) for quad_id in quad_ids]
+
+    def set_field(self, quad_id, field):
+        """Set quadrupole field strength [T/m] (shared supplies are not linked)."""
+        self.set_k1(quad_id, field / self.brho)
+
+    def set_fields(self, quad_ids, fields):
+        for quad_id, field in zip(quad_ids, fields):
+            self.set_field(quad_id, field)
+
+    def track(self):
+        """Compute the map from the lattice entrance to every element entrance."""
+        M = identity()
+        self.cumulative_maps = [M]
+        for element in self.elements:
+            M = matmul(element.matrix(), M)
+            self.cumulative_maps.append(M)
+        return self.cumulative_maps
+
+    def map_tree(self):
+        """Return the `MapTree` of the element maps (built on first use)."""
+        if self.tree is None:
+            self.tree = MapTree([element.matrix() for element in self.elements])
+        return self.tree
+
+    def cumulative_map(self, i):
+        """Return the map from the entrance to the entrance of element i.
+
+        i = len(elements) gives the map to the lattice exit. After `track`,
+        the maps are read from the tracked list; after a field change, they
+        come from the map tree, so only the changed quadrupoles are
+        recomputed.
+        """
+        if self.cumulative_maps is not None:
+            return self.cumulative_maps[i]
+        return self.map_tree().prefix(i)
+
+    def transfer_matrix(self, start_node_id=None, stop_node_id=None):
+        """Return the 4 x 4 transfer matrix between two node entrances.
+
+        The node ids can be out of order. The default is to start at the first
+        node and end at the last node.
+        """
+        i, j = 0, len(self.elements) - 1
+        if start_node_id is not None:
+            i = self.node_index(start_node_id)
+        if stop_node_id is not None:
+            j = self.node_index(stop_node_id)
+        M1, M2 = self.cumulative_map(i), self.cumulative_map(j)
+        return matmul(M2, symplectic_inverse(M1))
+
+    def _twiss_from_map(self, M):
+        return twiss_from_map(M, self.init_twiss) + [self.eps_x, self.eps_y]
+
+    def tracked_twiss(self):
+        """Return the Twiss parameters at each element entrance (and the exit).
+
+        Each row is [mu_x, mu_y, alpha_x, alpha_y, beta_x, beta_y, eps_x, eps_y],
+        as in `PhaseController.tracked_twiss`.
+        """
+        if self.cumulative_maps is None:
+            self.track()
+        return [self._twiss_from_map(M) for M in self.cumulative_maps]
+
+    def twiss(self, node_id):
+        """Return the Twiss parameters at the node entrance."""
+        return self._twiss_from_map(self.cumulative_map(self.node_index(node_id)))
+
+    def phases(self, node_id):
+        """Return the phase advances (mod 2pi) at the node entrance."""
+        return self.twiss(node_id)[:2]
+
+    def beta_funcs(self, node_id):
+        """Return the beta functions at the node entrance."""
+        return self.twiss(node_id)[4:6]
+
+    def max_betas(self, start="RTBT_Mag:QH02", stop="RTBT_Diag:WS24"):
+        """Return the maximum x and y beta functions from start to stop.
+
+        Setting start=None starts from the beginning of the lattice. Setting
+        stop=None goes through the end of the lattice.
+        """
+        lo = 0 if start is None else self.node_index(start)
+        hi = len(self.elements) if stop is None else self.node_index(stop)
+        beta_xs, beta_ys = [], []
+        M = self.cumulative_map(lo)
+        for i in range(lo, hi + 1):
+            mu_x, mu_y, alpha_x, alpha_y, beta_x, beta_y, _, _ = self._twiss_from_map(M)
+            beta_xs.append(beta_x)
+            beta_ys.append(beta_y)
+            if i < len(self.elements):
+                M = matmul(self.elements[i].matrix(), M)
+        return max(beta_xs), max(beta_ys)
+
+    def positions(self):
+        """Return the position of each element entrance [m]."""
+        return [element.position for element in self.elements]
+
+    def compare_twiss_file(self, filename):
+        """Compare the model with a MAD-X TWISS table.
+
+        MAD-X gives the optics at the element exit, which is the entrance of
+        the next element. Returns the maximum relative error in the beta
+        functions and the maximum absolute error in the alpha functions over
+        all elements in the table.
+        """
+        max_beta_err = max_alpha_err = 0.0
+        for row in read_twiss_file(filename):
+            name = row["NAME"]
+            if row.get("KEYWORD") == "DRIFT" or name.upper() not in self.index:
+                continue
+            i = self.index[name.upper()] + 1
+            _, _, alpha_x, alpha_y, beta_x, beta_y, _, _ = self._twiss_from_map(
+                self.cumulative_map(i)
+            )
+            for beta, beta_madx in [(beta_x, row["BETX"]), (beta_y, row["BETY"])]:
+                max_beta_err = max(max_beta_err, abs(beta - beta_madx) / beta_madx)
+            for alpha, alpha_madx in [(alpha_x, row["ALFX"]), (alpha_y, row["ALFY"])]:
+                max_alpha_err = max(max_alpha_err, abs(alpha - alpha_madx))
+        return max_beta_err, max_alpha_err
@@ -1,7 +1,12 @@
-"""Linear least squares solving using JAMA matrices."""
+"""Linear least squares solving using JAMA matrices (or their NumPy stand-in)."""
+from __future__ import print_function
 import copy
 from math import sqrt
-from Jama import Matrix
+
+from backend import LUDecomposition
+from backend import Matrix
+from backend import MatrixError
+from backend import QRDecomposition
 
 
 def sign(x):
@@ -192,12 +197,12 @@ def lsmr(
         maxiter = minDim
 
     if show:
-        print " "
-        print "LSMR            Least-squares solution of  Ax = b\n"
-        print "The matrix A has {} rows and {} columns".format(m, n)
-        print "damp = {}".format(damp)
-        print "atol = {}         conlim = {}".format(atol, conlim)
-        print "btol = {}         maxiter = {}".format(btol, maxiter)
+        print(" ")
+        print("LSMR            Least-squares solution of  Ax = b\n")
+        print("The matrix A has {} rows and {} columns".format(m, n))
+        print("damp = {}".format(damp))
+        print("atol = {}         conlim = {}".format(atol, conlim))
+        print("btol = {}         maxiter = {}".format(btol, maxiter))
 
     u = b
     normb = norm(b)
@@ -260,18 +265,18 @@ def lsmr(
     normar = alpha * beta
     if normar == 0:
         if show:
-            print msg[0]
+            print(msg[0])
         return x, istop, itn, normr, normar, normA, condA, normx
 
     if show:
-        print " "
-        print hdg1, hdg2
+        print(" ")
+        print(hdg1, hdg2)
         test1 = 1
         test2 = alpha / beta
         str1 = "{:6g} {:12.5e}".format(itn, x.get(0, 0))
         str2 = " {:10.3e} {:10.3e}".format(normr, normar)
         str3 = "  {:8.1e} {:8.1e}".format(test1, test2)
-        print "".join([str1, str2, str3])
+        print("".join([str1, str2, str3]))
 
     # Main iteration loop.
     while itn < maxiter:
@@ -414,33 +419,106 @@ def lsmr(
 
                 if pcount >= pfreq:
                     pcount = 0
-                    print " "
-                    print hdg1, hdg2
+                    print(" ")
+                    print(hdg1, hdg2)
                 pcount = pcount + 1
                 str1 = "{:6g} {:12.5e}".format(itn, x.get(0, 0))
                 str2 = " {:10.3e} {:10.3e}".format(normr, normar)
                 str3 = "  {:8.1e} {:8.1e}".format(test1, test2)
                 str4 = "  {:8.1e} {:8.1e}".format(normA, condA)
-                print "".join([str1, str2, str3, str4])
+                print("".join([str1, str2, str3, str4]))
 
         if istop > 0:
             break
 
     # Print the stopping condition.
     if show:
-        print " "
-        print "LSMR finished"
-        print msg[istop]
+        print(" ")
+        print("LSMR finished")
+        print(msg[istop])
         str1 = "istop = {}    normr ={:8.1e}".format(istop, normr)
         str2 = "    normA ={:8.1e}    normAr ={:8.1e}".format(normA, normar)
         str3 = "itn = {}    condA ={:8.1e}".format(itn, condA)
         str4 = "    normx = {:8.1e}".format(normx)
-        print str1, str2
-        print str3, str4
+        print(str1, str2)
+        print(str3, str4)
 
     return x, istop, itn, normr, normar, normA, condA, normx
 
 
+class FactoredMatrix:
+    """Factorization of a design matrix that can be reused for many right-hand sides.
+
+    `Matrix.solve` factors the design matrix on every call. When only the target
+    vector changes between solves (for example, when noise is added to the
+    measured moments), it is much cheaper to factor A once and reuse the
+    factorization. As in `Matrix.solve`, square matrices use LU decomposition
+    and rectangular matrices use QR decomposition.
+    """
+
+    def __init__(self, A):
+        if type(A) is list:
+            A = Matrix(A)
+        self.A = A
+        if A.getRowDimension() == A.getColumnDimension():
+            self.decomp = LUDecomposition(A)
+        else:
+            self.decomp = QRDecomposition(A)
+
+    def solve(self, B):
+        """Return the least-squares solution for every column of B.
+
+        Parameters
+        ----------
+        B : JAMA matrix, shape (m, k)
+            Each column is a target vector.
+
+        Returns
+        -------
+        X : JAMA matrix, shape (n, k)
+            Each column is the solution for the corresponding column of B.
+        """
+        return self.decomp.solve(B)
+
+
+def lsq_linear_batch(A, B, solver="exact", max_iter=None, lsmr_tol=1e-12, verbose=0):
+    """Solve an unbounded linear least-squares problem for many target vectors.
+
+    The design matrix is factored once and all k right-hand sides are solved
+    in a single call.
+
+    Parameters
+    ----------
+    A : list, shape (m, n), or FactoredMatrix
+        Design matrix. Pass a FactoredMatrix to reuse a factorization between
+        calls.
+    B : list, shape (m, k)
+        Target vectors (one per column).
+    solver : {'exact', 'lsmr'}
+        See `lsq_linear`. The 'lsmr' solver does not factor A, so it solves
+        one column at a time.
+    max_iter, lsmr_tol, verbose :
+        See `lsq_linear`.
+
+    Returns
+    -------
+    X : list, shape (k, n)
+        The solution for each column of B.
+    """
+    if solver == "exact":
+        if not isinstance(A, FactoredMatrix):
+            A = FactoredMatrix(A)
+        X = A.solve(Matrix(B))
+        return [list(x) for x in zip(*X.getArray())]
+    elif solver == "lsmr":
+        if isinstance(A, FactoredMatrix):
+            A = A.A
+        kws = dict(solver=solver, max_iter=max_iter, lsmr_tol=lsmr_tol, verbose=verbose)
+        return [lsq_linear(A, list(b), **kws) for b in zip(*B)]
+    else:
+        raise ValueError("Method must be in {'exact', 'lsmr'}")
+
+
 def lsq_linear(A, b, solver="exact", max_iter=None, lsmr_tol=1e-12, verbose=0):
     """Solve an unbounded linear least-squares problem.
     
@@ -472,7 +550,8 @@ def lsq_linear(A, b, solver="exact", max_iter=None, lsmr_tol=1e-12, verbose=0):
             * 1 : display a termination report.
             * 2 : display progress during iterations.
     """
-    A = Matrix(A)
+    if type(A) is list:
+        A = Matrix(A)
     if type(b[0]) is not list:
         b = transpose_list(b)
     b = Matrix(b)
@@ -489,3 +568,133 @@ def lsq_linear(A, b, solver="exact", max_iter=None, lsmr_tol=1e-12, verbose=0):
     # Turn column vector into row vector.
     x = [x.get(i, 0) for i in range(x.getRowDimension())]
     return x
+
+
+def levenberg_marquardt(
+    fun,
+    jac,
+    x0,
+    bounds=None,
+    max_iter=100,
+    ftol=1e-8,
+    xtol=1e-8,
+    gtol=1e-10,
+    lam=1e-3,
+    verbose=0,
+):
+    """Solve a nonlinear least-squares problem by the Levenberg-Marquardt method.
+
+    Given a residual function r(x) with m elements, minimize 0.5 * ||r(x)||**2.
+    Each iteration solves (J^T J + lam * D) dx = -J^T r, where J is the m-by-n
+    Jacobian and D is the largest diag(J^T J) seen so far (More's scaling).
+    Steps that reduce the cost are accepted and `lam` is decreased; otherwise
+    (or if the damped system is singular) `lam` is increased and the step is
+    retried. The iteration stops once `lam` exceeds 1e16 without an accepted
+    step. There is no randomness, so the same inputs always give the same
+    answer.
+
+    Parameters
+    ----------
+    fun : callable
+        `fun(x)` returns the residual vector as a list of shape (m,).
+    jac : callable
+        `jac(x)` returns the Jacobian as a list of shape (m, n).
+    x0 : list, shape (n,)
+        Initial guess.
+    bounds : 2-tuple of list, optional
+        Lower and upper bounds on x. Each trial point is clipped to the bounds
+        (use None for a missing bound).
+    max_iter : int
+        Maximum number of accepted or rejected steps.
+    ftol, xtol, gtol : float
+        Stop when the relative reduction in cost, the relative step size, or
+        the largest element of J^T r falls below these tolerances.
+    lam : float
+        Initial damping parameter.
+    verbose : {0, 1, 2}
+        Level of verbosity:
+            * 0 : work silently (default).
+            * 1 : display a termination report.
+            * 2 : display progress during iterations.
+
+    Returns
+    -------
+    x : list, shape (n,)
+        The solution.
+    cost : float
+        The value of 0.5 * ||r(x)||**2 at the solution.
+    itn : int
+        Number of iterations used.
+    """
+    n = len(x0)
+    if bounds is None:
+        bounds = (n * [None], n * [None])
+    lb, ub = bounds
+
+    def project(x):
+        return [_clip(xi, lo, hi) for xi, lo, hi in zip(x, lb, ub)]
+
+    def cost_of(r):
+        return 0.5 * sum([ri * ri for ri in r])
+
+    x = project(list(x0))
+    r = fun(x)
+    cost = cost_of(r)
+    scale = n * [0.0]
+    itn = 0
+    message = "The maximum number of iterations has been reached."
+    while itn < max_iter:
+        itn += 1
+        J = jac(x)
+        JT = Matrix(J).transpose()
+        g = JT.times(Matrix(transpose_list(r)))
+        if max([abs(g.get(i, 0)) for i in range(n)]) < gtol:
+            message = "The gradient is small enough, given gtol."
+            break
+        H = JT.times(Matrix(J))
+        scale = [max(scale[i], H.get(i, i)) for i in range(n)]
+        while True:
+            H_damped = H.copy()
+            for i in range(n):
+                H_damped.set(i, i, H.get(i, i) + lam * scale[i] + 1e-30)
+            accepted = False
+            try:
+                dx = H_damped.solve(g.times(-1.0))
+            except MatrixError:
+                dx = None
+            if dx is not None:
+                x_new = project([x[i] + dx.get(i, 0) for i in range(n)])
+                r_new = fun(x_new)
+                cost_new = cost_of(r_new)
+                accepted = cost_new <= cost
+            if accepted or lam > 1e16:
+                break
+            lam *= 10.0
+        if not accepted:
+            message = "The damping parameter has become too large."
+            break
+        step = sqrt(sum([(a - b) ** 2 for a, b in zip(x_new, x)]))
+        size = sqrt(sum([a * a for a in x]))
+        reduction = cost - cost_new
+        x, r, cost = x_new, r_new, cost_new
+        lam = max(lam / 10.0, 1e-12)
+        if verbose > 1:
+            print("itn = {:3}  cost = {:.6e}  lam = {:.1e}".format(itn, cost, lam))
+        if reduction <= ftol * cost:
+            message = "The reduction in cost is small enough, given ftol."
+            break
+        if step <= xtol * (xtol + size):
+            message = "The step size is small enough, given xtol."
+            break
+    if verbose > 0:
+        print(message)
+        print("itn = {}    cost = {:.6e}".format(itn, cost))
+    return x, cost, itn
+
+
+def _clip(x, lo, hi):
+    if lo is not None and x < lo:
+        return lo
+    if hi is not None and x > hi:
+        return hi
+    return x
@@ -1,7 +1,7 @@
 from __future__ import print_function
+from array import array
 import copy
 import math
-import time
 import warnings
 
 from xal.ca import Channel
@@ -18,14 +18,12 @@ from xal.extension.solver.SolveStopperFactory import maxEvaluationsStopper
 from xal.model.probe import Probe
 from xal.model.probe.traj import Trajectory
 from xal.service.pvlogger import RemoteLoggingCenter
-from xal.service.pvlogger.sim import PVLoggerDataSource
 from xal.sim.scenario import AlgorithmFactory
 from xal.sim.scenario import ProbeFactory
 from xal.sim.scenario import Scenario
 from xal.sim.sync import SynchronizationException
 from xal.smf import Accelerator
 from xal.smf import AcceleratorSeq
-from xal.smf.data import XMLDataManager
 from xal.smf.impl import MagnetMainSupply
 from xal.tools.beam import CovarianceMatrix
 from xal.tools.beam import PhaseVector
@@ -34,7 +32,17 @@ from xal.tools.beam.calc import CalculationsOnBeams
 from xal.tools.beam.calc import CalculationsOnRings
 
 # Local
+import accelerator_registry
+from field_cache import FieldCache
+import lattice
+import parallel
+import pvlogger_cache
+import ramp
+import ring_twiss
 from utils import clip
+from least_squares import levenberg_marquardt
+from utils import inverse
+from utils import LRUCache
 from utils import norm
 from utils import put_angle_in_range
 from utils import subtract
@@ -42,6 +50,7 @@ from xal_helpers import get_trial_vals
 from xal_helpers import list_from_xal_matrix
 from xal_helpers import minimize
 from utils import radians
+from utils import transpose
 
 
 # Available RTBT wire-scanners
@@ -91,48 +100,72 @@ def compute_twiss(state, calculator):
     return [mu_x, mu_y, alpha_x, alpha_y, beta_x, beta_y, eps_x, eps_y]
 
 
-def compute_model_twiss(node_id, kinetic_energy, pvloggerid=None, sync_mode="design"):
-    """Compute the model Twiss parameters in the RTBT."""
-    accelerator = XMLDataManager.loadDefaultAccelerator()
-    pvl_data_source = None
+def _synced_scenario(seq_name, pvloggerid=None, sync_mode="design"):
+    sequence = accelerator_registry.get_sequence(seq_name)
+    scenario = accelerator_registry.new_scenario(seq_name)
     if pvloggerid is not None:
-        pvl_data_source = PVLoggerDataSource(pvloggerid)
+        scenario = pvlogger_cache.set_model_source(pvloggerid, sequence, scenario)
+        scenario.resync()
+    else:
+        safe_sync(scenario, sync_mode)
+    return sequence, scenario
 
-    def get_seq_scenario(seq_name):
-        sequence = accelerator.getComboSequence(seq_name)
-        scenario = Scenario.newScenarioFor(sequence)
-        if pvloggerid is not None:
-            scenario = pvl_data_source.setModelSource(sequence, scenario)
-            scenario.resync()
-        else:
-            safe_sync(scenario, sync_mode)
-        return sequence, scenario
 
+def ring_matched_twiss(kinetic_energy, pvloggerid=None, sync_mode="design"):
+    """Return the matched (alpha_x, alpha_y, beta_x, beta_y) at the RTBT entrance.
+
+    The Twiss parameters are defined by the closed orbit in the Ring. They are
+    cached per machine state, kinetic energy and lattice (see `ring_twiss`).
+    """
+
+    def compute():
+        sequence, scenario = _synced_scenario("Ring", pvloggerid, sync_mode)
+        tracker = AlgorithmFactory.createTransferMapTracker(sequence)
+        probe = ProbeFactory.getTransferMapProbe(sequence, tracker)
+        probe.setKineticEnergy(kinetic_energy)
+        scenario.setProbe(probe)
+        scenario.run()
+        trajectory = probe.getTrajectory()
+        calculator = CalculationsOnRings(trajectory)
+        state = trajectory.statesForElement("Begin_Of_Ring3")[0]
+        twiss_x, twiss_y, twiss_z = calculator.computeMatchedTwissAt(state)
+        return [
+            twiss_x.getAlpha(),
+            twiss_y.getAlpha(),
+            twiss_x.getBeta(),
+            twiss_y.getBeta(),
+        ]
+
+    return ring_twiss.default_cache().get(
+        compute,
+        kinetic_energy,
+        pvloggerid,
+        sync_mode,
+        lattice_id=accelerator_registry.get_lattice_id(),
+    )
+
+
+def compute_model_twiss(node_id, kinetic_energy, pvloggerid=None, sync_mode="design"):
+    """Compute the model Twiss parameters in the RTBT."""
     # Get the model optics at the ring extraction point (RTBT entrance).
-    sequence, scenario = get_seq_scenario("Ring")
-    tracker = AlgorithmFactory.createTransferMapTracker(sequence)
-    probe = ProbeFactory.getTransferMapProbe(sequence, tracker)
-    probe.setKineticEnergy(kinetic_energy)
-    scenario.setProbe(probe)
-    scenario.run()
-    trajectory = probe.getTrajectory()
-    calculator = CalculationsOnRings(trajectory)
-    state = trajectory.statesForElement("Begin_Of_Ring3")[0]
-    twiss_x, twiss_y, twiss_z = calculator.computeMatchedTwissAt(state)
+    alpha_x, alpha_y, beta_x, beta_y = ring_matched_twiss(
+        kinetic_energy, pvloggerid, sync_mode
+    )
 
     # Track through the RTBT if necessary.
-    sequence, scenario = get_seq_scenario("RTBT")
+    sequence = accelerator_registry.get_sequence("RTBT")
     node_ids = [node.getId() for node in sequence.getNodes()]
     node_index = node_ids.index(node_id)
     if node_index > 0:
+        sequence, scenario = _synced_scenario("RTBT", pvloggerid, sync_mode)
         tracker = AlgorithmFactory.createEnvelopeTracker(sequence)
         tracker.setUseSpacecharge(False)
         probe = ProbeFactory.getEnvelopeProbe(sequence, tracker)
         probe.setBeamCurrent(0.0)
         probe.setKineticEnergy(kinetic_energy)
         eps_x = eps_y = 20e-6  # [mm mrad] (arbitrary)
-        twiss_x = Twiss(twiss_x.getAlpha(), twiss_x.getBeta(), eps_x)
-        twiss_y = Twiss(twiss_y.getAlpha(), twiss_y.getBeta(), eps_y)
+        twiss_x = Twiss(alpha_x, beta_x, eps_x)
+        twiss_y = Twiss(alpha_y, beta_y, eps_y)
         twiss_z = Twiss(0, 1, 0)
         probe.initFromTwiss([twiss_x, twiss_y, twiss_z])
         scenario.setProbe(probe)
@@ -141,12 +174,67 @@ def compute_model_twiss(node_id, kinetic_energy, pvloggerid=None, sync_mode="des
         calculator = CalculationsOnBeams(trajectory)
         state = trajectory.stateForElement(node_id)
         twiss_x, twiss_y, _ = calculator.computeTwissParameters(state)
-    return [
-        twiss_x.getAlpha(),
-        twiss_y.getAlpha(),
-        twiss_x.getBeta(),
-        twiss_y.getBeta(),
-    ]
+        alpha_x, alpha_y = twiss_x.getAlpha(), twiss_y.getAlpha()
+        beta_x, beta_y = twiss_x.getBeta(), twiss_y.getBeta()
+    return [alpha_x, alpha_y, beta_x, beta_y]
+
+
+def compute_model_phases(node_ids, kinetic_energy, pvloggerids, n_workers=None):
+    """Compute the model phase advances at the nodes for several machine states.
+
+    Each distinct PVLoggerID is synced and tracked once, on its own scenario;
+    the distinct states are tracked on parallel threads (see `parallel`).
+
+    Parameters
+    ----------
+    node_ids : list[str]
+        Ids of the RTBT nodes.
+    kinetic_energy : float
+        Beam kinetic energy [eV].
+    pvloggerids : list[int]
+        PVLoggerID of each machine state (repeats are allowed).
+    n_workers : int or None
+        Number of threads. Defaults to the number of processors.
+
+    Returns
+    -------
+    dict
+        Each key is a PVLoggerID. Each value is a list of [mu_x, mu_y] at each
+        node [rad].
+    """
+    states = []
+    for pvloggerid in pvloggerids:
+        if pvloggerid not in states:
+            states.append(pvloggerid)
+
+    def state_phases(pvloggerid):
+        alpha_x, alpha_y, beta_x, beta_y = ring_matched_twiss(
+            kinetic_energy, pvloggerid
+        )
+        sequence, scenario = _synced_scenario("RTBT", pvloggerid)
+        tracker = AlgorithmFactory.createEnvelopeTracker(sequence)
+        tracker.setUseSpacecharge(False)
+        probe = ProbeFactory.getEnvelopeProbe(sequence, tracker)
+        probe.setBeamCurrent(0.0)
+        probe.setKineticEnergy(kinetic_energy)
+        eps_x = eps_y = 20e-6  # [mm mrad] (arbitrary)
+        twiss_x = Twiss(alpha_x, beta_x, eps_x)
+        twiss_y = Twiss(alpha_y, beta_y, eps_y)
+        twiss_z = Twiss(0, 1, 0)
+        probe.initFromTwiss([twiss_x, twiss_y, twiss_z])
+        scenario.setProbe(probe)
+        scenario.run()
+        trajectory = probe.getTrajectory()
+        calculator = CalculationsOnBeams(trajectory)
+        phases = []
+        for node_id in node_ids:
+            state = trajectory.stateForElement(node_id)
+            mu_x, mu_y, _ = calculator.computeBetatronPhase(state).toArray()
+            phases.append([mu_x, mu_y])
+        return phases
+
+    results = parallel.map_threads(state_phases, states, n_workers=n_workers)
+    return dict(zip(states, results))
 
 
 def safe_sync(scenario, sync_mode):
@@ -173,8 +261,88 @@ def safe_sync(scenario, sync_mode):
     return sync_mode
 
 
+class TransferMatrixTable:
+    """Transfer matrices between any two nodes from one trajectory.
+
+    The cumulative first-order map (6 x 6) from the start of the lattice to
+    each node is read once from a transfer map trajectory and stored row by
+    row in a flat array. The inverse of each cumulative map is computed when
+    first needed and kept. The transfer matrix from node a to node b is then
+    M_b * inv(M_a), which also holds if b is upstream of a.
+
+    Parameters
+    ----------
+    trajectory : Trajectory
+        Transfer map probe trajectory.
+    node_ids : list[str]
+        Ids of the nodes to store, in lattice order.
+    """
+
+    def __init__(self, trajectory, node_ids):
+        self.node_ids = list(node_ids)
+        self.node_index = dict()
+        self.maps = array("d")
+        for i, node_id in enumerate(self.node_ids):
+            self.node_index[node_id] = i
+            M = trajectory.stateForElement(node_id).getTransferMap().getFirstOrder()
+            for k in range(6):
+                for l in range(6):
+                    self.maps.append(M.getElem(k, l))
+        self.inverses = dict()
+
+    def cumulative(self, node_id):
+        """Return the 6 x 6 map from the lattice start to the node (list)."""
+        lo = 36 * self.node_index[node_id]
+        return [list(self.maps[lo + 6 * k : lo + 6 * (k + 1)]) for k in range(6)]
+
+    def inverse_cumulative(self, node_id):
+        """Return the inverse of `cumulative(node_id)` (cached)."""
+        if node_id not in self.inverses:
+            self.inverses[node_id] = inverse(self.cumulative(node_id))
+        return self.inverses[node_id]
+
+    def get(self, start_node_id=None, stop_node_id=None):
+        """Return the 4 x 4 transfer matrix from start to stop (list).
+
+        The node ids can be out of order. The default is to start at the first
+        node and end at the last node.
+        """
+        if start_node_id is None:
+            start_node_id = self.node_ids[0]
+        if stop_node_id is None:
+            stop_node_id = self.node_ids[-1]
+        lo = 36 * self.node_index[stop_node_id]
+        Minv = self.inverse_cumulative(start_node_id)
+        M = []
+        for k in range(4):
+            row = self.maps[lo + 6 * k : lo + 6 * (k + 1)]
+            M.append([sum(row[n] * Minv[n][l] for n in range(6)) for l in range(4)])
+        return M
+
+    def to_target(self, target_node_id, node_ids=None):
+        """Return the transfer matrix from each node to the target node.
+
+        The default is to use every node in the table.
+        """
+        if node_ids is None:
+            node_ids = self.node_ids
+        return [self.get(node_id, target_node_id) for node_id in node_ids]
+
+
 class TransferMatrixGenerator:
-    """Class to compute the transfer matrix between two nodes."""
+    """Class to compute the transfer matrix between two nodes.
+
+    The scenario is run once and the trajectory is kept until the model
+    changes: `sync` and `set_kinetic_energy` do this automatically, and
+    `invalidate` should be called after any other change to the scenario (for
+    example, a field change). All transfer matrices come from a
+    `TransferMatrixTable` built from the cached trajectory. Syncing again to
+    the same PVLoggerID does nothing.
+
+    `optics` returns the optics of a PVLoggerID (energy and quad fields), so
+    that measurements taken with the same optics can share their transfer
+    matrices.
+    """
 
     def __init__(self, sequence, kinetic_energy):
         self.sequence = sequence
@@ -182,17 +350,69 @@ class TransferMatrixGenerator:
         self.tracker = AlgorithmFactory.createTransferMapTracker(self.sequence)
         self.probe = ProbeFactory.getTransferMapProbe(self.sequence, self.tracker)
         self.scenario.setProbe(self.probe)
+        self.node_ids = [node.getId() for node in self.sequence.getNodes()]
+        self.quad_ids = node_ids(self.sequence.getNodesOfType("quad", True))
+        self.node_index = dict()
+        for i, node_id in enumerate(self.node_ids):
+            self.node_index[node_id] = i
+        self.pvloggerid = None
+        self.trajectory = None
+        self._table = None
         self.set_kinetic_energy(kinetic_energy)
 
     def set_kinetic_energy(self, kinetic_energy):
         """Set the probe kinetic energy [eV]."""
+        self.kinetic_energy = kinetic_energy
         self.probe.setKineticEnergy(kinetic_energy)
+        self.trajectory = None
+        self._table = None
 
     def sync(self, pvloggerid):
         """Sync the model with the machine state from a PVLoggerID."""
-        pvl_data_source = PVLoggerDataSource(pvloggerid)
-        self.scenario = pvl_data_source.setModelSource(self.sequence, self.scenario)
+        if pvloggerid == self.pvloggerid:
+            return
+        self.scenario = pvlogger_cache.set_model_source(
+            pvloggerid, self.sequence, self.scenario
+        )
         self.scenario.resync()
+        self.trajectory = None
+        self._table = None
+        self.pvloggerid = pvloggerid
+
+    def optics(self, pvloggerid):
+        """Return the optics for a PVLoggerID: [kinetic energy] + quad fields.
+
+        The quad fields are those stored for the PVLoggerID, in the order of
+        `quad_ids`. It does not sync the model. Two optics vectors can be
+        compared with `analysis.same_optics`.
+        """
+        snapshot = pvlogger_cache.default_store().get(pvloggerid, self.sequence)
+        fields = [snapshot.fields.get(quad_id, 0.0) for quad_id in self.quad_ids]
+        return [self.kinetic_energy] + fields
+
+    def invalidate(self):
+        """Forget the tracked trajectory (call after changing the scenario).
+
+        The next `sync` will also reload the machine state, even if the
+        PVLoggerID has not changed.
+        """
+        self.trajectory = None
+        self._table = None
+        self.pvloggerid = None
+
+    def track(self):
+        """Return the trajectory, running the scenario only if needed."""
+        if self.trajectory is None:
+            self.scenario.resetProbe()
+            self.scenario.run()
+            self.trajectory = self.probe.getTrajectory()
+        return self.trajectory
+
+    def table(self):
+        """Return the `TransferMatrixTable` for the current trajectory."""
+        if self._table is None:
+            self._table = TransferMatrixTable(self.track(), self.node_ids)
+        return self._table
 
     def generate(self, start_node_id=None, stop_node_id=None):
         """Return the transfer matrix from start to node entrance.
@@ -200,34 +420,236 @@ class TransferMatrixGenerator:
         The node ids can be out of order. The default is to start at the first
         node and end at the last node in the sequence.
         """
-        # Default arguments
-        if start_node_id is None:
-            start_node_id = self.sequence.getNodes()[0].getId()
-        if stop_node_id is None:
-            stop_node_id = self.sequence.getNodes()[-1].getId()
-        # Check if the nodes are in order. If they are not, flip them and
-        # remember to take the inverse at the end.
-        reverse = False
-        node_ids = [node.getId() for node in self.sequence.getNodes()]
-        if node_ids.index(start_node_id) > node_ids.index(stop_node_id):
-            start_node_id, stop_node_id = stop_node_id, start_node_id
-            reverse = True
-        # Run the scenario.
-        self.scenario.resetProbe()
-        self.scenario.run()
-        # Get transfer matrix from upstream to downstream node.
-        trajectory = self.probe.getTrajectory()
-        state1 = trajectory.stateForElement(start_node_id)
-        state2 = trajectory.stateForElement(stop_node_id)
-        M1 = state1.getTransferMap().getFirstOrder()
-        M2 = state2.getTransferMap().getFirstOrder()
-        M = M2.times(M1.inverse())
-        if reverse:
-            M = M.inverse()
-        # Return list of shape (4, 4).
-        M = list_from_xal_matrix(M)
-        M = [row[:4] for row in M[:4]]
-        return M
+        return self.table().get(start_node_id, stop_node_id)
+
+    def to_target(self, target_node_id, node_ids=None):
+        """Return the transfer matrix from each node to the target node."""
+        return self.table().to_target(target_node_id, node_ids)
+
+
+class TwissTable:
+    """Twiss parameters at every state of a tracked trajectory.
+
+    The table is filled once per `track` and stored by column (one array per
+    parameter). Node indices are looked up in the trajectory once and then
+    memoized. A sparse table of the beta functions (the maximum over each
+    window of length 2^k) gives the maximum over any range of states in O(1).
+
+    Parameters
+    ----------
+    trajectory : Trajectory
+        The tracked trajectory.
+    params : list[list[float]]
+        [mu_x, mu_y, alpha_x, alpha_y, beta_x, beta_y, eps_x, eps_y] at each
+        state (the output of `compute_twiss`).
+    positions : list[float]
+        Position of each state [m].
+    """
+
+    names = ["mu_x", "mu_y", "alpha_x", "alpha_y", "beta_x", "beta_y", "eps_x", "eps_y"]
+
+    def __init__(self, trajectory, params, positions):
+        self.trajectory = trajectory
+        self.n_states = len(params)
+        self.columns = {"position": array("d", positions)}
+        for j, name in enumerate(self.names):
+            self.columns[name] = array("d", [row[j] for row in params])
+        self._indices = dict()
+        self._max_tables = dict()
+        for name in ["beta_x", "beta_y"]:
+            self._max_tables[name] = self._sparse_max_table(self.columns[name])
+
+    @staticmethod
+    def _sparse_max_table(values):
+        levels = [values]
+        width = 1
+        while 2 * width <= len(values):
+            prev = levels[-1]
+            n = len(prev) - width
+            levels.append(array("d", [max(prev[i], prev[i + width]) for i in range(n)]))
+            width *= 2
+        return levels
+
+    def indices(self, node_id):
+        """Return the first and last state index of the node."""
+        if node_id not in self._indices:
+            indices = self.trajectory.indicesForElement(node_id)
+            self._indices[node_id] = (indices[0], indices[-1])
+        return self._indices[node_id]
+
+    def row(self, i):
+        return [self.columns[name][i] for name in self.names]
+
+    def rows(self):
+        return [self.row(i) for i in range(self.n_states)]
+
+    def twiss(self, node_id):
+        """Return the Twiss parameters at the node entrance."""
+        return self.row(self.indices(node_id)[0])
+
+    def window_max(self, name, lo, hi):
+        """Return the maximum of column `name` over states lo, ..., hi - 1."""
+        if hi <= lo:
+            raise ValueError("Empty window.")
+        levels = self._max_tables[name]
+        k = 0
+        while 2 ** (k + 1) <= hi - lo:
+            k += 1
+        return max(levels[k][lo], levels[k][hi - 2 ** k])
+
+
+class TreeTracker:
+    """Incremental tracking for `PhaseController` (the 'tree' tracking mode).
+
+    The transfer map probe is run once. The map of each element is extracted
+    from the trajectory (M_i = C_i * inv(C_{i-1}), where C_i is the cumulative
+    map at state i) and stored in a `lattice.MapTree`. After a quadrupole
+    field change, only the maps of that quadrupole are recomputed.
+
+    The Twiss parameters at each state are kept by column and filled on
+    demand by propagating the Twiss parameters through the element maps. A
+    field change only forgets the states downstream of the changed quad, so
+    an optimizer that varies a few quads near the end of the lattice only
+    recomputes the states after them (and only up to the last state it asks
+    for). A single node that is not filled yet comes from a prefix product
+    of the tree, which costs O(log N) products.
+
+    The quadrupole pieces are thick quads; the ratio k / B of each piece is
+    calibrated from the extracted map, so the field polarity and rigidity
+    conventions of the online model are kept.
+    """
+
+    names = ["mu_x", "mu_y", "alpha_x", "alpha_y", "beta_x", "beta_y"]
+
+    def __init__(self, controller):
+        self.controller = controller
+        tracker = AlgorithmFactory.createTransferMapTracker(controller.sequence)
+        probe = ProbeFactory.getTransferMapProbe(controller.sequence, tracker)
+        probe.setKineticEnergy(controller.kinetic_energy)
+        controller.scenario.setProbe(probe)
+        controller.scenario.run()
+        self.trajectory = probe.getTrajectory()
+        controller.scenario.setProbe(controller.probe)
+
+        states = self.trajectory.getStatesViaIndexer()
+        self.positions = [state.getPosition() for state in states]
+        maps = []
+        Cinv = lattice.identity()
+        for state in states:
+            M = state.getTransferMap().getFirstOrder()
+            C = [[M.getElem(k, l) for l in range(4)] for k in range(4)]
+            maps.append(lattice.matmul(C, Cinv))
+            Cinv = lattice.symplectic_inverse(C)
+        self.tree = lattice.MapTree(maps)
+
+        # Twiss parameters at each state; states 0, ..., n_valid - 1 are current.
+        self.columns = dict()
+        for name in self.names:
+            self.columns[name] = array("d", len(states) * [0.0])
+        self.n_valid = 0
+        self._indices = dict()
+        self.eps = 20e-5  # (arbitrary, as in `PhaseController.initialize_envelope`)
+
+        # Quadrupole pieces: (state index, length, k / B).
+        gamma = 1.0 + controller.kinetic_energy / probe.getSpeciesRestEnergy()
+        pc = probe.getSpeciesRestEnergy() * math.sqrt(gamma ** 2 - 1.0)
+        brho = 1e-9 * pc / lattice.SPEED_OF_LIGHT
+        self.quad_pieces = dict()
+        for quad_id in controller.quad_ids:
+            field = controller.get_field(quad_id, "model")
+            pieces = []
+            for i in self.trajectory.indicesForElement(quad_id):
+                length = self.positions[i] - (self.positions[i - 1] if i > 0 else 0.0)
+                if length < 1e-9:
+                    continue
+                ratio = self._calibrate(maps[i], length, field, brho)
+                pieces.append((i, length, ratio))
+            self.quad_pieces[quad_id] = pieces
+
+    @staticmethod
+    def _calibrate(M, length, field, brho):
+        """Return k / B for a thick quad map M, or 1 / brho if field is ~0."""
+        if abs(field) < 1e-6:
+            return 1.0 / brho
+        c = M[0][0]
+        if c <= 1.0:
+            k = (math.acos(clip(c, -1.0, 1.0)) / length) ** 2
+        else:
+            k = -(math.log(c + math.sqrt(c ** 2 - 1.0)) / length) ** 2
+        return k / field
+
+    def invalidate(self, i=0):
+        """Forget the Twiss parameters at states i, i + 1, ..."""
+        self.n_valid = min(self.n_valid, i)
+
+    def set_field(self, quad_id, field):
+        for i, length, ratio in self.quad_pieces.get(quad_id, []):
+            self.tree.update(i, lattice.quad_matrix(length, ratio * field))
+            self.invalidate(i)
+
+    def indices(self, node_id):
+        """Return the first and last state index of the node."""
+        if node_id not in self._indices:
+            indices = self.trajectory.indicesForElement(node_id)
+            self._indices[node_id] = (indices[0], indices[-1])
+        return self._indices[node_id]
+
+    def _fill(self, hi):
+        """Compute the Twiss parameters at the states before `hi`."""
+        lo = self.n_valid
+        if hi <= lo:
+            return
+        init_twiss = self.controller.init_twiss
+        for k, plane in [(0, "x"), (2, "y")]:
+            mus = self.columns["mu_" + plane]
+            alphas = self.columns["alpha_" + plane]
+            betas = self.columns["beta_" + plane]
+            if lo == 0:
+                mu = 0.0
+                alpha = init_twiss["alpha_" + plane]
+                beta = init_twiss["beta_" + plane]
+            else:
+                mu, alpha, beta = mus[lo - 1], alphas[lo - 1], betas[lo - 1]
+            gamma = (1.0 + alpha ** 2) / beta
+            for i in range(lo, hi):
+                M = self.tree.get(i)
+                m11, m12 = M[k][k], M[k][k + 1]
+                m21, m22 = M[k + 1][k], M[k + 1][k + 1]
+                mu = (mu + math.atan2(m12, m11 * beta - m12 * alpha)) % (2.0 * math.pi)
+                beta, alpha, gamma = (
+                    m11 * m11 * beta - 2.0 * m11 * m12 * alpha + m12 * m12 * gamma,
+                    -m11 * m21 * beta + (m11 * m22 + m12 * m21) * alpha
+                    - m12 * m22 * gamma,
+                    m21 * m21 * beta - 2.0 * m21 * m22 * alpha + m22 * m22 * gamma,
+                )
+                mus[i], alphas[i], betas[i] = mu, alpha, beta
+        self.n_valid = hi
+
+    def row(self, i):
+        return [self.columns[name][i] for name in self.names] + [self.eps, self.eps]
+
+    def twiss(self, node_id):
+        """Return the Twiss parameters at the node entrance."""
+        i = self.indices(node_id)[0]
+        if i < self.n_valid:
+            return self.row(i)
+        M = self.tree.prefix(i + 1)
+        params = lattice.twiss_from_map(M, self.controller.init_twiss)
+        return params + [self.eps, self.eps]
+
+    def tracked_twiss(self, lo=None, hi=None):
+        """Return the Twiss parameters at states lo, ..., hi - 1."""
+        lo = 0 if lo is None else lo
+        hi = len(self.positions) if hi is None else hi
+        self._fill(hi)
+        return [self.row(i) for i in range(lo, hi)]
+
+    def window_max(self, name, lo, hi):
+        """Return the maximum of column `name` over states lo, ..., hi - 1."""
+        if hi <= lo:
+            raise ValueError("Empty window.")
+        self._fill(hi)
+        return max(self.columns[name][lo:hi])
 
 
 class PhaseController:
@@ -239,13 +661,15 @@ class PhaseController:
         kinetic_energy=1e9,
         sync_mode="live",
         connect=True,
+        track_cache_size=64,
+        field_quantum=1e-6,
     ):
         self.pvlgr_remote = RemoteLoggingCenter()
         self.connect = connect
         self.ref_ws_id = ref_ws_id
-        self.accelerator = XMLDataManager.loadDefaultAccelerator()
-        self.sequence = self.accelerator.getComboSequence("RTBT")
-        self.scenario = Scenario.newScenarioFor(self.sequence)
+        self.accelerator = accelerator_registry.get_accelerator()
+        self.sequence = accelerator_registry.get_sequence("RTBT")
+        self.scenario = accelerator_registry.new_scenario("RTBT")
         self.sync_mode = safe_sync(self.scenario, sync_mode)
         self.tracker = AlgorithmFactory.createEnvelopeTracker(self.sequence)
         self.tracker.setUseSpacecharge(False)
@@ -253,6 +677,12 @@ class PhaseController:
         self.probe.setBeamCurrent(0.0)
         self.scenario.setProbe(self.probe)
         self.trajectory = None
+        self._tmat_table = None
+        self.tree_tracker = None
+        self.track_cache = None
+        self.optimizer_tracking = "tree"
+        self.field_quantum = field_quantum
+        self.pvloggerid = None
         self.default_betas_at_target = None
         self.default_field_strengths = None
         self.set_kinetic_energy(kinetic_energy)
@@ -287,6 +717,10 @@ class PhaseController:
                 if ps_id == ind_ps_id and quad_id != ind_quad_id:
                     self.shared_power.setdefault(ind_quad_id, []).append(quad_id)
 
+        # Cache of tracked Twiss tables. The key is the quantized model field
+        # vector, the kinetic energy and the initial Twiss parameters.
+        self.track_cache = LRUCache(track_cache_size)
+
         # Connect to B_Book channels. These need to be changed at the same time as
         # the field settings, else the machine will trip.
         if self.connect:
@@ -295,6 +729,11 @@ class PhaseController:
                 channel = ps_node.findChannel(MagnetMainSupply.FIELD_BOOK_HANDLE)
                 self.book_channels[quad_id] = channel
 
+        # Serve live and book field reads from CA monitors.
+        self.field_cache = None
+        if self.connect:
+            self.field_cache = FieldCache.for_controller(self)
+
         # Determine upper and lower bounds on power supplies.
         if self.connect:
             self.ps_lb, self.ps_ub = [], []
@@ -352,6 +791,29 @@ class PhaseController:
 
         self.set_current_optics_as_default()
 
+    def clone(self):
+        """Return an independent controller with the same model state.
+
+        The copy has its own scenario, so it can be tracked on another thread.
+        It does not connect to the machine. The model fields of all quads, the
+        initial Twiss parameters, the power supply limits and the default
+        optics are copied; the rest of the model is synced to the same
+        PVLoggerID (or the design values).
+        """
+        controller = PhaseController(
+            self.ref_ws_id, self.kinetic_energy, sync_mode="design", connect=False
+        )
+        if self.pvloggerid is not None:
+            controller.sync_model_pvloggerid(self.pvloggerid)
+        controller.set_init_twiss(**self.init_twiss)
+        controller.ps_lb, controller.ps_ub = list(self.ps_lb), list(self.ps_ub)
+        for quad_id in self.quad_ids:
+            controller.set_field(quad_id, self.get_field(quad_id, "model"), "model")
+        controller.default_fields = list(self.default_fields)
+        controller.default_betas_at_target = list(self.default_betas_at_target)
+        controller.track()
+        return controller
+
     def snapshot(self, comment="no comment"):
         """Take a snapshot of the machine and return the PV Logger ID.
         
@@ -362,16 +824,24 @@ class PhaseController:
 
     def sync_model_pvloggerid(self, pvloggerid):
         """Sync the model with the machine state from a PVLoggerID."""
-        pvl_data_source = PVLoggerDataSource(pvloggerid)
-        self.scenario = pvl_data_source.setModelSource(self.sequence, self.scenario)
+        self.scenario = pvlogger_cache.set_model_source(
+            pvloggerid, self.sequence, self.scenario
+        )
         self.scenario.resync()
+        self.pvloggerid = pvloggerid
+        self._tmat_table = None
+        if self.track_cache is not None:
+            self.track_cache.clear()
+        self._reset_tree_tracker()
         self.track()
 
     def set_kinetic_energy(self, kinetic_energy):
         """Set the probe kinetic energy [eV]."""
         self.kinetic_energy = kinetic_energy
         self.probe.setKineticEnergy(kinetic_energy)
+        self._tmat_table = None
         self.set_init_twiss(*self.matched_init_twiss())
+        self._reset_tree_tracker()
         if self.trajectory is not None:
             self.track()
             self.default_betas_at_target = self.beta_funcs("RTBT:Tgt")
@@ -390,6 +860,8 @@ class PhaseController:
             "beta_x": beta_x,
             "beta_y": beta_y,
         }
+        if self.tree_tracker is not None:
+            self.tree_tracker.invalidate()
 
     def initialize_envelope(self):
         """Reset the envelope probe to the start of the lattice."""
@@ -405,24 +877,104 @@ class PhaseController:
         twiss_z = Twiss(0, 1, 0)
         self.probe.initFromTwiss([twiss_x, twiss_y, twiss_z])
 
+    def set_tracking(self, mode):
+        """Set the tracking mode.
+
+        mode : {'full', 'tree'}
+            'full': `track` runs the envelope probe through the whole lattice.
+            'tree': Twiss parameters come from a `TreeTracker`; a field change
+            only recomputes the maps of the changed quadrupole and forgets the
+            Twiss parameters downstream of it, and `track` does nothing. This
+            is much faster in optimizer loops that change a few quads at a
+            time.
+
+        The optimizers (`set_ref_ws_phases`, `constrain_size_on_target` and
+        `set_target_phases`) switch to `self.optimizer_tracking` ('tree' by
+        default) while they run and track the result in 'full' mode.
+        """
+        if mode not in ["full", "tree"]:
+            raise ValueError("mode must be in {'full', 'tree'}")
+        if mode == "tree":
+            self.tree_tracker = TreeTracker(self)
+            self.positions = self.tree_tracker.positions
+        else:
+            self.tree_tracker = None
+            self.track()
+
+    def _optimize(self, solve):
+        """Return `solve()`, run in `self.optimizer_tracking` mode.
+
+        If the mode was switched, it is switched back to 'full' afterwards,
+        which tracks the final model.
+        """
+        switch = self.optimizer_tracking == "tree" and self.tree_tracker is None
+        if switch:
+            self.set_tracking("tree")
+        try:
+            return solve()
+        finally:
+            if switch:
+                self.set_tracking("full")
+
+    def _reset_tree_tracker(self):
+        if self.tree_tracker is not None:
+            self.tree_tracker = TreeTracker(self)
+            self.positions = self.tree_tracker.positions
+
     def track(self):
-        """Return the envelope trajectory through the lattice."""
+        """Return the envelope trajectory through the lattice.
+
+        In 'tree' tracking mode the envelope is not tracked (the map tree is
+        already up to date) and the last trajectory is returned.
+        """
+        if self.tree_tracker is not None:
+            return self.trajectory
+        key = None
+        if self.track_cache is not None:
+            key = self.track_key()
+            cached = self.track_cache.get(key)
+            if cached is not None:
+                self.trajectory, self.calculator, self.states, self.twiss_table = cached
+                self.positions = list(self.twiss_table.columns["position"])
+                return self.trajectory
         self.initialize_envelope()
         self.scenario.run()
         self.trajectory = self.probe.getTrajectory()
         self.calculator = CalculationsOnBeams(self.trajectory)
         self.states = self.trajectory.getStatesViaIndexer()
         self.positions = [state.getPosition() for state in self.states]
+        params = [compute_twiss(state, self.calculator) for state in self.states]
+        self.twiss_table = TwissTable(self.trajectory, params, self.positions)
+        if key is not None:
+            cached = (self.trajectory, self.calculator, self.states, self.twiss_table)
+            self.track_cache.put(key, cached)
         return self.trajectory
 
+    def track_key(self):
+        """Return the cache key of the current model state for `track`."""
+        fields = self.get_fields(self.quad_ids, "model")
+        quantized = tuple([int(round(field / self.field_quantum)) for field in fields])
+        init_twiss = tuple(
+            [self.init_twiss[key] for key in ["alpha_x", "alpha_y", "beta_x", "beta_y"]]
+        )
+        return (quantized, self.kinetic_energy, init_twiss)
+
+    def track_cache_info(self):
+        """Return (hits, misses, size) of the tracking cache."""
+        cache = self.track_cache
+        return cache.hits, cache.misses, len(cache)
+
     def tracked_twiss(self):
         """Return the Twiss parameters at each state in trajectory."""
-        return [compute_twiss(state, self.calculator) for state in self.states]
+        if self.tree_tracker is not None:
+            return self.tree_tracker.tracked_twiss()
+        return self.twiss_table.rows()
 
     def twiss(self, node_id):
         """Return the Twiss parameters at the node entrance."""
-        state = self.trajectory.statesForElement(node_id)[0]
-        return compute_twiss(state, self.calculator)
+        if self.tree_tracker is not None:
+            return self.tree_tracker.twiss(node_id)
+        return self.twiss_table.twiss(node_id)
 
     def phases(self, node_id):
         """Return the phase advances (mod 2pi) at the node entrance."""
@@ -438,52 +990,103 @@ class PhaseController:
         Setting start=None starts tracks from the beginning of the lattice.
         Setting stop=None tracks through the end of the lattice.
         """
-        lo = None if start is None else self.trajectory.indicesForElement(start)[0]
-        hi = None if stop is None else self.trajectory.indicesForElement(stop)[-1]
-        beta_xs, beta_ys = [], []
-        for params in self.tracked_twiss()[lo:hi]:
-            mu_x, mu_y, alpha_x, alpha_y, beta_x, beta_y, eps_x, eps_y = params
-            beta_xs.append(beta_x)
-            beta_ys.append(beta_y)
-        return max(beta_xs), max(beta_ys)
+        table = self.twiss_table
+        if self.tree_tracker is not None:
+            table = self.tree_tracker
+        lo = 0 if start is None else table.indices(start)[0]
+        hi = len(self.positions) if stop is None else table.indices(stop)[1]
+        return table.window_max("beta_x", lo, hi), table.window_max("beta_y", lo, hi)
+
+    def transfer_matrix_table(self):
+        """Return a `TransferMatrixTable` for the current model.
+
+        The transfer map probe is run once; the table is kept until the model
+        changes (field, energy or PVLoggerID).
+        """
+        if self._tmat_table is None:
+            tracker = AlgorithmFactory.createTransferMapTracker(self.sequence)
+            probe = ProbeFactory.getTransferMapProbe(self.sequence, tracker)
+            probe.setKineticEnergy(self.kinetic_energy)
+            self.scenario.setProbe(probe)
+            self.scenario.run()
+            node_ids = [node.getId() for node in self.sequence.getNodes()]
+            self._tmat_table = TransferMatrixTable(probe.getTrajectory(), node_ids)
+            # Reset the PhaseController scenario to the EnvelopeProbe.
+            self.scenario.setProbe(self.probe)
+        return self._tmat_table
 
     def transfer_matrix(self, start_node_id=None, stop_node_id=None):
         """Compute the transfer matrix between two nodes."""
-        # Set start and stop node if None is provided.
-        if start_node_id is None:
-            start_node_id = self.sequence.getNodes()[0].getId()
-        if stop_node_id is None:
-            stop_node_id = self.sequence.getNodes()[-1].getId()
-        # Check if the nodes are in order. If they are not, flip them and
-        # remember to take the inverse at the end.
-        reverse = False
-        node_ids = [node.getId() for node in self.sequence.getNodes()]
-        if node_ids.index(start_node_id) > node_ids.index(stop_node_id):
-            start_node_id, stop_node_id = stop_node_id, start_node_id
-            reverse = True
-        # Set up transfer matrix probe.
-        tracker = AlgorithmFactory.createTransferMapTracker(self.sequence)
-        probe = ProbeFactory.getTransferMapProbe(self.sequence, tracker)
-        probe.setKineticEnergy(self.kinetic_energy)
-        self.scenario.setProbe(probe)
-        # Compute the transfer matrix.
-        self.scenario.run()
-        trajectory = probe.getTrajectory()
-        state1 = trajectory.stateForElement(start_node_id)
-        state2 = trajectory.stateForElement(stop_node_id)
-        M1 = state1.getTransferMap().getFirstOrder()
-        M2 = state2.getTransferMap().getFirstOrder()
-        M = M2.times(M1.inverse())
-        if reverse:
-            M = M.inverse()
-        # Convert JAMA matrix to list of shape (4, 4).
-        M = list_from_xal_matrix(M)
-        M = [row[:4] for row in M[:4]]
-        # Reset the PhaseController scenario to the EnvelopeProbe.
-        self.scenario.setProbe(self.probe)
-        return M
+        return self.transfer_matrix_table().get(start_node_id, stop_node_id)
+
+    def match(self, quad_ids, residuals, guess, bounds, max_iter=25, verbose=0):
+        """Vary quadrupole fields to minimize a residual vector.
+
+        Uses the Levenberg-Marquardt method with the fields clipped to the
+        bounds. The Jacobian is computed by forward differences from the
+        residuals of the last step, so each iteration costs len(quad_ids) + 1
+        tracks. The tracks are much cheaper
+        in 'tree' tracking mode (see `set_tracking`); in 'full' mode, repeated
+        field vectors are served by the tracking cache.
+
+        Parameters
+        ----------
+        quad_ids : list[str]
+            Ids of the quads to vary.
+        residuals : callable
+            `residuals()` returns the residual vector for the tracked model.
+        guess : list[float]
+            Initial fields [T/m].
+        bounds : 2-tuple of list
+            Lower and upper bounds on the fields.
+        max_iter : int
+            Maximum number of Levenberg-Marquardt steps.
+        verbose : int
+            Passed to `least_squares.levenberg_marquardt`.
+
+        Returns
+        -------
+        list[float]
+            The optimal fields. The model is left at these fields.
+        """
+        lb, ub = bounds
+        last = dict()
 
-    def set_ref_ws_phases(self, mu_x, mu_y, beta_lims=(40, 40), verbose=0, guess=None):
+        def fun(fields):
+            self.set_fields(quad_ids, fields, "model")
+            self.track()
+            r = residuals()
+            last["fields"], last["residuals"] = list(fields), r
+            return r
+
+        def jac(fields):
+            # `levenberg_marquardt` has just evaluated the residuals at `fields`.
+            if last.get("fields") == list(fields):
+                r0 = last["residuals"]
+            else:
+                r0 = fun(fields)
+            columns = []
+            for j, field in enumerate(fields):
+                step = 1e-4 * max(abs(field), 1.0)
+                if field + step > ub[j]:
+                    step = -step
+                fields_step = list(fields)
+                fields_step[j] += step
+                r = fun(fields_step)
+                columns.append([(ri - r0i) / step for ri, r0i in zip(r, r0)])
+            return transpose(columns)
+
+        guess = [clip(x, lo, hi) for x, lo, hi in zip(guess, lb, ub)]
+        fields, cost, itn = levenberg_marquardt(
+            fun, jac, guess, bounds=bounds, max_iter=max_iter, verbose=verbose
+        )
+        self.set_fields(quad_ids, fields, "model")
+        self.track()
+        return fields
+
+    def set_ref_ws_phases(
+        self, mu_x, mu_y, beta_lims=(40, 40), verbose=0, guess=None, method="simplex"
+    ):
         """Set the phase advances at the reference wire-scanner.
 
         The initial guess given to the solver is `self.default_field_strengths`. The
@@ -497,12 +1100,15 @@ class PhaseController:
             Maximum beta functions to allow from QH02 to WS24.
         verbose : int
             If greater than zero, print a before/after summary.
+        method : {'simplex', 'lm'}
+            'simplex': OpenXAL simplex search on a scalar cost.
+            'lm': Levenberg-Marquardt on the residual vector (see `match`).
             
         Returns
         -------
         fields : list[float],
             The correct field strengths for the independent quadrupoles that 
-            were varied. 
+            were varied. The model is left at these fields.
         """
 
         class MyScorer(Scorer):
@@ -538,8 +1144,22 @@ class PhaseController:
         bounds = (lb, ub)
         if guess is None:
             guess = self.default_fields[lo : hi + 1]
-        self.restore_default_optics()
-        fields = minimize(scorer, guess, var_names, bounds)
+
+        def residuals():
+            residuals = phase_diffs(self.phases(self.ref_ws_id), [mu_x, mu_y])
+            for max_beta, beta_lim in zip(self.max_betas(), beta_lims):
+                residuals.append(clip(max_beta - beta_lim, 0))
+            return residuals
+
+        def solve():
+            self.restore_default_optics()
+            if method == "lm":
+                return self.match(var_names, residuals, guess, bounds)
+            fields = minimize(scorer, guess, var_names, bounds)
+            self.set_fields(var_names, fields, "model")
+            return fields
+
+        fields = self._optimize(solve)
         if verbose > 0:
             print("  Desired phases : {:.3f}, {:.3f}".format(mu_x, mu_y))
             print(
@@ -591,8 +1211,12 @@ class PhaseController:
         var_names = ["B26", "B27", "B28", "B29", "B30"]
         init_fields = self.get_fields(self.ind_quad_ids[-5:], "model")
         bounds = (self.ps_lb[-5:], self.ps_ub[-5:])
-        fields = minimize(scorer, init_fields, var_names, bounds)
-        self.set_fields(self.ind_quad_ids[-5:], fields, "model")
+
+        def solve():
+            fields = minimize(scorer, init_fields, var_names, bounds)
+            self.set_fields(self.ind_quad_ids[-5:], fields, "model")
+
+        self._optimize(solve)
         if verbose > 0:
             print(
                 "  Desired betas: {:.3f}, {:.3f}".format(*self.default_betas_at_target)
@@ -610,6 +1234,7 @@ class PhaseController:
         default_target_betas,
         target_beta_frac_tol,
         guess=None,
+        method="simplex",
     ):
         """Set the phase advances at the target.
 
@@ -625,6 +1250,19 @@ class PhaseController:
             The default beta functions at the target.
         target_beta_frac_tol : float
             Fractional tolerance for target beta functions.
+        guess : list[float], optional
+            Initial fields. The default is the current model fields.
+        method : {'simplex', 'lm'}
+            'simplex': OpenXAL simplex search on a scalar cost.
+            'lm': Levenberg-Marquardt on the residual vector (see `match`).
+            The target beta functions are then penalized by their distance
+            outside the tolerance band, which is smooth in the fields.
+
+        Returns
+        -------
+        fields : list[float]
+            The fields of the independent quads from QH18 to QH30. The model
+            is left at these fields.
         """
 
         class MyScorer(Scorer):
@@ -679,7 +1317,27 @@ class PhaseController:
         bounds = (lb, ub)
         if guess is None:
             guess = self.get_fields(quad_ids, "model")
-        minimize(scorer, guess, var_names, bounds)
+
+        def residuals():
+            residuals = phase_diffs(self.phases("RTBT:Tgt"), [mux, muy])
+            for beta in self.max_betas("RTBT_Mag:QH18", "RTBT_Diag:WS24"):
+                residuals.append(clip(beta - beta_max_before_ws24, 0.0))
+            for beta in self.max_betas("RTBT_Diag:WS24", "RTBT:Tgt"):
+                residuals.append(clip(beta - beta_max_after_ws24, 0.0))
+            target_betas = self.beta_funcs("RTBT:Tgt")
+            for beta, beta0 in zip(target_betas, default_target_betas):
+                excess = abs(beta - beta0) - target_beta_frac_tol * abs(beta0)
+                residuals.append(clip(excess, 0.0))
+            return residuals
+
+        def solve():
+            if method == "lm":
+                return self.match(quad_ids, residuals, guess, bounds)
+            fields = minimize(scorer, guess, var_names, bounds)
+            self.set_fields(quad_ids, fields, "model")
+            return fields
+
+        return self._optimize(solve)
 
     def get_field(self, quad_id, opt="model"):
         """Return quadrupole field strength [T/m].
@@ -690,10 +1348,17 @@ class PhaseController:
             'model': value from online model
             'live' : live readback value 
             'book' : book setting
+            The 'live' and 'book' values come from the monitored field cache
+            when connected (see `field_cache.FieldCache`). Channels that the
+            cache does not monitor are read directly.
         """
         node = self.sequence.getNodeWithId(quad_id)
+        cache = self.field_cache
+        cached = cache is not None and cache.covers([quad_id], opt)
         if opt == "model":
             return self.scenario.elementsMappedTo(node)[0].getMagField()
+        elif opt in ["live", "book"] and cached:
+            return cache.get(quad_id, opt)
         elif opt == "live":
             return node.getField()
         elif opt == "book":
@@ -713,8 +1378,11 @@ class PhaseController:
         """
         node = self.sequence.getNodeWithId(quad_id)
         if opt == "model":
+            self._tmat_table = None
             for elem in self.scenario.elementsMappedTo(node):
                 elem.setMagField(field)
+            if self.tree_tracker is not None:
+                self.tree_tracker.set_field(quad_id, field)
             if quad_id in self.shared_power:
                 for dep_quad_id in self.shared_power[quad_id]:
                     self.set_field(dep_quad_id, field, "model")
@@ -722,6 +1390,8 @@ class PhaseController:
             node.setField(field)
         elif opt == "book":
             self.book_channels[quad_id].putVal(node.toCAFromField(field))
+            if self.field_cache is not None:
+                self.field_cache.update(quad_id, "book", field)
         else:
             raise ValueError("opt must be in {'model', 'live', 'book'}")
 
@@ -733,6 +1403,9 @@ class PhaseController:
         max_frac_change=0.01,
         max_iters=100,
         sleep_time=0.5,
+        settle_tol=0.002,
+        min_step_time=0.0,
+        channels=None,
     ):
         """Set the field of each quadrupole in the list.
         
@@ -751,42 +1424,48 @@ class PhaseController:
             are thrown when the book values are changed, which will occur if 
             the change is beyond 5%. We found 1% to be a safe value.
         max_iters : int
-            Maximum iterations when stepping the quads. This is just so the while
-            loop is guaranteed to terminate; it will never be approached.
+            Maximum number of limited steps per quad (see `ramp.plan_ramp`).
         sleep_time : float
-            Time to pause between field updates [seconds]. We found 0.5 seconds
-            to be a safe value.
+            Maximum time to wait for the readbacks to settle after each step
+            [seconds]. There is no minimum wait: the next step is put as soon
+            as the readbacks are within `settle_tol` of the setpoints. If this
+            time expires first, the book values are read again and the rest of
+            the ramp is planned from them (see `ramp.ramp_fields`), so each put
+            stays within `max_frac_change` of the actual book value.
+        settle_tol : float
+            Fractional tolerance for the readbacks to count as settled.
+        min_step_time : float
+            Minimum time between consecutive steps [seconds], even if the
+            readbacks settle sooner. Set it to 0.5 to keep the old fixed
+            spacing.
+        channels : ramp.XalQuadChannels or ramp.SimulatedQuadChannels
+            Channel layer used for 'live'. Defaults to the machine channels.
         """
         if opt == "model":
             for quad_id, field in zip(quad_ids, fields):
                 self.set_field(quad_id, field, "model")
         elif opt == "live":
             if sleep_time < 0.5:
-                warnings.warn("sleep_time < 0.5 seconds... may trip MPS.")
+                warnings.warn(
+                    "sleep_time < 0.5 seconds... readbacks may not settle "
+                    "in time, and the ramp will be re-planned."
+                )
             if max_frac_change > 0.01:
                 warnings.warn("max_frac_change > 0.01... may trip MPS.")
-            # Move all quad fields close enough to the desired values to
-            # avoid tripping MPS...
-            stop, iters = False, 0
-            while not stop and iters < max_iters:
-                stop, iters = True, iters + 1
-                for quad_id, field in zip(quad_ids, fields):
-                    book = self.get_field(quad_id, "book")
-                    change_needed = field - book
-                    max_abs_change = max_frac_change * abs(book)
-                    if abs(change_needed) > max_abs_change:
-                        stop = False
-                        if change_needed >= 0.0:
-                            new_field = book + max_abs_change
-                        else:
-                            new_field = book - max_abs_change
-                        self.set_field(quad_id, new_field, "book")
-                        self.set_field(quad_id, new_field, "live")
-                time.sleep(sleep_time)
-            # ... and then set them to the desired values.
-            for quad_id, field in zip(quad_ids, fields):
-                self.set_field(quad_id, field, "book")
-                self.set_field(quad_id, field, "live")
+            # Step all quads together, each by at most `max_frac_change`, to
+            # avoid tripping MPS.
+            if channels is None:
+                channels = ramp.XalQuadChannels(self)
+            ramp.ramp_fields(
+                channels,
+                quad_ids,
+                fields,
+                max_frac_change=max_frac_change,
+                max_steps=max_iters,
+                settle_tol=settle_tol,
+                timeout=sleep_time,
+                min_dwell=min_step_time,
+            )
 
     def set_current_optics_as_default(self):
         """Store the current machine state as the default state.
@@ -832,8 +1511,10 @@ class PhaseController:
         # Get default phase advances without changing current state.
         model_fields = self.get_fields(self.ind_quad_ids, "model")
         self.restore_default_optics("model")
+        self.track()
         mux0, muy0 = self.phases(self.ref_ws_id)
         self.set_fields(self.ind_quad_ids, model_fields, "model")
+        self.track()
 
         n = int(n_steps) // 2
         phase_coverage = radians(phase_coverage)
@@ -852,6 +1533,14 @@ class PhaseController:
         return phases
 
 
+def phase_diffs(phases, target_phases):
+    """Return phases - target_phases, wrapped to [-pi, pi)."""
+    return [
+        (phase - target + math.pi) % (2.0 * math.pi) - math.pi
+        for phase, target in zip(phases, target_phases)
+    ]
+
+
 def lin_phase_range(mu_min, mu_max, n_steps, endpoint=True):
     """Step the phase advance between mu_min and mu_max, shifting to keep
     all values within [0, 2pi]."""
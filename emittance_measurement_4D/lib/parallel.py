@@ -0,0 +1,122 @@
+"""Run independent tasks in parallel.
+
+Under Jython there is no global interpreter lock, so Java threads run Python
+code in parallel. Under CPython, thread pools run the tasks one after another
+and process pools use `multiprocessing`.
+"""
+try:
+    from java.lang import Runtime
+    from java.util.concurrent import Callable
+    from java.util.concurrent import Executors
+
+    JAVA_THREADS = True
+except ImportError:
+    JAVA_THREADS = False
+
+
+def cpu_count():
+    """Return the number of available processors."""
+    if JAVA_THREADS:
+        return Runtime.getRuntime().availableProcessors()
+    import multiprocessing
+
+    return multiprocessing.cpu_count()
+
+
+def default_workers():
+    """Return the default number of workers for pools of independent trials.
+
+    This is one per processor under Jython, where the workers are cheap
+    threads, and one (no pool) under CPython.
+    """
+    if JAVA_THREADS:
+        return cpu_count()
+    return 1
+
+
+if JAVA_THREADS:
+
+    class _Task(Callable):
+        def __init__(self, func, item):
+            self.func = func
+            self.item = item
+
+        def call(self):
+            return self.func(self.item)
+
+
+class WorkerPool:
+    """A pool of workers that can be reused for several `map` calls.
+
+    Under Jython the workers are Java threads. Under CPython they are
+    processes if `processes` is True; otherwise the tasks run one after
+    another. With fewer than two workers the tasks always run one after
+    another in the calling thread.
+
+    Use `close` (or a `with` block) to stop the workers.
+    """
+
+    def __init__(self, n_workers=None, processes=False):
+        if n_workers is None:
+            n_workers = cpu_count()
+        self.n_workers = n_workers
+        self.pool = None
+        if n_workers < 2:
+            return
+        if JAVA_THREADS:
+            self.pool = Executors.newFixedThreadPool(n_workers)
+        elif processes:
+            import multiprocessing
+
+            self.pool = multiprocessing.Pool(n_workers)
+
+    def map(self, func, items):
+        """Return [func(item) for item in items], in the order of `items`.
+
+        `func` must not modify shared state. For a process pool, `func`, the
+        items and the results must be picklable (`func` must be defined at the
+        top level of a module).
+        """
+        items = list(items)
+        if self.pool is None or len(items) < 2:
+            return [func(item) for item in items]
+        if JAVA_THREADS:
+            futures = self.pool.invokeAll([_Task(func, item) for item in items])
+            return [future.get() for future in futures]
+        return self.pool.map(func, items)
+
+    def close(self):
+        if self.pool is None:
+            return
+        if JAVA_THREADS:
+            self.pool.shutdown()
+        else:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def map_threads(func, items, n_workers=None):
+    """Return [func(item) for item in items], computed on parallel threads.
+
+    The threads only run in parallel under Jython.
+    """
+    items = list(items)
+    with WorkerPool(min(n_workers or cpu_count(), len(items))) as pool:
+        return pool.map(func, items)
+
+
+def map_processes(func, items, n_workers=None):
+    """Return [func(item) for item in items], computed on parallel workers.
+
+    Same as `map_threads` under Jython; a process pool under CPython.
+    """
+    items = list(items)
+    with WorkerPool(min(n_workers or cpu_count(), len(items)), processes=True) as pool:
+        return pool.map(func, items)
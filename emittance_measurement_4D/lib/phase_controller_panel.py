@@ -1,5 +1,6 @@
 """This panel controls the RTBT optics."""
 from __future__ import print_function
+import threading
 
 from java.awt import BorderLayout
 from java.awt import Color
@@ -23,13 +24,17 @@ from javax.swing import JScrollPane
 from javax.swing import JTable
 from javax.swing import JTabbedPane
 from javax.swing import JTextField
+from javax.swing import SwingUtilities
+from javax.swing import SwingWorker
 from javax.swing import JFormattedTextField
 from javax.swing.event import CellEditorListener
 from javax.swing.table import AbstractTableModel
 from java.text import NumberFormat
 
 import optics
+import phase_lookup
 import plotting as plt
+from scan_planner import ScanOpticsPlanner
 import utils
 
 
@@ -72,6 +77,8 @@ class PhaseControllerPanel(JPanel):
         self.n_steps_text_field.setValue(10)
         self.scan_type_dropdown = JComboBox([1, 2])
         self.max_beta_text_field = JTextField("30.0")
+        self.n_workers_text_field = JTextField("1")
+        self.solver_dropdown = JComboBox(["lm", "simplex"])
         self.calculate_scan_optics_button = JButton("Calculate optics")
 
         # Action listeners
@@ -107,6 +114,8 @@ class PhaseControllerPanel(JPanel):
         row.setLayout(FlowLayout(FlowLayout.LEFT))
         row.add(JLabel("Ref. wire-scanner"))
         row.add(self.ref_ws_id_dropdown)
+        row.add(JLabel("Solver"))
+        row.add(self.solver_dropdown)
         scan_optics_panel.add(row, c)
 
         row = JPanel()
@@ -125,6 +134,8 @@ class PhaseControllerPanel(JPanel):
         row.add(self.n_steps_text_field)
         row.add(JLabel("Scan type"))
         row.add(self.scan_type_dropdown)
+        row.add(JLabel("Workers"))
+        row.add(self.n_workers_text_field)
         scan_optics_panel.add(row, c)
 
         c.weighty = 1.0
@@ -465,6 +476,40 @@ class TwissTableListener(CellEditorListener):
         print("Updated initial Twiss:", self.phase_controller.init_twiss)
 
 
+class ScanOpticsWorker(SwingWorker):
+    """Solve the scan optics on a background thread.
+
+    The planner works on clones of the panel's controller, so the other
+    listeners can keep using the controller on the event thread. The progress
+    bar is updated on the event thread after each step, and the solved fields
+    are copied to the panel in `done`.
+    """
+
+    def __init__(self, panel, planner, phases):
+        self.panel = panel
+        self.planner = planner
+        self.phases = phases
+        self.n_done = 0
+        self.lock = threading.Lock()
+
+    def progress(self, scan_index):
+        with self.lock:
+            self.n_done += 1
+            n_done = self.n_done
+        SwingUtilities.invokeLater(lambda: self.panel.progress_bar.setValue(n_done))
+
+    def doInBackground(self):
+        return self.planner.plan(self.phases, progress=self.progress)
+
+    def done(self):
+        try:
+            self.panel.model_fields_list = self.get()
+        except Exception as exception:
+            print("Scan optics calculation failed: {}".format(exception))
+        self.panel.calculate_scan_optics_button.setEnabled(True)
+        self.panel.update_plots()
+
+
 class CalculateScanOpticsButtonListener(ActionListener):
     def __init__(self, panel):
         self.panel = panel
@@ -472,7 +517,13 @@ class CalculateScanOpticsButtonListener(ActionListener):
         self.ind_quad_ids = self.phase_controller.ind_quad_ids
 
     def actionPerformed(self, event):
-        """Calculate/store correct optics settings for each step in the scan."""
+        """Calculate/store correct optics settings for each step in the scan.
+
+        The steps are solved by a `ScanOpticsPlanner` on a background thread;
+        each step starts from the solution of the previous step. The planner
+        gets a clone of the controller (made here, on the event thread), so
+        the controller is never tracked from two threads.
+        """
         self.panel.model_fields_list = []
 
         # Start from the default optics.
@@ -485,6 +536,7 @@ class CalculateScanOpticsButtonListener(ActionListener):
         max_beta = float(self.panel.max_beta_text_field.getText())
         beta_lims = (max_beta, max_beta)
         scan_type = self.panel.scan_type_dropdown.getSelectedItem()
+        n_workers = int(self.panel.n_workers_text_field.getText())
         phases = self.phase_controller.get_phases_for_scan(
             phase_coverage, n_steps, scan_type
         )
@@ -496,42 +548,15 @@ class CalculateScanOpticsButtonListener(ActionListener):
         # Compute the optics needed for step in the scan.
         self.panel.progress_bar.setValue(0)
         self.panel.progress_bar.setMaximum(n_steps)
-
-        for scan_index, (mux, muy) in enumerate(phases):
-            # Set the model optics.
-            print("Scan index = {}/{}.".format(scan_index, n_steps - 1))
-            print("Setting phases at {}...".format(self.phase_controller.ref_ws_id))
-            self.phase_controller.set_ref_ws_phases(mux, muy, beta_lims, verbose=1)
-
-            # Constrain beam size on target if it's too far from the default.
-            beta_x_target, beta_y_target = self.phase_controller.beta_funcs("RTBT:Tgt")
-            beta_x_default, beta_y_default = self.phase_controller.default_betas_at_target
-            frac_change_x = abs(beta_x_target - beta_x_default) / beta_x_default
-            frac_change_y = abs(beta_y_target - beta_y_default) / beta_y_default
-            tol = 0.05
-            if frac_change_x > tol or frac_change_y > tol:
-                print("Setting betas at target...")
-                self.phase_controller.constrain_size_on_target(verbose=1)
-            max_betas_anywhere = self.phase_controller.max_betas(stop=None)
-            print("  Max betas anywhere: {:.3f}, {:.3f}.".format(*max_betas_anywhere))
-
-            # Save the model quadrupole strengths.
-            model_fields = []
-            for quad_id in self.ind_quad_ids:
-                field = self.phase_controller.get_field(quad_id, "model")
-                model_fields.append(field)
-
-            # Store the model fields.
-            self.panel.model_fields_list.append(model_fields)
-
-            # Update the panel progress bar. (This doesn't work currently;
-            # we would need to run on a separate thread.)
-            self.panel.progress_bar.setValue(scan_index + 1)
-            print()
-
-        # Put the model back to its original state.
-        self.phase_controller.restore_default_optics("model")
-        self.phase_controller.track()
+        planner = ScanOpticsPlanner(
+            self.phase_controller.clone(),
+            beta_lims,
+            target_beta_tol=0.05,
+            method=self.panel.solver_dropdown.getSelectedItem(),
+            n_workers=n_workers,
+        )
+        self.panel.calculate_scan_optics_button.setEnabled(False)
+        ScanOpticsWorker(self.panel, planner, phases).execute()
 
 
 class ScanSettingsListener(ActionListener):
@@ -585,8 +610,18 @@ class SetLiveOpticsButton2Listener(ActionListener):
             "mux0, muy0 = {}, {} [deg]".format(utils.degrees(mux0), utils.degrees(muy0))
         )
         print("mux, muy = {}, {} [deg]".format(utils.degrees(mux), utils.degrees(muy)))
-        print("Setting model phase advances...")
-        self.phase_controller.set_ref_ws_phases(mux, muy, verbose=2)
+        fields = None
+        grid = phase_lookup.find_grid(self.phase_controller)
+        if grid is not None:
+            print("Setting model phase advances from lookup grid...")
+            fields = phase_lookup.set_phase_offsets(
+                self.phase_controller, grid, delta_mux, delta_muy, verbose=1
+            )
+        if fields is None:
+            print("Setting model phase advances...")
+            self.phase_controller.set_ref_ws_phases(
+                mux, muy, verbose=2, method=self.panel.solver_dropdown.getSelectedItem()
+            )
 
         # Constrain the beam size on the target if it's too far from the default.
         beta_x_target, beta_y_target = self.phase_controller.beta_funcs("RTBT:Tgt")
@@ -0,0 +1,370 @@
+"""Lookup grid from phase advances at the reference wire-scanner to quad fields.
+
+`set_ref_ws_phases` runs an optimizer every time it is called. A
+`PhaseFieldGrid` is built offline for one reference wire-scanner and one
+machine state: the optics are solved (with `ScanOpticsPlanner`) on a regular
+grid of phase offsets (delta mu_x, delta mu_y) from the default optics, and the
+fields of QH18-QV19 and the five quads after WS24 are stored. A query
+interpolates the grid bilinearly and refines QH18-QV19 with a few
+Levenberg-Marquardt steps.
+
+Grids are saved in a small binary file: a fixed header, the id strings, then
+arrays of little-endian doubles.
+"""
+from __future__ import print_function
+from array import array
+import os
+import struct
+import sys
+
+from optics import phase_diffs
+from scan_planner import ScanOpticsPlanner
+from utils import linspace
+from utils import put_angle_in_range
+from utils import radians
+
+
+DEFAULT_DIR = os.path.join("_cache", "phase_lookup")
+MAGIC = b"PFG1"
+HEADER = "<4sIIIddd"
+
+
+def _write_string(file, string):
+    data = string.encode("ascii")
+    file.write(struct.pack("<I", len(data)))
+    file.write(data)
+
+
+def _read_string(file):
+    (size,) = struct.unpack("<I", file.read(4))
+    return str(file.read(size).decode("ascii"))
+
+
+def _write_doubles(file, values):
+    values = array("d", values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    file.write(struct.pack("<I", len(values)))
+    values.tofile(file)
+
+
+def _read_doubles(file):
+    (size,) = struct.unpack("<I", file.read(4))
+    values = array("d")
+    values.fromfile(file, size)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def state_label(controller):
+    """Return a label for the machine state of the controller model."""
+    if controller.pvloggerid is not None:
+        return "pvl{}".format(controller.pvloggerid)
+    return controller.sync_mode
+
+
+def filename(controller, directory=DEFAULT_DIR):
+    """Return the grid file for the controller's reference wire-scanner and state."""
+    ws_name = controller.ref_ws_id.replace(":", "-")
+    return os.path.join(directory, "{}_{}.bin".format(ws_name, state_label(controller)))
+
+
+class PhaseFieldGrid:
+    """Quad fields on a regular grid of phase offsets.
+
+    Attributes
+    ----------
+    ref_ws_id : str
+        The reference wire-scanner.
+    state : str
+        Machine state the grid was built for (see `state_label`).
+    kinetic_energy : float
+        Beam kinetic energy [eV].
+    phases0 : (mux0, muy0)
+        Phase advances at the reference wire-scanner in the default optics [rad].
+    default_fields : array
+        Default fields of all the independent quads [T/m].
+    quad_ids : list[str]
+        Ids of the stored quads.
+    dmux, dmuy : array
+        Phase offsets along each axis of the grid [rad].
+    fields : array
+        Flat array of stored fields; the fields at (dmux[i], dmuy[j]) start at
+        index (i * len(dmuy) + j) * len(quad_ids).
+    """
+
+    def __init__(
+        self,
+        ref_ws_id,
+        state,
+        kinetic_energy,
+        phases0,
+        default_fields,
+        quad_ids,
+        dmux,
+        dmuy,
+        fields,
+    ):
+        self.ref_ws_id = ref_ws_id
+        self.state = state
+        self.kinetic_energy = kinetic_energy
+        self.phases0 = tuple(phases0)
+        self.default_fields = array("d", default_fields)
+        self.quad_ids = list(quad_ids)
+        self.dmux = array("d", dmux)
+        self.dmuy = array("d", dmuy)
+        self.fields = array("d", fields)
+
+    def node(self, i, j):
+        """Return the stored fields at (dmux[i], dmuy[j])."""
+        n = len(self.quad_ids)
+        start = (i * len(self.dmuy) + j) * n
+        return self.fields[start : start + n]
+
+    def matches(self, controller, rtol=1e-6):
+        """Return True if the grid was built for the controller's default optics."""
+        if controller.ref_ws_id != self.ref_ws_id:
+            return False
+        if abs(controller.kinetic_energy - self.kinetic_energy) > 1.0:
+            return False
+        if len(controller.default_fields) != len(self.default_fields):
+            return False
+        for field, grid_field in zip(controller.default_fields, self.default_fields):
+            if abs(field - grid_field) > rtol * max(abs(grid_field), 1.0):
+                return False
+        return True
+
+    def _locate(self, x, axis):
+        """Return (index, weight) of the cell containing x, or None if outside."""
+        lo, hi = axis[0], axis[-1]
+        if x < lo or x > hi:
+            return None
+        if len(axis) < 2:
+            return 0, 0.0
+        step = (hi - lo) / (len(axis) - 1)
+        i = min(int((x - lo) / step), len(axis) - 2)
+        return i, (x - axis[i]) / step
+
+    def interpolate(self, delta_mux, delta_muy):
+        """Return the fields at the phase offsets [rad] (bilinear interpolation).
+
+        Returns None if the offsets are outside the grid.
+        """
+        cell_x = self._locate(delta_mux, self.dmux)
+        cell_y = self._locate(delta_muy, self.dmuy)
+        if cell_x is None or cell_y is None:
+            return None
+        i, u = cell_x
+        j, v = cell_y
+        i1 = min(i + 1, len(self.dmux) - 1)
+        j1 = min(j + 1, len(self.dmuy) - 1)
+        corners = [
+            (self.node(i, j), (1.0 - u) * (1.0 - v)),
+            (self.node(i1, j), u * (1.0 - v)),
+            (self.node(i, j1), (1.0 - u) * v),
+            (self.node(i1, j1), u * v),
+        ]
+        return [
+            sum(weight * fields[k] for fields, weight in corners)
+            for k in range(len(self.quad_ids))
+        ]
+
+    def save(self, filename):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(filename, "wb") as file:
+            file.write(
+                struct.pack(
+                    HEADER,
+                    MAGIC,
+                    len(self.dmux),
+                    len(self.dmuy),
+                    len(self.quad_ids),
+                    self.kinetic_energy,
+                    self.phases0[0],
+                    self.phases0[1],
+                )
+            )
+            _write_string(file, self.ref_ws_id)
+            _write_string(file, self.state)
+            _write_string(file, " ".join(self.quad_ids))
+            for values in [self.default_fields, self.dmux, self.dmuy, self.fields]:
+                _write_doubles(file, values)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as file:
+            header = file.read(struct.calcsize(HEADER))
+            magic, nx, ny, nq, kinetic_energy, mux0, muy0 = struct.unpack(
+                HEADER, header
+            )
+            if magic != MAGIC:
+                raise ValueError("{} is not a phase lookup grid.".format(filename))
+            ref_ws_id = _read_string(file)
+            state = _read_string(file)
+            quad_ids = _read_string(file).split()
+            default_fields, dmux, dmuy, fields = [_read_doubles(file) for _ in range(4)]
+        if (len(quad_ids), len(dmux), len(dmuy), len(fields)) != (
+            nq,
+            nx,
+            ny,
+            nx * ny * nq,
+        ):
+            raise ValueError("{} is corrupted.".format(filename))
+        return cls(
+            ref_ws_id,
+            state,
+            kinetic_energy,
+            (mux0, muy0),
+            default_fields,
+            quad_ids,
+            dmux,
+            dmuy,
+            fields,
+        )
+
+
+def stored_quad_ids(controller):
+    """Return the ids of the quads stored in a grid: QH18-QV19 and after WS24."""
+    ind_quad_ids = controller.ind_quad_ids
+    lo = ind_quad_ids.index("RTBT_Mag:QH18")
+    hi = ind_quad_ids.index("RTBT_Mag:QV19")
+    return ind_quad_ids[lo : hi + 1] + ind_quad_ids[-5:]
+
+
+def build(controller, max_offset=radians(45.0), n_steps=(13, 13), **planner_kws):
+    """Solve the optics on a grid of phase offsets around the default optics.
+
+    Parameters
+    ----------
+    controller : PhaseController
+        The controller; its model is left at the default optics.
+    max_offset : float or (float, float)
+        The grid spans [-max_offset, max_offset] in each plane [rad].
+    n_steps : (int, int)
+        Number of grid points in each plane.
+    **planner_kws
+        Passed to `ScanOpticsPlanner` (beta_lims, method, n_workers, ...).
+
+    Returns
+    -------
+    PhaseFieldGrid
+    """
+    if type(max_offset) in [int, float]:
+        max_offset = (max_offset, max_offset)
+    dmux = linspace(-max_offset[0], max_offset[0], n_steps[0])
+    dmuy = linspace(-max_offset[1], max_offset[1], n_steps[1])
+    controller.restore_default_optics("model")
+    controller.track()
+    mux0, muy0 = controller.phases(controller.ref_ws_id)
+
+    # Sweep the grid back and forth so that consecutive points are neighbors
+    # (the planner warm-starts each point from the previous one).
+    order = []
+    for i in range(len(dmux)):
+        columns = range(len(dmuy))
+        if i % 2 == 1:
+            columns = reversed(columns)
+        order.extend((i, j) for j in columns)
+    phases = [
+        (put_angle_in_range(mux0 + dmux[i]), put_angle_in_range(muy0 + dmuy[j]))
+        for i, j in order
+    ]
+    planner = ScanOpticsPlanner(controller, **planner_kws)
+    solutions = planner.plan(phases)
+
+    quad_ids = stored_quad_ids(controller)
+    indices = [controller.ind_quad_ids.index(quad_id) for quad_id in quad_ids]
+    nodes = dict()
+    for (i, j), ind_fields in zip(order, solutions):
+        nodes[(i, j)] = [ind_fields[k] for k in indices]
+    fields = []
+    for i in range(len(dmux)):
+        for j in range(len(dmuy)):
+            fields.extend(nodes[(i, j)])
+    return PhaseFieldGrid(
+        controller.ref_ws_id,
+        state_label(controller),
+        controller.kinetic_energy,
+        (mux0, muy0),
+        controller.default_fields,
+        quad_ids,
+        dmux,
+        dmuy,
+        fields,
+    )
+
+
+def find_grid(controller, directory=DEFAULT_DIR):
+    """Load the grid for the controller, or return None if there is no valid one."""
+    grid_filename = filename(controller, directory)
+    if not os.path.isfile(grid_filename):
+        return None
+    grid = PhaseFieldGrid.load(grid_filename)
+    if not grid.matches(controller):
+        return None
+    return grid
+
+
+def set_phase_offsets(controller, grid, delta_mux, delta_muy, max_iter=3, verbose=0):
+    """Set the model phase offsets at the reference wire-scanner from the grid.
+
+    The interpolated fields are refined by `max_iter` Levenberg-Marquardt
+    steps on QH18-QV19 (see `PhaseController.match`).
+
+    Parameters
+    ----------
+    controller : PhaseController
+        The controller. Its default optics must match the grid.
+    grid : PhaseFieldGrid
+        The lookup grid.
+    delta_mux, delta_muy : float
+        Phase offsets from the default optics [rad].
+    max_iter : int
+        Number of refinement steps.
+    verbose : int
+        If greater than zero, print a before/after summary.
+
+    Returns
+    -------
+    list[float] or None
+        The independent quad fields, or None if the offsets are outside the
+        grid (the model is not changed).
+    """
+    fields = grid.interpolate(delta_mux, delta_muy)
+    if fields is None:
+        return None
+    mux = put_angle_in_range(grid.phases0[0] + delta_mux)
+    muy = put_angle_in_range(grid.phases0[1] + delta_muy)
+    controller.restore_default_optics("model")
+    controller.set_fields(grid.quad_ids, fields, "model")
+    controller.track()
+    if verbose > 0:
+        print(
+            "  Interpolated phases: {:.3f}, {:.3f}".format(
+                *controller.phases(controller.ref_ws_id)
+            )
+        )
+
+    ind_quad_ids = controller.ind_quad_ids
+    lo = ind_quad_ids.index("RTBT_Mag:QH18")
+    hi = ind_quad_ids.index("RTBT_Mag:QV19")
+    quad_ids = ind_quad_ids[lo : hi + 1]
+    bounds = (controller.ps_lb[lo : hi + 1], controller.ps_ub[lo : hi + 1])
+
+    def residuals():
+        return phase_diffs(controller.phases(controller.ref_ws_id), [mux, muy])
+
+    controller.match(
+        quad_ids, residuals, fields[: len(quad_ids)], bounds, max_iter=max_iter
+    )
+    if verbose > 0:
+        print("  Desired phases     : {:.3f}, {:.3f}".format(mux, muy))
+        print(
+            "  Refined phases     : {:.3f}, {:.3f}".format(
+                *controller.phases(controller.ref_ws_id)
+            )
+        )
+    return controller.get_fields(ind_quad_ids, "model")
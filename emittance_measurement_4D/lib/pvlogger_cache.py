@@ -0,0 +1,207 @@
+"""Local store of PVLogger snapshots.
+
+Loading a machine state with `PVLoggerDataSource` is a database round trip.
+`SnapshotStore` keeps the magnet field settings it produces, together with the
+raw magnet and power supply readings, keyed by PVLoggerID. Snapshots are kept
+in memory (least recently used first out, with a bound on the number of stored
+values) and pickled to disk, so repeated syncs skip the database and archived
+measurements can be analyzed with no network connection.
+
+The field settings are stored per node id. A snapshot is replayed by setting
+the same model inputs that `PVLoggerDataSource.setModelSource` would set.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+import os
+import threading
+
+from xal.service.pvlogger.sim import PVLoggerDataSource
+from xal.sim.scenario import Scenario
+from xal.smf.impl import Electromagnet
+from xal.smf.proxy import ElectromagnetPropertyAccessor
+
+import utils
+
+
+DEFAULT_DIR = os.path.join("_cache", "pvlogger")
+FIELD = ElectromagnetPropertyAccessor.PROPERTY_FIELD
+
+
+def _to_dict(java_map):
+    """Convert a java.util.Map of PV names to values to a dict."""
+    return dict((str(key), float(java_map.get(key))) for key in java_map.keySet())
+
+
+def _magnet_nodes(sequence):
+    return sequence.getNodesOfType(Electromagnet.s_strType, True)
+
+
+class Snapshot:
+    """Machine state from one PVLoggerID.
+
+    Attributes
+    ----------
+    pvloggerid : int
+        The PVLoggerID.
+    fields : dict
+        Model field setting of each magnet node, keyed by node id.
+    magnets, supplies : dict
+        Raw magnet and power supply readings, keyed by PV name.
+    sequence_ids : list[str]
+        Ids of the sequences whose magnets are in `fields`.
+    """
+
+    def __init__(self, pvloggerid):
+        self.pvloggerid = pvloggerid
+        self.fields = dict()
+        self.magnets = dict()
+        self.supplies = dict()
+        self.sequence_ids = []
+
+    @classmethod
+    def from_dict(cls, data):
+        snapshot = cls(data["pvloggerid"])
+        snapshot.__dict__.update(data)
+        return snapshot
+
+    def size(self):
+        """Return the number of stored values."""
+        return len(self.fields) + len(self.magnets) + len(self.supplies)
+
+    def covers(self, sequence):
+        return sequence.getId() in self.sequence_ids
+
+    def record(self, pvl_data_source, sequence, scenario):
+        """Store the state that `pvl_data_source` loaded into `scenario`."""
+        self.magnets.update(_to_dict(pvl_data_source.getMagnetMap()))
+        self.supplies.update(_to_dict(pvl_data_source.getMagnetPSMap()))
+        for node in _magnet_nodes(sequence):
+            model_input = scenario.getModelInput(node, FIELD)
+            if model_input is not None:
+                self.fields[node.getId()] = model_input.getDoubleValue()
+        self.sequence_ids.append(sequence.getId())
+
+    def apply(self, sequence, scenario):
+        """Load the stored fields into the scenario. Call `resync` afterwards."""
+        scenario.setSynchronizationMode(Scenario.SYNC_MODE_DESIGN)
+        for node in _magnet_nodes(sequence):
+            field = self.fields.get(node.getId())
+            if field is not None:
+                scenario.setModelInput(node, FIELD, field)
+        return scenario
+
+
+class SnapshotStore:
+    """Snapshots keyed by PVLoggerID, cached in memory and on disk.
+
+    Parameters
+    ----------
+    directory : str or None
+        Folder for the pickled snapshots. If None, nothing is saved to disk.
+    max_values : int
+        Bound on the total number of values held in memory. The least recently
+        used snapshots are dropped from memory (not from disk) when it is
+        exceeded.
+    offline : bool
+        If True, never connect to the database; a snapshot that is not cached
+        raises a KeyError.
+    """
+
+    def __init__(self, directory=DEFAULT_DIR, max_values=100000, offline=False):
+        self.directory = directory
+        self.max_values = max_values
+        self.offline = offline
+        self.snapshots = OrderedDict()
+        self.n_values = 0
+        self.hits = self.misses = 0
+        self.lock = threading.RLock()
+
+    def filename(self, pvloggerid):
+        return os.path.join(self.directory, "{}.pkl".format(pvloggerid))
+
+    def _load(self, pvloggerid):
+        if self.directory is None:
+            return None
+        filename = self.filename(pvloggerid)
+        if not os.path.isfile(filename):
+            return None
+        return Snapshot.from_dict(utils.load_pickle(filename))
+
+    def _save(self, snapshot):
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Save a plain dict so the file does not depend on the module path.
+        utils.save_pickle(self.filename(snapshot.pvloggerid), snapshot.__dict__)
+
+    def _remember(self, snapshot):
+        """Move the snapshot to the front of the LRU order; enforce the bound."""
+        old = self.snapshots.pop(snapshot.pvloggerid, None)
+        if old is not None:
+            self.n_values -= old.size()
+        self.snapshots[snapshot.pvloggerid] = snapshot
+        self.n_values += snapshot.size()
+        while self.n_values > self.max_values and len(self.snapshots) > 1:
+            _, dropped = self.snapshots.popitem(last=False)
+            self.n_values -= dropped.size()
+
+    def get(self, pvloggerid, sequence):
+        """Return the snapshot for `pvloggerid`, covering the sequence magnets.
+
+        Safe to call from several threads; the database is queried outside the
+        lock.
+        """
+        with self.lock:
+            snapshot = self.snapshots.get(pvloggerid)
+            if snapshot is None:
+                snapshot = self._load(pvloggerid)
+            if snapshot is not None and snapshot.covers(sequence):
+                self.hits += 1
+                self._remember(snapshot)
+                return snapshot
+            self.misses += 1
+        if self.offline:
+            raise KeyError(
+                "PVLoggerID {} ({}) is not cached.".format(pvloggerid, sequence.getId())
+            )
+        pvl_data_source = PVLoggerDataSource(pvloggerid)
+        scenario = Scenario.newScenarioFor(sequence)
+        scenario = pvl_data_source.setModelSource(sequence, scenario)
+        with self.lock:
+            if snapshot is None:
+                snapshot = self.snapshots.get(pvloggerid) or Snapshot(pvloggerid)
+            if not snapshot.covers(sequence):
+                snapshot.record(pvl_data_source, sequence, scenario)
+                self._save(snapshot)
+            self._remember(snapshot)
+            return snapshot
+
+    def set_model_source(self, pvloggerid, sequence, scenario):
+        """Replacement for `PVLoggerDataSource(pvloggerid).setModelSource`."""
+        return self.get(pvloggerid, sequence).apply(sequence, scenario)
+
+    def clear(self):
+        """Forget the snapshots held in memory (the files are kept)."""
+        with self.lock:
+            self.snapshots.clear()
+            self.n_values = 0
+
+
+_default_store = None
+
+
+def default_store():
+    """Return the store shared by the module-level functions."""
+    global _default_store
+    if _default_store is None:
+        _default_store = SnapshotStore()
+    return _default_store
+
+
+def set_model_source(pvloggerid, sequence, scenario):
+    """Load the machine state from a PVLoggerID into the scenario.
+
+    Uses the default store. Call `scenario.resync()` afterwards.
+    """
+    return default_store().set_model_source(pvloggerid, sequence, scenario)
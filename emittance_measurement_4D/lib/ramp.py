@@ -0,0 +1,334 @@
+"""Ramp live quad fields in steps that stay under the MPS limit.
+
+The book value of a quad may only change by a small fraction (1%) at a time.
+`plan_ramp` computes the schedule from the current book values: each quad takes
+the largest allowed steps toward its target, and all quads step together.
+`ramp_fields` puts each step to all quads at once and moves to the next step as
+soon as the readbacks have settled on the setpoints instead of sleeping for a
+fixed time. If they have not settled within a timeout, or a put was not
+confirmed, the book values are read again and the rest of the ramp is planned
+from them, so every put stays within the limit of the actual book value. An
+optional minimum dwell keeps the steps at least that far apart.
+
+The channels are accessed through a small interface (`book`, `put`,
+`unconfirmed`, `readbacks`), implemented for the machine by `XalQuadChannels`
+and for tests by `SimulatedQuadChannels`. If the channel layer has a `field_cache` that
+monitors every quad, the ramp waits on its monitors instead of polling the
+readbacks.
+"""
+import math
+import threading
+import time
+
+try:
+    from xal.ca import Channel
+    from xal.ca import ConnectionException
+    from xal.ca import PutException
+    from xal.ca import PutListener
+    from xal.smf.impl import MagnetMainSupply
+
+    XAL = True
+except ImportError:
+    XAL = False
+
+
+def plan_ramp(start, stop, max_frac_change=0.01, max_steps=100):
+    """Return the field steps that take each quad from `start` to `stop`.
+
+    Each quad changes by at most `max_frac_change` times its current field per
+    step. After `max_steps` limited steps (or immediately if the remaining
+    change is allowed) the quad is set to its target.
+
+    Parameters
+    ----------
+    start, stop : list[float]
+        Initial (book) and final fields of each quad.
+    max_frac_change : float
+        Maximum fractional field change per step.
+    max_steps : int
+        Maximum number of limited steps per quad.
+
+    Returns
+    -------
+    list[list[float]]
+        The fields of all quads at each step. The last step is `stop`.
+    """
+    paths = []
+    for field, target in zip(start, stop):
+        path = []
+        while len(path) < max_steps:
+            max_abs_change = max_frac_change * abs(field)
+            change_needed = target - field
+            if abs(change_needed) <= max_abs_change:
+                break
+            field += math.copysign(max_abs_change, change_needed)
+            path.append(field)
+        path.append(target)
+        paths.append(path)
+    n_steps = max([len(path) for path in paths] + [0])
+    return [[path[min(k, len(path) - 1)] for path in paths] for k in range(n_steps)]
+
+
+def settled(readbacks, setpoints, tol):
+    """Return True if every readback is within a fraction `tol` of its setpoint."""
+    for readback, setpoint in zip(readbacks, setpoints):
+        if abs(readback - setpoint) > tol * max(abs(setpoint), 1.0):
+            return False
+    return True
+
+
+def ramp_fields(
+    channels,
+    quad_ids,
+    fields,
+    max_frac_change=0.01,
+    max_steps=100,
+    settle_tol=0.002,
+    timeout=0.5,
+    min_dwell=0.0,
+    max_retries=3,
+    poll_time=0.02,
+    sleep=time.sleep,
+    clock=time.time,
+):
+    """Ramp the quads to `fields`, keeping book and live values equal.
+
+    Parameters
+    ----------
+    channels : XalQuadChannels or SimulatedQuadChannels
+        The channel layer.
+    quad_ids : list[str]
+        Quads to ramp.
+    fields : list[float]
+        Target fields [T/m].
+    max_frac_change : float
+        Maximum fractional change of each book value per step.
+    max_steps : int
+        See `plan_ramp`.
+    settle_tol : float
+        Fractional tolerance for the readbacks to count as settled.
+    timeout : float
+        Maximum time to wait for the readbacks after each step [seconds]. If it
+        expires, or a put of the step was not confirmed, the book values are
+        read again and the rest of the ramp is planned from them.
+    min_dwell : float
+        Minimum time between the puts of consecutive steps [seconds].
+    max_retries : int
+        The ramp is aborted with a RuntimeError after this many consecutive
+        steps that did not settle.
+    poll_time : float
+        Time between readback checks [seconds].
+    sleep, clock : callable
+        Replaced by simulated time in tests.
+
+    Returns
+    -------
+    int
+        The number of steps put, including repeated ones.
+    """
+    steps = plan_ramp(channels.book(quad_ids), fields, max_frac_change, max_steps)
+    previous = None
+    n_puts = n_retries = k = 0
+    while k < len(steps):
+        step = steps[k]
+        if previous is None:
+            changed = range(len(quad_ids))
+        else:
+            changed = [i for i, (a, b) in enumerate(zip(step, previous)) if a != b]
+        channels.put([quad_ids[i] for i in changed], [step[i] for i in changed])
+        n_puts += 1
+        previous = step
+        start = clock()
+        cache = channels.field_cache
+        if cache is not None and cache.covers(quad_ids, "live"):
+            ok = cache.wait_until(quad_ids, step, "live", settle_tol, timeout)
+        else:
+            deadline = start + timeout
+            ok = settled(channels.readbacks(quad_ids), step, settle_tol)
+            while not ok and clock() < deadline:
+                sleep(poll_time)
+                ok = settled(channels.readbacks(quad_ids), step, settle_tol)
+        remaining = start + min_dwell - clock()
+        if remaining > 0.0:
+            sleep(remaining)
+        lost = channels.unconfirmed()
+        if ok and not lost:
+            n_retries = 0
+            k += 1
+            continue
+        n_retries += 1
+        if n_retries > max_retries:
+            raise RuntimeError(
+                "Ramp aborted: no step settled in {} retries.".format(max_retries)
+            )
+        if lost:
+            print("Puts not confirmed: {}".format(", ".join(lost)))
+        else:
+            print("Readbacks did not settle.")
+        print("Re-planning the ramp from the book values.")
+        book = channels.book(quad_ids)
+        steps = plan_ramp(book, fields, max_frac_change, max_steps)
+        previous = book
+        k = 0
+    return n_puts
+
+
+if XAL:
+
+    class _PutRecorder(PutListener):
+        """Records the channels whose puts have not completed yet."""
+
+        def __init__(self):
+            self.pending = set()
+            self.lock = threading.Lock()
+
+        def add(self, channel):
+            with self.lock:
+                self.pending.add(channel.channelName())
+
+        def putCompleted(self, channel):
+            with self.lock:
+                self.pending.discard(channel.channelName())
+
+        def unconfirmed(self):
+            with self.lock:
+                return sorted(self.pending)
+
+    class XalQuadChannels:
+        """Book and live field channels of the quads of a PhaseController.
+
+        The puts of one step are issued without waiting and flushed together.
+        A put that cannot be issued raises a RuntimeError; a put that is issued
+        but never completes is reported by `unconfirmed`.
+        """
+
+        def __init__(self, controller):
+            self.controller = controller
+            self.field_cache = controller.field_cache
+            self.put_listener = _PutRecorder()
+            self.set_channels = dict()
+
+        def _set_channel(self, quad_id):
+            channel = self.set_channels.get(quad_id)
+            if channel is None:
+                node = self.controller.sequence.getNodeWithId(quad_id)
+                channel = node.getMainSupply().findChannel(
+                    MagnetMainSupply.FIELD_SET_HANDLE
+                )
+                self.set_channels[quad_id] = channel
+            return channel
+
+        def book(self, quad_ids):
+            """Read the book values from the channels, bypassing the cache.
+
+            The cache holds the values put by this ramp, which a lost put
+            would make wrong, so it is corrected from the channels here.
+            """
+            fields = []
+            for quad_id in quad_ids:
+                node = self.controller.sequence.getNodeWithId(quad_id)
+                value = self.controller.book_channels[quad_id].getValFlt()
+                field = node.toFieldFromCA(value)
+                if self.field_cache is not None:
+                    self.field_cache.update(quad_id, "book", field)
+                fields.append(field)
+            return fields
+
+        def _put(self, channel, value):
+            self.put_listener.add(channel)
+            try:
+                channel.putValCallback(value, self.put_listener)
+            except (ConnectionException, PutException) as exception:
+                raise RuntimeError(
+                    "Put to {} failed: {}".format(channel.channelName(), exception)
+                )
+
+        def put(self, quad_ids, fields):
+            sequence = self.controller.sequence
+            for quad_id, field in zip(quad_ids, fields):
+                value = sequence.getNodeWithId(quad_id).toCAFromField(field)
+                self._put(self.controller.book_channels[quad_id], value)
+                self._put(self._set_channel(quad_id), value)
+                if self.field_cache is not None:
+                    self.field_cache.update(quad_id, "book", field)
+            Channel.flushIO()
+
+        def unconfirmed(self):
+            """Return the names of the channels whose puts have not completed."""
+            return self.put_listener.unconfirmed()
+
+        def readbacks(self, quad_ids):
+            return self.controller.get_fields(quad_ids, "live")
+
+
+class SimulatedQuadChannels:
+    """Quad channels with first-order readback lag, for testing ramps.
+
+    Parameters
+    ----------
+    fields : dict
+        Initial field of each quad, keyed by quad id.
+    tau : float
+        Time constant of the readbacks [seconds].
+    trip_frac : float
+        A put that changes a book value by more than this fraction raises a
+        RuntimeError, like an MPS trip.
+    clock : callable
+        Returns the current time [seconds].
+    lost_puts : list[int]
+        Indices of the puts that are dropped, leaving the book values
+        unchanged. They are reported by `unconfirmed`.
+    """
+
+    def __init__(
+        self, fields, tau=0.1, trip_frac=0.05, clock=time.time, lost_puts=()
+    ):
+        self.tau = tau
+        self.trip_frac = trip_frac
+        self.clock = clock
+        self.lost_puts = set(lost_puts)
+        self.lost = []
+        self.field_cache = None
+        self.book_values = dict(fields)
+        self.live_values = dict(fields)
+        self.start_values = dict(fields)
+        self.put_times = dict((quad_id, clock()) for quad_id in fields)
+        self.n_puts = 0
+
+    def book(self, quad_ids):
+        return [self.book_values[quad_id] for quad_id in quad_ids]
+
+    def put(self, quad_ids, fields):
+        self.lost = []
+        if self.n_puts in self.lost_puts:
+            self.lost = list(quad_ids)
+            self.n_puts += 1
+            return
+        readbacks = self.readbacks(quad_ids)
+        now = self.clock()
+        for quad_id, field, readback in zip(quad_ids, fields, readbacks):
+            book = self.book_values[quad_id]
+            if abs(field - book) > self.trip_frac * abs(book):
+                raise RuntimeError(
+                    "MPS trip: {} changed from {} to {}.".format(quad_id, book, field)
+                )
+            self.start_values[quad_id] = readback
+            self.book_values[quad_id] = self.live_values[quad_id] = field
+            self.put_times[quad_id] = now
+        self.n_puts += 1
+
+    def unconfirmed(self):
+        return list(self.lost)
+
+    def readbacks(self, quad_ids):
+        now = self.clock()
+        readbacks = []
+        for quad_id in quad_ids:
+            setpoint = self.live_values[quad_id]
+            decay = 0.0
+            if self.tau > 0.0:
+                decay = math.exp(-(now - self.put_times[quad_id]) / self.tau)
+            readbacks.append(
+                setpoint + (self.start_values[quad_id] - setpoint) * decay
+            )
+        return readbacks
@@ -0,0 +1,129 @@
+"""Cache of the matched Twiss parameters at the RTBT entrance.
+
+The matched Twiss parameters come from tracking a transfer-map probe through
+the whole Ring, which dominates the cost of changing the kinetic energy or the
+reconstruction point. `MatchedTwissCache` keeps them per machine state
+(PVLoggerID or sync mode), kinetic energy and lattice. Entries for a
+PVLoggerID or the design optics only change with the lattice files, so they
+are also pickled to disk, keyed by the lattice identity (see
+`accelerator_registry.lattice_id`). Entries for the live machine are kept in
+memory only, and expire after `live_max_age`.
+"""
+import os
+import threading
+import time
+
+import utils
+
+
+DEFAULT_FILE = os.path.join("_cache", "ring_twiss.pkl")
+
+
+def state_key(pvloggerid=None, sync_mode="design"):
+    """Return the key of the machine state."""
+    if pvloggerid is not None:
+        return "pvl{}".format(pvloggerid)
+    return sync_mode
+
+
+class MatchedTwissCache:
+    """Matched (alpha_x, alpha_y, beta_x, beta_y) keyed by (state, energy, lattice).
+
+    Parameters
+    ----------
+    filename : str or None
+        Pickle file for the persistent entries. If None, nothing is saved.
+    live_max_age : float
+        Lifetime of the entries for the live machine [seconds].
+    """
+
+    def __init__(self, filename=DEFAULT_FILE, live_max_age=300.0):
+        self.filename = filename
+        self.live_max_age = live_max_age
+        self.entries = None
+        self.live_times = dict()
+        self.hits = self.misses = 0
+        self.lock = threading.RLock()
+
+    def _load(self):
+        self.entries = dict()
+        if self.filename is not None and os.path.isfile(self.filename):
+            for key, twiss in utils.load_pickle(self.filename).items():
+                # Entries saved without a lattice identity are dropped.
+                if len(key) == 3:
+                    self.entries[key] = twiss
+
+    def _save(self):
+        if self.filename is None:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        persistent = dict(
+            (key, twiss) for key, twiss in self.entries.items() if key[0] != "live"
+        )
+        utils.save_pickle(self.filename, persistent)
+
+    def get(
+        self,
+        compute,
+        kinetic_energy,
+        pvloggerid=None,
+        sync_mode="design",
+        lattice_id=None,
+    ):
+        """Return the matched Twiss parameters, calling `compute()` on a miss.
+
+        `compute()` must return (alpha_x, alpha_y, beta_x, beta_y) for the
+        machine state and kinetic energy [eV]. It is called outside the lock,
+        so different states can be computed on different threads. `lattice_id`
+        identifies the lattice files; entries for another lattice are not used.
+        """
+        key = (state_key(pvloggerid, sync_mode), int(round(kinetic_energy)), lattice_id)
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            twiss = self.entries.get(key)
+            if twiss is not None and key[0] == "live":
+                if time.time() - self.live_times[key] > self.live_max_age:
+                    twiss = None
+            if twiss is not None:
+                self.hits += 1
+                return list(twiss)
+            self.misses += 1
+        twiss = tuple(compute())
+        with self.lock:
+            self.entries[key] = twiss
+            if key[0] == "live":
+                self.live_times[key] = time.time()
+            else:
+                self._save()
+        return list(twiss)
+
+    def invalidate(self, pvloggerid=None, sync_mode=None):
+        """Forget the entries for one machine state, or all if no state is given.
+
+        Forgotten persistent entries are also removed from the file.
+        """
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if pvloggerid is None and sync_mode is None:
+                self.entries.clear()
+            else:
+                state = state_key(pvloggerid, sync_mode)
+                for key in list(self.entries):
+                    if key[0] == state:
+                        del self.entries[key]
+            self._save()
+
+
+_default_cache = None
+
+
+def default_cache():
+    """Return the cache shared by the module-level functions."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = MatchedTwissCache()
+    return _default_cache
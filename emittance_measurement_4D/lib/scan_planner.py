@@ -0,0 +1,139 @@
+"""Compute the model optics for each step of a phase scan.
+
+Each step sets the phase advances at the reference wire-scanner and, if the
+beta functions at the target moved too far from their default values,
+re-matches the quads after WS24. Neighboring steps have neighboring phases,
+so each step starts from the solution of the previous step instead of the
+default optics.
+
+The steps can be split into contiguous blocks that are solved at the same
+time, each on its own clone of the `PhaseController` (under Jython the
+blocks run on parallel threads; see `parallel`).
+"""
+from __future__ import print_function
+
+import parallel
+
+
+class ScanOpticsPlanner:
+    """Solve for the quad fields at each step of a phase scan.
+
+    Parameters
+    ----------
+    phase_controller : PhaseController
+        The controller; its model is left at the default optics.
+    beta_lims : (xmax, ymax)
+        Maximum beta functions from QH02 to WS24.
+    target_beta_tol : float
+        Fractional change in the target beta functions that triggers
+        `constrain_size_on_target`.
+    method : {'lm', 'simplex'}
+        Passed to `PhaseController.set_ref_ws_phases`. An 'lm' iteration
+        costs one track per varied quad plus one; 'simplex' evaluates up to
+        1000 trial points.
+    n_workers : int
+        Number of blocks solved at the same time. Each extra worker needs a
+        clone of the controller.
+    verbose : int
+        Passed to the controller methods.
+    """
+
+    def __init__(
+        self,
+        phase_controller,
+        beta_lims=(40.0, 40.0),
+        target_beta_tol=0.05,
+        method="lm",
+        n_workers=1,
+        verbose=1,
+    ):
+        self.phase_controller = phase_controller
+        self.beta_lims = beta_lims
+        self.target_beta_tol = target_beta_tol
+        self.method = method
+        self.n_workers = n_workers
+        self.verbose = verbose
+
+    def solve_step(self, controller, mux, muy, start_fields=None):
+        """Set the optics for one step and return the independent quad fields.
+
+        `start_fields` (the independent quad fields of a neighboring step) is
+        the initial guess. If None, start from the default optics.
+        """
+        ind_quad_ids = controller.ind_quad_ids
+        lo = ind_quad_ids.index("RTBT_Mag:QH18")
+        hi = ind_quad_ids.index("RTBT_Mag:QV19")
+        guess = None
+        if start_fields is not None:
+            guess = start_fields[lo : hi + 1]
+        fields = controller.set_ref_ws_phases(
+            mux,
+            muy,
+            self.beta_lims,
+            verbose=self.verbose,
+            guess=guess,
+            method=self.method,
+        )
+        controller.set_fields(ind_quad_ids[lo : hi + 1], fields, "model")
+        controller.track()
+
+        # Constrain beam size on target if it's too far from the default.
+        betas = controller.beta_funcs("RTBT:Tgt")
+        default_betas = controller.default_betas_at_target
+        for beta, beta_default in zip(betas, default_betas):
+            if abs(beta - beta_default) / beta_default > self.target_beta_tol:
+                if start_fields is not None:
+                    controller.set_fields(ind_quad_ids[-5:], start_fields[-5:], "model")
+                    controller.track()
+                if self.verbose > 0:
+                    print("Setting betas at target...")
+                controller.constrain_size_on_target(verbose=self.verbose)
+                controller.track()
+                break
+        return controller.get_fields(ind_quad_ids, "model")
+
+    def solve_block(self, controller, steps, progress=None):
+        """Solve consecutive steps, each warm-started from the previous one.
+
+        `steps` is a list of (index, mux, muy). Returns a list of
+        (index, fields).
+        """
+        results = []
+        fields = None
+        for index, mux, muy in steps:
+            if self.verbose > 0:
+                print("Scan index = {}.".format(index))
+            fields = self.solve_step(controller, mux, muy, fields)
+            results.append((index, fields))
+            if progress is not None:
+                progress(index)
+        return results
+
+    def plan(self, phases, progress=None):
+        """Return the independent quad fields for each (mux, muy) in `phases`.
+
+        `progress(index)` is called after each step is solved (from a worker
+        thread if n_workers > 1). The controller is restored to the default
+        optics afterwards.
+        """
+        steps = [(i, mux, muy) for i, (mux, muy) in enumerate(phases)]
+        n_blocks = max(1, min(self.n_workers, len(steps)))
+        block_size = -(-len(steps) // n_blocks)
+        blocks = [steps[i : i + block_size] for i in range(0, len(steps), block_size)]
+        controllers = [self.phase_controller]
+        controllers += [self.phase_controller.clone() for _ in blocks[1:]]
+
+        def solve(args):
+            controller, block = args
+            return self.solve_block(controller, block, progress)
+
+        results = []
+        for block_results in parallel.map_threads(
+            solve, zip(controllers, blocks), n_workers=n_blocks
+        ):
+            results.extend(block_results)
+        results.sort()
+
+        self.phase_controller.restore_default_optics("model")
+        self.phase_controller.track()
+        return [fields for index, fields in results]
@@ -0,0 +1,162 @@
+"""Sobol quasi-random sequence in pure Python.
+
+Quasi-random points fill the unit hypercube more evenly than pseudo-random
+points, so averages over them usually converge faster. The generating
+polynomials are found by search (the first primitive polynomials over GF(2),
+in order of degree), so any dimension is supported. The initial direction
+numbers are drawn from a generator with a fixed seed, so the sequence is
+always the same; the `seed` argument only sets a random digital shift
+(XOR with a random integer), which gives an unbiased randomized sequence.
+"""
+import random
+
+
+N_BITS = 32
+
+
+def _poly_mulmod(a, b, p, degree):
+    """Return a * b mod p for polynomials over GF(2) stored as integers."""
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a >> degree & 1:
+            a ^= p
+    return result
+
+
+def _poly_powmod(a, n, p, degree):
+    result = 1
+    while n:
+        if n & 1:
+            result = _poly_mulmod(result, a, p, degree)
+        a = _poly_mulmod(a, a, p, degree)
+        n >>= 1
+    return result
+
+
+def _prime_factors(n):
+    factors = []
+    q = 2
+    while q * q <= n:
+        if n % q == 0:
+            factors.append(q)
+            while n % q == 0:
+                n //= q
+        q += 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+
+def _is_primitive(p, degree):
+    """Return True if polynomial `p` of degree `degree` is primitive over GF(2).
+
+    p is primitive if x has multiplicative order 2^degree - 1 modulo p.
+    """
+    if degree == 1:
+        return p == 3
+    order = 2 ** degree - 1
+    if _poly_powmod(2, order, p, degree) != 1:
+        return False
+    for q in _prime_factors(order):
+        if _poly_powmod(2, order // q, p, degree) == 1:
+            return False
+    return True
+
+
+def primitive_polynomials(n):
+    """Return the first `n` primitive polynomials over GF(2) as (degree, int)."""
+    polys = []
+    degree = 1
+    while len(polys) < n:
+        for p in range(2 ** degree + 1, 2 ** (degree + 1), 2):
+            if _is_primitive(p, degree):
+                polys.append((degree, p))
+                if len(polys) == n:
+                    break
+        degree += 1
+    return polys
+
+
+def direction_numbers(dim):
+    """Return the direction numbers v[k][j] for dimensions k < dim."""
+    rng = random.Random(12345)
+    v = [[1 << (N_BITS - 1 - j) for j in range(N_BITS)]]
+    for degree, p in primitive_polynomials(dim - 1):
+        # m_i is odd and m_i < 2^i (i = 1, ..., degree).
+        m = [1] + [2 * rng.randrange(2 ** (i - 1)) + 1 for i in range(2, degree + 1)]
+        for i in range(degree, N_BITS):
+            value = m[i - degree] ^ (m[i - degree] << degree)
+            for k in range(1, degree):
+                if p >> (degree - k) & 1:
+                    value ^= m[i - k] << k
+            m.append(value)
+        v.append([m[j] << (N_BITS - 1 - j) for j in range(N_BITS)])
+    return v
+
+
+class SobolSequence:
+    """Sobol points in [0, 1)^dim.
+
+    Points are generated in Gray code order, so point i only depends on i;
+    any block of points can be generated independently of the others.
+
+    Parameters
+    ----------
+    dim : int
+        Number of dimensions.
+    seed : int, optional
+        Seed for the random digital shift. If None, the points are not shifted
+        (and the first point is the origin).
+    """
+
+    def __init__(self, dim, seed=None):
+        self.dim = dim
+        self.v = direction_numbers(dim)
+        if seed is None:
+            self.shift = dim * [0]
+        else:
+            rng = random.Random(seed)
+            self.shift = [rng.getrandbits(N_BITS) for _ in range(dim)]
+
+    def points(self, start, n):
+        """Return points start, ..., start + n - 1 as a list of shape (n, dim)."""
+        gray = start ^ (start >> 1)
+        x = []
+        for k in range(self.dim):
+            value = 0
+            for j in range(N_BITS):
+                if gray >> j & 1:
+                    value ^= self.v[k][j]
+            x.append(value)
+        scale = 1.0 / 2 ** N_BITS
+        points = []
+        for i in range(start, start + n):
+            points.append([(xk ^ sk) * scale for xk, sk in zip(x, self.shift)])
+            # The next point in Gray code order differs in the lowest zero bit of i.
+            c = 0
+            while i >> c & 1:
+                c += 1
+            for k in range(self.dim):
+                x[k] ^= self.v[k][c]
+        return points
+
+
+class PointSampler:
+    """Draw uniform numbers from the coordinates of one quasi-random point.
+
+    Implements `uniform(a, b)` like `random.Random`, so a point can be used in
+    place of a random number generator. Each call uses the next coordinate.
+    """
+
+    def __init__(self, point):
+        self.point = point
+        self.index = 0
+
+    def uniform(self, a, b):
+        u = self.point[self.index]
+        self.index += 1
+        return a + (b - a) * u
@@ -1,7 +1,9 @@
+from collections import OrderedDict
 import math
 import os
 import pickle
-from Jama import Matrix
+
+from backend import Matrix
 
 
 def list_files(path, join=True):
@@ -94,6 +96,33 @@ def matvec(A, vec):
     return [dot(row, vec) for row in A]
 
 
+def matmul(A, B):
+    """Return the matrix product of lists A and B."""
+    BT = transpose(B)
+    return [[dot(row, col) for col in BT] for row in A]
+
+
+def inverse(A):
+    """Return the inverse of square matrix A (list of lists).
+
+    Uses Gauss-Jordan elimination with partial pivoting.
+    """
+    n = len(A)
+    M = [list(row) + [float(i == j) for j in range(n)] for i, row in enumerate(A)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda i: abs(M[i][col]))
+        if M[pivot][col] == 0.0:
+            raise ValueError("Matrix is singular.")
+        M[col], M[pivot] = M[pivot], M[col]
+        scale = 1.0 / M[col][col]
+        M[col] = [elem * scale for elem in M[col]]
+        for i in range(n):
+            factor = M[i][col]
+            if i != col and factor != 0.0:
+                M[i] = [a - factor * b for a, b in zip(M[i], M[col])]
+    return [row[n:] for row in M]
+
+
 def linspace(start, stop, num=10, endpoint=True):
     if num < 2:
         return [start]
@@ -131,6 +160,72 @@ def mean_std(xx):
     return mean(xx), std(xx)
 
 
+class RunningStats:
+    """Running mean and standard deviation (Welford's algorithm).
+
+    Values are added one at a time, so the full sample never has to be stored.
+    `std` matches `utils.std` (the population standard deviation).
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def push(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+
+    def variance(self):
+        return self._m2 / self.n
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def mean_std(self):
+        if self.n == 0:
+            return None, None
+        return self.mean, self.std()
+
+
+class LRUCache:
+    """Bounded mapping that drops the least recently used item when full.
+
+    Counts cache hits and misses in `get`.
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
 # JAMA matrices
 # -------------------------------------------------------------------------------
 def diagonal_matrix(diagonal_elements):
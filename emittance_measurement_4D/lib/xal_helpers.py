@@ -11,13 +11,13 @@ from xal.extension.solver.algorithm import SimplexSearchAlgorithm
 from xal.extension.solver.ProblemFactory import getInverseSquareMinimizerProblem
 from xal.extension.solver.SolveStopperFactory import maxEvaluationsStopper
 from xal.smf import Accelerator
-from xal.smf.data import XMLDataManager
+
+import accelerator_registry
 
 
 def load_sequence(sequence_name):
     """Load the RTBT sequence of the SNS accelerator."""
-    accelerator = XMLDataManager.loadDefaultAccelerator()
-    return accelerator.getComboSequence(sequence_name)
+    return accelerator_registry.get_sequence(sequence_name)
 
 
 def write_traj_to_file(data, positions, filename):
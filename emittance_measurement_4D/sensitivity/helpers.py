@@ -4,15 +4,15 @@ import os
 import math
 from math import sqrt
 import random
-from Jama import Matrix
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from lib import analysis
+from lib import parallel
 from lib import utils
-from lib.least_squares import lsq_linear
+from lib.backend import Matrix
 
 
-def get_moments(Sigma0, tmats, frac_error=None):
+def get_moments(Sigma0, tmats, frac_error=None, rng=random):
     """Return moments after application of each transfer matrix.
     
     Parameters
@@ -24,6 +24,8 @@ def get_moments(Sigma0, tmats, frac_error=None):
     frac_error : float
         The squared moment along each dimension is multiplied by 1 + f, where
         -frac_err <= f <= +frac_err.
+    rng : random.Random
+        The random number generator used for the noise.
         
     Returns
     -------
@@ -40,9 +42,9 @@ def get_moments(Sigma0, tmats, frac_error=None):
         sig_xy = Sigma.get(0, 2)
         sig_uu = 0.5 * (2.0 * sig_xy + sig_xx + sig_yy)
         if frac_error is not None:
-            sig_xx *= 1.0 + random.uniform(-frac_error, frac_error)
-            sig_yy *= 1.0 + random.uniform(-frac_error, frac_error)
-            sig_uu *= 1.0 + random.uniform(-frac_error, frac_error)
+            sig_xx *= 1.0 + rng.uniform(-frac_error, frac_error)
+            sig_yy *= 1.0 + rng.uniform(-frac_error, frac_error)
+            sig_uu *= 1.0 + rng.uniform(-frac_error, frac_error)
         sig_xy = 0.5 * (2.0 * sig_uu - sig_xx - sig_yy)
         moments.append([sig_xx, sig_yy, sig_xy])
     return moments
@@ -50,33 +52,64 @@ def get_moments(Sigma0, tmats, frac_error=None):
 
 def solve(tmats, moments, return_type='matrix'):
     """Return the LLSQ solution from the measurements."""
-    Axx, Ayy, Axy = [], [], []
-    bxx, byy, bxy = [], [], []
-    for M, (sig_xx, sig_yy, sig_xy) in zip(tmats, moments):
-        Axx.append([M[0][0] ** 2, M[0][1] ** 2, 2 * M[0][0] * M[0][1]])
-        Ayy.append([M[2][2] ** 2, M[2][3] ** 2, 2 * M[2][2] * M[2][3]])
-        Axy.append(
-            [M[0][0] * M[2][2], M[0][1] * M[2][2], M[0][0] * M[2][3], M[0][1] * M[2][3]]
-        )
-        bxx.append(sig_xx)
-        byy.append(sig_yy)
-        bxy.append(sig_xy)
-    sig_11, sig_22, sig_12 = lsq_linear(Axx, bxx)
-    sig_33, sig_44, sig_34 = lsq_linear(Ayy, byy)
-    sig_13, sig_23, sig_14, sig_24 = lsq_linear(Axy, bxy)
-    Sigma = [
-        [sig_11, sig_12, sig_13, sig_14],
-        [sig_12, sig_22, sig_23, sig_24],
-        [sig_13, sig_23, sig_33, sig_34],
-        [sig_14, sig_24, sig_34, sig_44],
-    ]
-    if return_type == 'matrix':
-        Sigma = Matrix(Sigma)
+    Sigma = analysis.to_mat(analysis.ReconstructionSystem(tmats).solve(moments))
+    if return_type != 'matrix':
+        Sigma = [list(row) for row in Sigma.getArray()]
     return Sigma
 
 
-def run_trials(Sigma0, tmats, n_trials, frac_error=None, disp=False):
+def _trials_chunk(args):
+    """Run one chunk of trials; return each Sigma as a list (None if it failed)."""
+    Sigma0, tmats, frac_error, seed, n = args
+    rng = random.Random(seed)
+    system = analysis.ReconstructionSystem(tmats)
+    block = [get_moments(Sigma0, tmats, frac_error, rng) for _ in range(n)]
+    Sigmas = []
+    for x in system.solve_batch(block):
+        Sigma = analysis.to_mat(x)
+        if analysis.is_valid_covariance_matrix(Sigma):
+            Sigmas.append([list(row) for row in Sigma.getArray()])
+        else:
+            Sigmas.append(None)
+    return Sigmas
+
+
+def trial_sigmas(
+    Sigma0, tmats, n_trials, frac_error=None, seed=None, n_workers=None, chunk_size=500
+):
+    """Return the LLSQ solution for `n_trials` noisy measurements.
+
+    The trials are split into chunks. Each chunk draws its noise from its own
+    random number generator, seeded from `seed`, and the chunks can run on
+    parallel workers (see `parallel.WorkerPool`). The result does not depend
+    on `n_workers`, which defaults to `parallel.default_workers()`.
+
+    Returns
+    -------
+    list, shape (n_trials,)
+        The reconstructed Sigma (list of shape (4, 4)) at each trial, or None
+        if the trial failed.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    if n_workers is None:
+        n_workers = parallel.default_workers()
+    chunk_seeds = random.Random(seed)
+    args_list = []
+    for start in range(0, n_trials, chunk_size):
+        n = min(chunk_size, n_trials - start)
+        args_list.append((Sigma0, tmats, frac_error, chunk_seeds.getrandbits(32), n))
+    with parallel.WorkerPool(n_workers, processes=True) as pool:
+        chunks = pool.map(_trials_chunk, args_list)
+    return [Sigma for chunk in chunks for Sigma in chunk]
+
+
+def run_trials(
+    Sigma0, tmats, n_trials, frac_error=None, disp=False, seed=None, n_workers=None
+):
     """Repeat measurement `n_trials` times.
+
+    See `trial_sigmas` for `seed` and `n_workers`.
     
     Returns
     -------
@@ -86,15 +119,14 @@ def run_trials(Sigma0, tmats, n_trials, frac_error=None, disp=False):
         Reconstructed [eps_x, eps_y, eps_1, eps_2] at each successful trial.
     """
     emittances, n_fail = [], 0
-    for i in range(n_trials):
-        moments = get_moments(Sigma0, tmats, frac_error)
-        Sigma = solve(tmats, moments)
-        if not analysis.is_valid_covariance_matrix(Sigma):
+    Sigmas = trial_sigmas(Sigma0, tmats, n_trials, frac_error, seed, n_workers)
+    for i, Sigma in enumerate(Sigmas):
+        if Sigma is None:
             n_fail += 1
             if disp:
                 print(i, "Failed.")
             continue
-        eps_x, eps_y, eps_1, eps_2 = analysis.emittances(Sigma)
+        eps_x, eps_y, eps_1, eps_2 = analysis.emittances(Matrix(Sigma))
         emittances.append([eps_x, eps_y, eps_1, eps_2])
         if disp:
             print(i, eps_x, eps_y, eps_1, eps_2)
@@ -104,8 +136,12 @@ def run_trials(Sigma0, tmats, n_trials, frac_error=None, disp=False):
     return fail_rate, emittances
 
 
-def run_trials2(Sigma0, tmats, n_trials, frac_error=None, disp=False):
+def run_trials2(
+    Sigma0, tmats, n_trials, frac_error=None, disp=False, seed=None, n_workers=None
+):
     """Repeat measurement `n_trials` times.
+
+    See `trial_sigmas` for `seed` and `n_workers`.
     
     Returns
     -------
@@ -115,10 +151,10 @@ def run_trials2(Sigma0, tmats, n_trials, frac_error=None, disp=False):
         Reconstructed [eps_x, eps_y, eps_1, eps_2] at each successful trial.
     """
     Sigmas, n_fail = [], 0
-    for i in range(n_trials):
-        moments = get_moments(Sigma0, tmats, frac_error)
-        Sigma = solve(tmats, moments, return_type='list')
-        if not analysis.is_valid_covariance_matrix(Matrix(Sigma)):
+    for i, Sigma in enumerate(
+        trial_sigmas(Sigma0, tmats, n_trials, frac_error, seed, n_workers)
+    ):
+        if Sigma is None:
             n_fail += 1
             if disp:
                 print(i, "Failed.")
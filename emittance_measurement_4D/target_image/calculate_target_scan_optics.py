@@ -177,12 +177,12 @@ for i, mux in enumerate(muxx):
         file.write(
             "node_id M11 M12 M13 M14 M21 M22 M23 M34 M31 M32 M33 M34 M41 M42 M43 M44\n"
         )
-        for node in controller.sequence.getNodes():
-            M = controller.transfer_matrix(node.getId(), "RTBT:Tgt")
+        tmat_table = controller.transfer_matrix_table()
+        for node_id, M in zip(tmat_table.node_ids, tmat_table.to_target("RTBT:Tgt")):
             tmat_elems = [M[k][l] for k in range(4) for l in range(4)]
             file.write(
                 "{} {} {} {} {} {} {} {} {} {} {} {} {} {} {} {} {}\n".format(
-                    node.getId(), *tmat_elems
+                    node_id, *tmat_elems
                 )
             )
         file.close()